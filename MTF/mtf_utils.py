@@ -0,0 +1,292 @@
+import argparse
+import glob
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+
+import numpy as np
+from scipy import ndimage as ndi
+from scipy.interpolate import PchipInterpolator
+from scipy.io import savemat
+from skimage.filters import threshold_otsu
+
+# Slanted-edge pre-sampled MTF, a port of MTF_Analysis.m / simple_MTF_Analysis.m without the
+# interactive crop. The subpixel edge of every row is found at once (argmax of the smoothed
+# row derivative, then an inverse pchip through the 5 pixels around it, vectorized over
+# rows), and the oversampled ESF is binned with np.bincount. Parameters and outputs follow
+# the MATLAB script (resolutions in mm, frequencies in line pairs per mm).
+
+NA = 0.79
+WAVELENGTH = 532e-9                 # m
+PIXEL_MM = 0.00006686046            # isotropic pixel pitch in mm
+PIXEL_SUBDIVISION = 0.10            # ESF bin width in pixels
+BIN_PAD = 0.0001
+SPAN = 10                           # ESF smoothing window
+EDGE_SPAN = 4                       # row smoothing window to locate the edge
+BOUND = 2                           # pixels either side of the edge for the subpixel position
+BOUND_EXTRA = 6                     # pixels either side of the edge binned into the ESF
+MTF_LEVELS = dict(smoothed=0.09, fit=0.1, raw=0.1)
+
+@dataclass
+class MTFResult:
+    image: str
+    orientation: str        # 'vertical' (edge crosses the rows) or 'horizontal' (analysed transposed)
+    angle_deg: float        # edge angle to the row axis, as Angle_degrees in the MATLAB script
+    roi: tuple              # (y0, y1, x0, x1) analysed region
+    edge_position: np.ndarray
+    x_esf: np.ndarray
+    esf: np.ndarray
+    lsf: np.ndarray         # from the smoothed ESF, normalized
+    lsf_fit: np.ndarray     # Gaussian fit of lsf
+    lsf_raw: np.ndarray
+    freq: np.ndarray        # lp/mm
+    mtf: np.ndarray
+    mtf_fit: np.ndarray
+    mtf_raw: np.ndarray
+    mtf_ideal: np.ndarray   # diffraction limit on freq_ideal
+    freq_ideal: np.ndarray
+    resolution_smoothed: float  # mm
+    resolution_fit: float
+    resolution_raw: float
+
+    def record(self):
+        """ row of the results store 'mtf' table (results_utils.py) """
+        res = dict(smoothed=self.resolution_smoothed, fit=self.resolution_fit, raw=self.resolution_raw)
+        rec = dict(image=self.image, angle_deg=self.angle_deg, freq=self.freq, mtf=self.mtf)
+        for k, v in res.items():
+            rec[f'res_{k}_um'] = v * 1e3
+            rec[f'lpmm_{k}'] = 1 / (2 * v)
+        return rec
+
+def to_gray(img):
+    """ rgb2gray weights for colour images, float64 """
+    img = np.asarray(img, dtype=np.float64)
+    if img.ndim == 3:
+        img = img[..., :3] @ np.array([0.2989, 0.5870, 0.1140])
+    return img
+
+def edge_roi(image, pad=20, sigma=2.):
+    """
+    Box (y0, y1, x0, x1) around the strongest edge, replacing the interactive crop: pixels whose
+    gradient magnitude is above half its maximum, largest component, padded by pad pixels.
+    """
+    grad = ndi.gaussian_gradient_magnitude(image, sigma)
+    lab, n = ndi.label(grad > 0.5 * grad.max())
+    if n > 1:
+        lab = np.where(lab == np.argmax(np.bincount(lab.ravel())[1:]) + 1, 1, 0)
+    ys, xs = ndi.find_objects(lab)[0]
+    H, W = image.shape
+    return max(ys.start - pad, 0), min(ys.stop + pad, H), max(xs.start - pad, 0), min(xs.stop + pad, W)
+
+def edge_threshold(image):
+    """ Otsu split, then the midpoint of the mean intensities of the two sides """
+    t = threshold_otsu(image)
+    return (image[image >= t].mean() + image[image <= t].mean()) / 2
+
+def is_vertical(image):
+    """ the edge crosses the rows when intensity changes mostly along them """
+    return np.abs(np.diff(image, axis=1)).sum() > np.abs(np.diff(image, axis=0)).sum()
+
+def _pchip_slopes(x, y):
+    # MATLAB / scipy pchip derivatives, every row of (n, k) at once (k >= 3)
+    h = np.diff(x, axis=1)
+    delta = np.diff(y, axis=1) / h
+    d = np.zeros_like(y)
+    w1 = 2 * h[:, 1:] + h[:, :-1]
+    w2 = h[:, 1:] + 2 * h[:, :-1]
+    same = np.sign(delta[:, :-1]) * np.sign(delta[:, 1:]) > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d[:, 1:-1] = np.where(same, (w1 + w2) / (w1 / delta[:, :-1] + w2 / delta[:, 1:]), 0)
+    for end, (h0, h1, d0, d1) in ((0, (h[:, 0], h[:, 1], delta[:, 0], delta[:, 1])),
+                                  (-1, (h[:, -1], h[:, -2], delta[:, -1], delta[:, -2]))):
+        s = ((2 * h0 + h1) * d0 - h0 * d1) / (h0 + h1)
+        s = np.where(np.sign(s) != np.sign(d0), 0, s)
+        s = np.where((np.sign(d0) != np.sign(d1)) & (np.abs(s) > np.abs(3 * d0)), 3 * d0, s)
+        d[:, end] = s
+    return d
+
+def pchip_rows(x, y, xq):
+    """ pchip interpolant of every row (x strictly increasing) evaluated at xq (per row), with extrapolation """
+    d = _pchip_slopes(x, y)
+    rows = np.arange(len(x))
+    j = np.clip((x < xq[:, None]).sum(1) - 1, 0, x.shape[1] - 2)
+    h = x[rows, j + 1] - x[rows, j]
+    delta = (y[rows, j + 1] - y[rows, j]) / h
+    d0, d1 = d[rows, j], d[rows, j + 1]
+    t = xq - x[rows, j]
+    c = (3 * delta - 2 * d0 - d1) / h
+    b = (d0 - 2 * delta + d1) / h**2
+    return y[rows, j] + t * (d0 + t * (c + t * b))
+
+def _inverse_pchip(values, level):
+    # position (1-based, within the strip) where the strip crosses level; unique() as in the MATLAB script
+    xu, first = np.unique(values, return_index=True)
+    if len(xu) < 2:
+        return np.nan
+    return float(PchipInterpolator(xu, first + 1.)(level))
+
+def edge_positions(image, threshold, method='batched'):
+    """
+    Subpixel edge position (0-based column) of every row of a vertical-edge image and the
+    columns of the BOUND_EXTRA neighbourhood used for the ESF. Rows whose neighbourhood leaves
+    the image get NaN. method='loop' evaluates the rows one by one with scipy's pchip.
+    """
+    n_rows, W = image.shape
+    rows = np.arange(BOUND_EXTRA - 1, n_rows - BOUND_EXTRA)
+    strips = image[rows]
+    c = np.cumsum(np.pad(strips, ((0, 0), (1, 0))), axis=1)
+    smoothed = (c[:, EDGE_SPAN:] - c[:, :-EDGE_SPAN]) / EDGE_SPAN
+    app = np.argmax(np.abs(np.diff(smoothed, axis=1)), axis=1) + 2   # first maximum, as app_edge(1)
+    valid = (app - BOUND_EXTRA >= 0) & (app + BOUND_EXTRA < W)
+    app = np.clip(app, BOUND_EXTRA, W - BOUND_EXTRA - 1)
+    cols = app[:, None] + np.arange(-BOUND_EXTRA, BOUND_EXTRA + 1)
+    near = np.take_along_axis(strips, cols, axis=1)
+    cropped = near[:, BOUND_EXTRA - BOUND:BOUND_EXTRA + BOUND + 1]
+    if method == 'loop':
+        pos = np.array([_inverse_pchip(s, threshold) for s in cropped])
+    elif method == 'batched':
+        order = np.argsort(cropped, axis=1, kind='stable')
+        xs = np.take_along_axis(cropped, order, axis=1)
+        ties = (np.diff(xs, axis=1) == 0).any(1)
+        pos = np.empty(len(rows))
+        pos[~ties] = pchip_rows(xs[~ties], order[~ties] + 1., np.full((~ties).sum(), threshold))
+        # strips with repeated values (integer images) drop the repeats first, as unique() does
+        pos[ties] = [_inverse_pchip(s, threshold) for s in cropped[ties]]
+    else:
+        raise ValueError("method must be 'batched' or 'loop'")
+    pos = pos + app - BOUND - 1
+    pos[~valid] = np.nan
+    return pos, cols, near
+
+def bin_esf(positions, values, subdivision=PIXEL_SUBDIVISION):
+    """ mean of values in bins of width subdivision over positions (histc edges of the script) """
+    bot = positions.min() - BIN_PAD
+    top = positions.max() + BIN_PAD + subdivision
+    n_bins = int(np.floor((top - bot) / subdivision + 1e-10))
+    idx = np.floor((positions - bot) / subdivision).astype(np.int64)
+    sums = np.bincount(idx, weights=values, minlength=n_bins)[:n_bins]
+    counts = np.bincount(idx, minlength=n_bins)[:n_bins]
+    with np.errstate(invalid='ignore'):
+        mean = sums / counts
+    centers = bot + (np.arange(n_bins) + 0.5) * subdivision
+    # drop the first and last bins, fill empty bins with pchip
+    esf, x = mean[1:-1], centers[1:-1]
+    ok = np.isfinite(esf)
+    if not ok.all():
+        esf = PchipInterpolator(x[ok], esf[ok])(x)
+    return x, esf
+
+def gauss_fit(x, y, h=0.2):
+    """ mygaussfit: parabola through log(y) of the samples above h*max(y) """
+    keep = y > y.max() * h
+    a = np.polyfit(x[keep], np.log(y[keep]), 2)
+    sigma = np.sqrt(-1 / (2 * a[0]))
+    mu = a[1] * sigma**2
+    return sigma, mu, np.exp(a[2] + mu**2 / (2 * sigma**2))
+
+def _frequency_at(mtf, freq, level, stop):
+    # interp1(MTF(1:stop), freq(1:stop), level, 'pchip')
+    xu, first = np.unique(mtf[:stop], return_index=True)
+    return float(PchipInterpolator(xu, freq[:stop][first])(level))
+
+def mtf_from_esf(x_esf, esf, pixel_mm=PIXEL_MM, subdivision=PIXEL_SUBDIVISION, span=SPAN):
+    """ LSF (smoothed, Gaussian fit, raw), one-sided MTFs and resolutions from the binned ESF """
+    smoothed = np.convolve(esf, np.ones(span) / span, mode='valid')
+    lsf = -np.diff(smoothed)
+    lsf[np.isnan(lsf)] = 0
+    lsf /= lsf.sum()
+    lsf_raw = np.diff(esf)[span // 2 - 1:len(esf) - 1 - span // 2]
+    lsf_raw = lsf_raw / lsf_raw.sum()
+    x_fit = np.arange(1, len(lsf) + 1)
+    sigma, mu, A = gauss_fit(x_fit, lsf)
+    lsf_fit = A * np.exp(-(x_fit - mu)**2 / (2 * sigma**2))
+    n = len(lsf)
+    n_half = n // 2 + 1 if n % 2 else n // 2
+    freq = np.arange(n_half) / (n * pixel_mm * subdivision)
+    mtf, mtf_fit, mtf_raw = (np.abs(np.fft.fft(v))[:n_half] for v in (lsf, lsf_fit, lsf_raw))
+    below = np.flatnonzero(mtf < 0.05)
+    stop = below[0] + 1 if len(below) else len(mtf)
+    res = {k: 1 / (2 * _frequency_at(m, freq, MTF_LEVELS[k], stop))
+           for k, m in (('smoothed', mtf), ('fit', mtf_fit), ('raw', mtf_raw))}
+    return dict(lsf=lsf, lsf_fit=lsf_fit, lsf_raw=lsf_raw, freq=freq, mtf=mtf, mtf_fit=mtf_fit, mtf_raw=mtf_raw,
+                **{f'resolution_{k}': v for k, v in res.items()})
+
+def ideal_mtf(n_freq, na=NA, wavelength=WAVELENGTH):
+    """ diffraction-limited MTF on the first quarter of the frequency axis, as plotted by the script """
+    cutoff = 2 * na / wavelength * 1e-3
+    u = np.linspace(0, cutoff, int(round(n_freq / 4)))
+    r = u / cutoff
+    return u, 2 / np.pi * (np.arccos(r) - r * np.sqrt(1 - r**2))
+
+def analyze_edge(image, roi='auto', name='', method='batched', pixel_mm=PIXEL_MM, subdivision=PIXEL_SUBDIVISION):
+    """
+    MTF of one slanted-edge image (path or array).
+    roi: (y0, y1, x0, x1), 'auto' (edge_roi) or None (whole image)
+    """
+    if isinstance(image, str):
+        import tifffile
+        name = name or os.path.basename(image)
+        image = tifffile.imread(image)
+    image = to_gray(image)
+    if roi == 'auto':
+        roi = edge_roi(image)
+    roi = tuple(int(v) for v in roi) if roi is not None else (0, image.shape[0], 0, image.shape[1])
+    img = image[roi[0]:roi[1], roi[2]:roi[3]]
+    threshold = edge_threshold(img)
+    vertical = is_vertical(img)
+    if not vertical:
+        img = img.T
+    pos, cols, near = edge_positions(img, threshold, method)
+    ok = np.isfinite(pos)
+    y = np.flatnonzero(ok) + 1.
+    slope = np.polyfit(pos[ok], y, 1)[0]
+    angle = np.degrees(np.arctan(abs(slope))) if vertical else np.degrees(np.arctan(1 / abs(slope)))
+    x_esf, esf = bin_esf((cols[ok] - pos[ok, None]).ravel(), near[ok].ravel(), subdivision)
+    m = mtf_from_esf(x_esf, esf, pixel_mm, subdivision)
+    freq_ideal, mtf_ideal = ideal_mtf(len(m['freq']))
+    return MTFResult(name, 'vertical' if vertical else 'horizontal', float(angle), roi, pos, x_esf, esf,
+                     mtf_ideal=mtf_ideal, freq_ideal=freq_ideal, **m)
+
+def save_results(result, path):
+    """ <image>_MTFresults.mat with the variables of the MATLAB script (plus freq and the angle) """
+    savemat(path, dict(ESF=result.esf, LSF=result.lsf, MTF=result.mtf, freq=result.freq,
+                       Resolution_smoothed=result.resolution_smoothed, Resolution_fit=result.resolution_fit,
+                       Resolution_raw=result.resolution_raw, Angle_degrees=result.angle_deg))
+    return path
+
+def _analyze_file(path, roi, save_mat):
+    result = analyze_edge(path, roi)
+    if save_mat:
+        save_results(result, path + '_MTFresults.mat')
+    return result
+
+def analyze_folder(folder, pattern='*.tif', roi='auto', workers=None, save_mat=True):
+    """ MTF of every edge image of a folder in a process pool; results in file order """
+    paths = sorted(glob.glob(os.path.join(folder, pattern)))
+    if workers == 1 or len(paths) < 2:
+        return [_analyze_file(p, roi, save_mat) for p in paths]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_analyze_file, paths, [roi] * len(paths), [save_mat] * len(paths)))
+
+if __name__ == '__main__':
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    parser = argparse.ArgumentParser(description='Slanted-edge MTF of every image of a folder.')
+    parser.add_argument('folder')
+    parser.add_argument('--pattern', default='*.tif')
+    parser.add_argument('--roi', type=int, nargs=4, metavar=('Y0', 'Y1', 'X0', 'X1'),
+                        help='same region for every image (default: found around the strongest edge)')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--no-mat', action='store_true', help='do not write <image>_MTFresults.mat')
+    parser.add_argument('--store', help='append the results to this results store (results_utils.py)')
+    parser.add_argument('--session', default='default')
+    args = parser.parse_args()
+
+    results = analyze_folder(args.folder, args.pattern, args.roi or 'auto', args.workers, not args.no_mat)
+    for r in results:
+        print(f'{r.image}: {r.orientation}, {r.angle_deg:.2f} deg, resolution smoothed/fit/raw = '
+              f'{1e3 * r.resolution_smoothed:.3f} / {1e3 * r.resolution_fit:.3f} / {1e3 * r.resolution_raw:.3f} um')
+    if args.store and results:
+        from results_utils import append
+        print('mtf ->', append(args.store, 'mtf', [dict(r.record(), source=os.path.abspath(args.folder))
+                                                 for r in results], args.session))
@@ -0,0 +1,195 @@
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+from scipy.interpolate import interp1d, make_smoothing_spline
+from scipy.ndimage import map_coordinates
+
+# Python port of single.m / multiple.m / interpolation_capillary.m.
+# Lines are given as (x, y) end points in 0-based pixel coordinates of the image they are
+# sampled from (MATLAB coordinates are one larger). All lines of all capillaries are sampled
+# in one bilinear gather; the background fits are linear in the profile values, so they are
+# built once as matrices and applied to every profile with a matrix product.
+
+PIX_UM = 1.74                # um per pixel (multiple.m)
+BG_RANGE_UM = (10, 35)       # background where dist <= 10 um or dist >= 35 um
+SMOOTHING = 0.9              # csaps smoothing parameter p
+
+COLUMNS = ['Image', 'Capillary', 'Sample', 'Dist_px', 'Dist_um', 'MeanIntensity', 'StdIntensity',
+           'BG_Poly', 'BG_Spline', 'BG_LinearInterp', 'Corr_Poly', 'Corr_Spline', 'Corr_LinearInterp', 'Lines']
+
+def n_samples(x_pair, y_pair):
+    """ samples ~ length in px, as in the MATLAB scripts """
+    return int(round(np.hypot(np.diff(x_pair)[0], np.diff(y_pair)[0]))) + 1
+
+def parallel_lines(x_pair, y_pair, offsets):
+    """
+    Copies of the line (x_pair, y_pair) shifted by offsets along its normal (-dy, dx)/len;
+    for a left-to-right horizontal line the offsets are added to y (multiple.m's ys).
+    Returns (n_lines, 2, 2) end points [[x0, y0], [x1, y1]].
+    """
+    p = np.stack([x_pair, y_pair], 1).astype(np.float64)
+    d = p[1] - p[0]
+    normal = np.array([-d[1], d[0]]) / np.hypot(*d)
+    return p[None] + np.asarray(offsets, np.float64)[:, None, None] * normal
+
+def sample_lines(img, lines, n=None):
+    """
+    Bilinear profiles along every line (improfile(..., n, 'bilinear') for all lines at once).
+    lines: (..., 2, 2) end points; n: samples per line (default from the first line).
+    Returns profiles (..., n) and the sample coordinates xs, ys (..., n); NaN outside img.
+    """
+    lines = np.asarray(lines, np.float64)
+    if n is None:
+        first = lines.reshape(-1, 2, 2)[0]
+        n = n_samples(first[:, 0], first[:, 1])
+    t = np.linspace(0, 1, n)
+    xs = lines[..., 0, 0, None] + t * (lines[..., 1, 0, None] - lines[..., 0, 0, None])
+    ys = lines[..., 0, 1, None] + t * (lines[..., 1, 1, None] - lines[..., 0, 1, None])
+    profiles = map_coordinates(np.asarray(img, np.float64), [ys, xs], order=1, mode='constant', cval=np.nan)
+    return profiles, xs, ys
+
+def line_stats(profiles):
+    """ single.m's N, mean, min, max, std and mode of every profile (last axis) """
+    return dict(N=profiles.shape[-1], mean=profiles.mean(-1), min=profiles.min(-1), max=profiles.max(-1),
+                std=profiles.std(-1, ddof=1), mode=stats.mode(profiles, axis=-1).mode)
+
+def background_operators(x, bg_range=BG_RANGE_UM, smoothing=SMOOTHING):
+    """
+    Matrices (len(x), n_bg) mapping the background samples of a profile to the three
+    background estimates of interpolation_capillary.m over all of x:
+    polyfit/polyval deg 2, csaps(xb, yb, p) and interp1 'linear' 'extrap'.
+    """
+    bg_mask = (x <= bg_range[0]) | (x >= bg_range[1])
+    xb = x[bg_mask]
+    eye = np.eye(len(xb))
+    poly = np.vander(x, 3) @ np.linalg.pinv(np.vander(xb, 3))
+    # csaps minimizes p*sum((y - f)^2) + (1 - p)*int(f''^2), i.e. lam = (1 - p)/p
+    lam = (1 - smoothing) / smoothing
+    spline = np.stack([make_smoothing_spline(xb, e, lam=lam)(x) for e in eye], axis=1)
+    linear = interp1d(xb, eye, axis=0, fill_value='extrapolate')(x)
+    return bg_mask, dict(BG_Poly=poly, BG_Spline=spline, BG_LinearInterp=linear)
+
+def correct_profiles(mean_profiles, dist_um, bg_range=BG_RANGE_UM, smoothing=SMOOTHING):
+    """ backgrounds and corrected profiles for a batch of mean profiles (..., n) sharing dist_um """
+    bg_mask, ops = background_operators(dist_um, bg_range, smoothing)
+    yb = mean_profiles[..., bg_mask]
+    out = {}
+    for name, op in ops.items():
+        out[name] = yb @ op.T
+        out['Corr_' + name[3:]] = mean_profiles - out[name]
+    return out
+
+def profile_table(profiles, dist_px, pix_um=PIX_UM, image=None, capillaries=None,
+                  bg_range=BG_RANGE_UM, smoothing=SMOOTHING):
+    """
+    profiles: (n_capillaries, n_lines, n) -> one long table with a row per capillary and
+    sample: mean/std over the lines (omitnan), the three backgrounds and corrected
+    profiles, and the individual line intensities as a list column.
+    """
+    n_caps, n_lines, n = profiles.shape
+    dist_um = dist_px * pix_um
+    mean = np.nanmean(profiles, axis=1)
+    std = np.nanstd(profiles, axis=1, ddof=1)
+    corr = correct_profiles(mean, dist_um, bg_range, smoothing)
+    caps = np.arange(n_caps) if capillaries is None else np.asarray(capillaries)
+    table = dict(Image=np.full(n_caps * n, image, dtype=object), Capillary=np.repeat(caps, n),
+                 Sample=np.tile(np.arange(1, n + 1), n_caps), Dist_px=np.tile(dist_px, n_caps),
+                 Dist_um=np.tile(dist_um, n_caps), MeanIntensity=mean.ravel(), StdIntensity=std.ravel())
+    table.update({k: v.ravel() for k, v in corr.items()})
+    table['Lines'] = list(profiles.transpose(0, 2, 1).reshape(n_caps * n, n_lines))
+    return pd.DataFrame(table)[COLUMNS]
+
+def lines_from_centerline(centerline, half_length, num_lines=20, at=0.5):
+    """
+    num_lines consecutive lines normal to an ordered (row, col) centerline, centred on the
+    centerline points around fraction `at` of its length, each 2*half_length px long.
+    Returns (num_lines, 2, 2) (x, y) end points running left to right across the vessel.
+    """
+    cl = np.asarray(centerline, np.float64)
+    i0 = int(np.clip(round(at * (len(cl) - 1)) - num_lines // 2, 1, max(len(cl) - num_lines - 1, 1)))
+    idx = np.arange(i0, i0 + num_lines).clip(1, len(cl) - 2)
+    d = cl[idx + 1] - cl[idx - 1]
+    normal = np.stack([d[:, 0], -d[:, 1]], 1) / np.hypot(d[:, 0], d[:, 1])[:, None]  # (x, y)
+    normal *= np.where(normal[:, :1] < 0, -1, 1)
+    center = cl[idx][:, ::-1]
+    return np.stack([center - half_length * normal, center + half_length * normal], 1)
+
+def profile_capillaries(img, centerlines, half_length=13, num_lines=20, pix_um=PIX_UM, image=None,
+                        capillaries=None, **kwargs):
+    """ profile table of several capillaries of one frame, sampled in one gather """
+    lines = np.stack([lines_from_centerline(cl, half_length, num_lines) for cl in centerlines])
+    n = int(round(2 * half_length)) + 1
+    profiles, _, _ = sample_lines(img, lines, n)
+    return profile_table(profiles, np.linspace(0, 2 * half_length, n), pix_um, image, capillaries, **kwargs)
+
+def centerlines_from_index(index, mask):
+    """
+    centerline (longest skeleton path of the largest mask component) of every indexed capillary;
+    needs segmentation/ on sys.path for skeleton_utils
+    """
+    from skeleton_utils import longest_path
+    from skimage.measure import label
+    from skimage.morphology import skeletonize
+    centerlines = []
+    for cap in index['capillaries']:
+        y0, x0 = cap['y_min'], cap['x_min']
+        crop = np.asarray(mask[y0:cap['y_max'], x0:cap['x_max']]) > 0
+        lab = label(crop)
+        crop = lab == np.argmax(np.bincount(lab.ravel())[1:]) + 1
+        centerlines.append(longest_path(skeletonize(crop)) + [y0, x0])
+    return centerlines
+
+def write_results(table, path):
+    """ one Parquet file per run (all capillaries, all samples) """
+    table.to_parquet(path, index=False)
+    return path
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'segmentation'))
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    parser = argparse.ArgumentParser(description='Multi-line intensity profiles with background correction.')
+    parser.add_argument('image', help='green-channel TIFF')
+    parser.add_argument('--out', default='intensity_profiles.parquet')
+    parser.add_argument('--pix-um', type=float, default=PIX_UM)
+    parser.add_argument('--num-lines', type=int, default=20)
+    # multiple.m: horizontal lines x_pair at num_lines rows between y_min and y_max of a crop
+    parser.add_argument('--crop', type=int, nargs=4, metavar=('Y0', 'Y1', 'X0', 'X1'))
+    parser.add_argument('--x', type=float, nargs=2, metavar=('X0', 'X1'))
+    parser.add_argument('--y-range', type=float, nargs=2, metavar=('Y_MIN', 'Y_MAX'))
+    # every capillary of a frame: detection index (segmentation/detection_utils.py) and its mask
+    parser.add_argument('--index', help='capillary_index.json with a stitched mask')
+    parser.add_argument('--half-length', type=float, default=13)
+    parser.add_argument('--store', help='append to this results store (results_utils.py) instead of --out')
+    parser.add_argument('--session', default='default')
+    args = parser.parse_args()
+
+    import json
+    import tifffile
+    if not args.index and (args.y_range is None or args.x is None):
+        parser.error('--x and --y-range are required without --index')
+    img = tifffile.imread(args.image)
+    if args.index:
+        with open(args.index) as f:
+            index = json.load(f)
+        centerlines = centerlines_from_index(index, tifffile.memmap(index['mask'], mode='r'))
+        table = profile_capillaries(img, centerlines, args.half_length, args.num_lines, args.pix_um,
+                                    image=args.image, capillaries=[c['id'] for c in index['capillaries']])
+    else:
+        if args.crop:
+            y0, y1, x0, x1 = args.crop
+            img = img[y0:y1, x0:x1]
+        y_mid = np.mean(args.y_range)
+        lines = parallel_lines(args.x, [y_mid, y_mid], np.linspace(*args.y_range, args.num_lines) - y_mid)
+        profiles, xs, ys = sample_lines(img, lines)
+        table = profile_table(profiles[None], np.hypot(xs[0] - xs[0, 0], ys[0] - ys[0, 0]), args.pix_um,
+                              image=args.image)
+    if args.store:
+        from results_utils import append
+        out = append(args.store, 'profiles', table, args.session)
+    else:
+        out = write_results(table, args.out)
+    print(f"{table['Capillary'].nunique()} capillaries, {len(table)} rows -> {out}")
@@ -1,12 +1,14 @@
-
-
-
+import argparse
 import os
+import sys
 import rawpy
 import subprocess
 from skimage import io
 import traceback
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'image_conversion'))
+from batch_convert import MANIFEST_NAME, convert_batch, find_dngs
+
 def extract_preview_with_exiftool(image_path):
     try:
         output_path = image_path[:-4] + ".jpg"
@@ -21,24 +23,49 @@ def extract_preview_with_exiftool(image_path):
             with open(output_path, 'wb') as f:
                 f.write(result.stdout)
             print("Extracted preview with exiftool:", output_path)
+            return output_path
         else:
             print("exiftool could not extract preview from:", image_path)
     except Exception as e:
         print("Fallback via exiftool failed for", image_path)
         traceback.print_exc()
+    return None
+
+
+def convert_image(image):
+    """rawpy postprocess to TIFF, falling back to the embedded preview; returns the output path or None."""
+    try:
+        with rawpy.imread(image) as raw:
+            rgb = raw.postprocess()
+            tif_path = image[:-4] + '.tif'
+            io.imsave(tif_path, rgb)
+            print("rawpy success:", tif_path)
+            return tif_path
+    except rawpy.LibRawFileUnsupportedError:
+        print("rawpy failed (unsupported format). Trying exiftool preview extraction...")
+        return extract_preview_with_exiftool(image)
+    except Exception:
+        print(f"Unexpected error processing {image} with rawpy:")
+        traceback.print_exc()
+    return None
 
 
 def main():
-    root_dir = input("Enter 'images*' folders names: ").strip()
+    p = argparse.ArgumentParser(description="Convert DNGs under 'images*' folders to TIFF.")
+    p.add_argument("root_dir", nargs="?", help="Root folder (prompted if omitted).")
+    p.add_argument("--batch", action="store_true",
+                   help="Convert in a process pool and skip files already in the manifest.")
+    p.add_argument("--workers", type=int, default=None, help="Worker processes for --batch (default: all cores).")
+    p.add_argument("--mem-limit-gb", type=float, default=None,
+                   help="Cap the images decoded at once so they fit this memory budget.")
+    args = p.parse_args()
+
+    root_dir = args.root_dir or input("Enter 'images*' folders names: ").strip()
     if not os.path.isdir(root_dir):
         print(f"Error: '{root_dir}' is not a valid directory.")
         return
 
-    images = []
-    for root, dirs, files in os.walk(root_dir):
-        for fname in files:
-            if fname.lower().endswith('.dng'):
-                images.append(os.path.join(root, fname))
+    images = find_dngs(root_dir)
 
     if not images:
         print("No DNG files found in:", root_dir)
@@ -46,22 +73,22 @@ def main():
 
     print(f"\nFound {len(images)} DNG file(s). Starting conversion...\n")
 
-    for image in images:
+    if args.batch:
+        # 8-bit RGB output plus the raw buffer, estimated from the first file
         try:
-            with rawpy.imread(image) as raw:
-                rgb = raw.postprocess()
-                tif_path = image[:-4] + '.tif'
-                io.imsave(tif_path, rgb)
-                print("rawpy success:", tif_path)
-        except rawpy.LibRawFileUnsupportedError:
-            print("rawpy failed (unsupported format). Trying exiftool preview extraction...")
-            extract_preview_with_exiftool(image)
+            with rawpy.imread(images[0]) as raw:
+                s = raw.sizes
+            bytes_per_image = s.raw_width * s.raw_height * 2 + s.width * s.height * 3
         except Exception:
-            print(f"Unexpected error processing {image} with rawpy:")
-            traceback.print_exc()
+            bytes_per_image = None
+        convert_batch(images, convert_image, workers=args.workers, mem_limit_gb=args.mem_limit_gb,
+                      bytes_per_image=bytes_per_image, manifest_path=os.path.join(root_dir, MANIFEST_NAME))
+        return
+
+    for image in images:
+        convert_image(image)
 
     print(f"\n Conversion complete. Processed {len(images)} file(s).")
 
 if __name__ == "__main__":
     main()
-
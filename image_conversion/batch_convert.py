@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+MANIFEST_NAME = '.convert_manifest.json'
+
+
+def find_dngs(root_dir):
+    images = []
+    for root, dirs, files in os.walk(root_dir):
+        for fname in files:
+            if fname.lower().endswith('.dng'):
+                images.append(os.path.join(root, fname))
+    return sorted(images)
+
+
+def params_key(params):
+    """Stable short hash of the conversion parameters (enums are hashed by their str())."""
+    blob = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha1(blob.encode()).hexdigest()[:16]
+
+
+def source_key(path, params):
+    st = os.stat(path)
+    return {'size': st.st_size, 'mtime': st.st_mtime, 'params': params_key(params)}
+
+
+def load_manifest(manifest_path):
+    if manifest_path and os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            return json.load(f)
+    return {}
+
+
+def save_manifest(manifest, manifest_path):
+    tmp = manifest_path + '.part'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, manifest_path)
+
+
+def is_done(manifest, path, params):
+    entry = manifest.get(os.path.abspath(path))
+    if entry is None or entry.get('output') is None or not os.path.exists(entry['output']):
+        return False
+    return all(entry.get(k) == v for k, v in source_key(path, params).items())
+
+
+def _timed_convert(convert, image, params):
+    t0 = time.perf_counter()
+    out = convert(image, **params)
+    return out, time.perf_counter() - t0
+
+
+def convert_batch(images, convert, params=None, workers=None, mem_limit_gb=None, bytes_per_image=None,
+                  manifest_path=None):
+    """
+    Convert images with convert(image, **params) -> output path (None on failure) in a process pool.
+
+    - convert must be a module-level function so it can be sent to the workers.
+    - Every worker holds one decoded image at a time; with mem_limit_gb and an estimate of
+      bytes_per_image the number of images in flight is capped to fit the budget, and
+      new files are only submitted as others finish.
+    - The manifest records source size, mtime and a hash of params for every converted file;
+      files whose entry still matches (and whose output exists) are skipped on re-runs.
+    Returns a list of per-file records.
+    """
+    params = dict(params or {})
+    max_in_flight = workers or os.cpu_count() or 1
+    if mem_limit_gb and bytes_per_image:
+        max_in_flight = min(max_in_flight, int(mem_limit_gb * 1e9 // bytes_per_image))
+    max_in_flight = max(1, max_in_flight)
+    manifest = load_manifest(manifest_path)
+
+    todo = [im for im in images if not is_done(manifest, im, params)]
+    skipped = len(images) - len(todo)
+    if skipped:
+        print(f"Skipping {skipped} file(s) already converted with the same parameters.")
+    print(f"Converting {len(todo)} file(s) with {max_in_flight} worker(s)...")
+
+    records = []
+    t_start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=max_in_flight) as pool:
+        pending = {}
+        queue = iter(todo)
+        while True:
+            # keep the pool fed, but never more than max_in_flight images at once
+            while len(pending) < max_in_flight:
+                image = next(queue, None)
+                if image is None:
+                    break
+                pending[pool.submit(_timed_convert, convert, image, params)] = image
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                image = pending.pop(fut)
+                try:
+                    out, seconds = fut.result()
+                except Exception as e:
+                    print(f"Worker failed on {image}: {e}")
+                    out, seconds = None, float('nan')
+                rec = {'source': image, 'output': out, 'seconds': seconds,
+                       'mbytes': os.path.getsize(image) / 1e6}
+                records.append(rec)
+                if out is not None:
+                    print(f"converted {os.path.basename(image)} -> {os.path.basename(out)} ({seconds:.2f} s)")
+                    if manifest_path:
+                        manifest[os.path.abspath(image)] = dict(source_key(image, params), output=out, seconds=seconds)
+                        save_manifest(manifest, manifest_path)
+                else:
+                    print(f"Failed to convert {image}")
+    report(records, time.perf_counter() - t_start, skipped)
+    return records
+
+
+def report(records, wall_s, skipped=0):
+    ok = [r for r in records if r['output'] is not None]
+    print(f"\n{'file':<40} {'MB':>8} {'seconds':>8}")
+    for r in sorted(records, key=lambda r: r['source']):
+        status = '' if r['output'] is not None else '  FAILED'
+        print(f"{os.path.basename(r['source']):<40} {r['mbytes']:>8.1f} {r['seconds']:>8.2f}{status}")
+    mbytes = sum(r['mbytes'] for r in ok)
+    print(f"\nConverted {len(ok)}, failed {len(records) - len(ok)}, skipped {skipped} "
+          f"in {wall_s:.1f} s")
+    if ok and wall_s > 0:
+        cpu_s = sum(r['seconds'] for r in ok)
+        print(f"Throughput: {len(ok) / wall_s:.2f} files/s, {mbytes / wall_s:.1f} MB/s "
+              f"(mean {cpu_s / len(ok):.2f} s/file per worker)")
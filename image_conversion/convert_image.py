@@ -1,43 +1,189 @@
+import argparse
+import io
 import os
 import shutil
 import subprocess
+import sys
 import traceback
 
+import numpy as np
 import rawpy
 from tifffile import imwrite, imread
 
+from batch_convert import MANIFEST_NAME, convert_batch
+from tiff_utils import write_tiff
 
-def convert_with_rawpy(image):
+if __name__ == '__main__':
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from instrument_utils import stage
+
+POSTPROCESS_PARAMS = dict(
+    gamma=(1, 1),
+    use_camera_wb=True,
+    output_color=rawpy.ColorSpace.raw, 
+    no_auto_scale=True, 
+    highlight_mode=rawpy.HighlightMode.Ignore, 
+    no_auto_bright=True, 
+    output_bps=16
+)
+
+
+def open_raw(image, data=None):
+    """rawpy handle of the DNG at image, or of its bytes when data is given (decoded from memory)."""
+    return rawpy.imread(io.BytesIO(data) if data is not None else image)
+
+
+@stage
+def convert_with_rawpy(image, tile=None, compression=None, levels=0, ome=False, data=None, **postprocess_params):
+    """
+    Linear 16-bit TIFF next to the DNG; returns its path, or None on failure.
+    tile/compression/levels/ome select a tiled, compressed, pyramidal or OME-TIFF
+    layout (see tiff_utils.write_tiff); the defaults keep the plain whole-image TIFF.
+    data: the DNG's bytes, decoded instead of reading image from disk.
+    """
+    params = dict(POSTPROCESS_PARAMS, **postprocess_params)
+    try:
+        with open_raw(image, data) as raw:
+            rgb16 = raw.postprocess(**params)
+        out_tif = os.path.splitext(image)[0] + ('.ome.tif' if ome else '.tif')
+        if tile or compression or levels or ome:
+            write_tiff(out_tif, rgb16, tile=tile, compression=compression, levels=levels, ome=ome)
+        else:
+            imwrite(out_tif, rgb16)
+        return out_tif
+    except Exception as e:
+        print(f"rawpy failed: {e}")
+        return None
+
+
+def green_plane(raw, mode='half', block_rows=1024):
+    """
+    Linear green plane read straight from the Bayer buffer, without demosaicing.
+    Black level is subtracted per CFA channel and values are clipped at the white level.
+    mode='half': (H/2, W/2), mean of the two green sites of every 2x2 cell
+    mode='full': (H, W), green kept at green sites and the mean of the 4 green
+                 neighbours at red/blue sites
+    Rows are processed in blocks so the float working copy stays small.
+    """
+    bayer = raw.raw_image_visible
+    pattern = raw.raw_pattern
+    if pattern is None or bayer.ndim != 2 or np.shape(pattern) != (2, 2):
+        raise ValueError("not a 2x2 Bayer raw")
+    pattern = np.asarray(pattern)
+    black = np.asarray(raw.black_level_per_channel, dtype=np.float32)[pattern]
+    is_green = np.isin(pattern, (1, 3))
+    if is_green.sum() != 2:
+        raise ValueError("Bayer pattern without two green sites")
+    white = float(raw.white_level) - black[is_green].mean()
+    H, W = bayer.shape
+
+    if mode == 'half':
+        (gy1, gx1), (gy2, gx2) = np.argwhere(is_green)
+        H2, W2 = H // 2, W // 2
+        out = np.empty((H2, W2), dtype=np.uint16)
+        for r0 in range(0, H2, block_rows):
+            r1 = min(r0 + block_rows, H2)
+            g1 = bayer[2*r0 + gy1:2*r1:2, gx1:2*W2:2].astype(np.float32) - black[gy1, gx1]
+            g2 = bayer[2*r0 + gy2:2*r1:2, gx2:2*W2:2].astype(np.float32) - black[gy2, gx2]
+            out[r0:r1] = np.round(np.clip((g1 + g2) / 2, 0, white))
+        return out
+    elif mode != 'full':
+        raise ValueError("mode must be 'half' or 'full'")
+
+    out = np.empty((H, W), dtype=np.uint16)
+    cx = (np.arange(W) % 2)[None, :]
+    for r0 in range(0, H, block_rows):
+        r1 = min(r0 + block_rows, H)
+        # one halo row on each side; reflect at the image border keeps the CFA phase
+        a0, a1 = max(r0 - 1, 0), min(r1 + 1, H)
+        block = bayer[a0:a1].astype(np.float32)
+        block -= black[(np.arange(a0, a1) % 2)[:, None], cx]
+        block = np.pad(block, ((int(r0 == 0), int(r1 == H)), (1, 1)), mode='reflect')
+        c = block[1:-1, 1:-1]
+        interp = (block[:-2, 1:-1] + block[2:, 1:-1] + block[1:-1, :-2] + block[1:-1, 2:]) / 4
+        green_mask = is_green[(np.arange(r0, r1) % 2)[:, None], cx]
+        out[r0:r1] = np.round(np.clip(np.where(green_mask, c, interp), 0, white))
+    return out
+
+
+@stage
+def convert_green(image, mode='half', tile=None, compression=None, levels=0, ome=False, data=None):
+    """
+    Linear green-only TIFF (C2-<name>.tif, the channel the analysis uses) next to the DNG,
+    without building the RGB image; returns its path, or None on failure.
+    Non-Bayer DNGs fall back to the green channel of the linear postprocess.
+    data: the DNG's bytes, decoded instead of reading image from disk.
+    """
     try:
-        with rawpy.imread(image) as raw:
-            rgb16 = raw.postprocess(
-                gamma=(1, 1),
-                use_camera_wb=True,
-                output_color=rawpy.ColorSpace.raw, 
-                no_auto_scale=True, 
-                highlight_mode=rawpy.HighlightMode.Ignore, 
-                no_auto_bright=True, 
-                output_bps=16
-            )
-        out_tif = os.path.splitext(image)[0] + '.tif'
-        imwrite(out_tif, rgb16)
-        return True
+        with open_raw(image, data) as raw:
+            try:
+                green = green_plane(raw, mode=mode)
+            except ValueError as e:
+                print(f"{image}: {e}, using the green channel of postprocess")
+                green = raw.postprocess(**POSTPROCESS_PARAMS)[..., 1]
+        folder, fname = os.path.split(image)
+        out_tif = os.path.join(folder, 'C2-' + os.path.splitext(fname)[0] + ('.ome.tif' if ome else '.tif'))
+        if tile or compression or levels or ome:
+            write_tiff(out_tif, green, tile=tile, compression=compression, levels=levels, ome=ome)
+        else:
+            imwrite(out_tif, green)
+        return out_tif
     except Exception as e:
         print(f"rawpy failed: {e}")
-        return False
+        return None
+
+
+def decoded_bytes(image, data=None):
+    """Rough peak memory of converting one DNG: raw Bayer buffer + 16-bit RGB output."""
+    try:
+        with open_raw(image, data) as raw:
+            s = raw.sizes
+    except Exception:
+        return None
+    return s.raw_width * s.raw_height * 2 + s.width * s.height * 6
 
 
 def main():
-    folder = input("Enter the folder containing .dng files: ").strip()
+    p = argparse.ArgumentParser(description="Convert .dng files to linear 16-bit TIFF.")
+    p.add_argument("folder", nargs="?", help="Folder containing .dng files (prompted if omitted).")
+    p.add_argument("--batch", action="store_true",
+                   help="Convert in a process pool and skip files already in the manifest.")
+    p.add_argument("--workers", type=int, default=None, help="Worker processes for --batch (default: all cores).")
+    p.add_argument("--mem-limit-gb", type=float, default=None,
+                   help="Cap the images decoded at once so they fit this memory budget.")
+    p.add_argument("--tile", type=int, default=None, help="Write tiled TIFFs with this tile size (e.g. 512).")
+    p.add_argument("--compression", default=None, help="TIFF compression, e.g. zlib or zstd.")
+    p.add_argument("--pyramid", type=int, default=0, help="Number of 2x downsampled pyramid levels.")
+    p.add_argument("--ome", action="store_true", help="Write OME-TIFF (.ome.tif).")
+    p.add_argument("--green", choices=("half", "full"), default=None,
+                   help="Write only the linear green plane straight from the Bayer data "
+                        "(half: average of G1/G2, full: green interpolated at R/B sites).")
+    args = p.parse_args()
+    write_opts = dict(tile=args.tile, compression=args.compression, levels=args.pyramid, ome=args.ome)
+
+    folder = args.folder or input("Enter the folder containing .dng files: ").strip()
     if not os.path.isdir(folder):
         print("Error: Not a valid directory.")
         return
 
-    for fname in os.listdir(folder):
-        if not fname.lower().endswith('.dng'):
-            continue
-        path = os.path.join(folder, fname)
-        if convert_with_rawpy(path):
+    paths = [os.path.join(folder, fname) for fname in sorted(os.listdir(folder))
+             if fname.lower().endswith('.dng')]
+
+    if args.green:
+        convert, params = convert_green, dict(write_opts, mode=args.green)
+    else:
+        convert, params = convert_with_rawpy, dict(POSTPROCESS_PARAMS, **write_opts)
+
+    if args.batch:
+        if paths:
+            convert_batch(paths, convert, params=params,
+                          workers=args.workers, mem_limit_gb=args.mem_limit_gb,
+                          bytes_per_image=decoded_bytes(paths[0]),
+                          manifest_path=os.path.join(folder, MANIFEST_NAME))
+        return
+
+    for path in paths:
+        if convert(path, **params):
             continue
 
         print(f"Failed to convert {path} with all methods.")
@@ -0,0 +1,98 @@
+import json
+
+import numpy as np
+import tifffile
+
+
+def downsample2(image):
+    """2x2 block mean (odd edge row/column dropped), keeping the input dtype."""
+    h, w = image.shape[0] // 2 * 2, image.shape[1] // 2 * 2
+    img = image[:h, :w]
+    out = (img[0::2, 0::2].astype(np.float32) + img[1::2, 0::2] + img[0::2, 1::2] + img[1::2, 1::2]) / 4
+    if np.issubdtype(image.dtype, np.integer):
+        out = np.round(out)
+    return out.astype(image.dtype)
+
+
+def write_tiff(path, image, tile=None, compression=None, levels=0, ome=False):
+    """
+    Write image (H,W) or (H,W,C) as a TIFF.
+    tile: tile edge in pixels (multiple of 16) or None for the plain strip layout
+    compression: None, 'zlib', 'zstd', 'lzw', ... (anything tifffile accepts)
+    levels: number of 2x-downsampled pyramid levels stored as SubIFDs
+    ome: write OME-TIFF metadata
+    """
+    if levels and not tile:
+        tile = 512
+    opts = dict(
+        tile=(tile, tile) if tile else None,
+        compression=compression,
+        photometric='rgb' if image.ndim == 3 and image.shape[-1] in (3, 4) else 'minisblack',
+    )
+    with tifffile.TiffWriter(path, bigtiff=image.nbytes > 2**31 or levels > 0, ome=ome) as tif:
+        tif.write(image, subifds=levels or None, **opts)
+        level = image
+        for _ in range(levels):
+            level = downsample2(level)
+            tif.write(level, subfiletype=1, **opts)
+
+
+def _level_page(tf, level):
+    series = tf.series[0]
+    if level >= len(series.levels):
+        raise ValueError(f"level {level} not in file ({len(series.levels)} level(s))")
+    return series.levels[level].keyframe
+
+
+def read_roi(path, y0, y1, x0, x1, level=0):
+    """
+    Read image[y0:y1, x0:x1] without loading the whole frame. Coordinates are in full
+    resolution pixels and are divided by 2**level for pyramid levels.
+    - tiled or compressed files: only the tiles/strips intersecting the ROI are decoded
+    - uncompressed contiguous files: the ROI is sliced from a memory map
+    """
+    y0, y1, x0, x1 = (int(v) >> level for v in (y0, y1, x0, x1))
+    with tifffile.TiffFile(path) as tf:
+        page = _level_page(tf, level)
+        planar = page.planarconfig != 1
+        # separate-plane pages are (C, H, W); imagelength / imagewidth hold for both layouts
+        H, W = page.imagelength, page.imagewidth
+        y0, y1, x0, x1 = max(y0, 0), min(y1, H), max(x0, 0), min(x1, W)
+        if level == 0 and not page.is_tiled and page.compression == 1 and page.is_contiguous:
+            mm = tifffile.memmap(path, mode='r')
+            return np.array(mm[..., y0:y1, x0:x1] if planar else mm[y0:y1, x0:x1])
+        if planar:
+            return page.asarray()[..., y0:y1, x0:x1]
+        if page.is_tiled:
+            th, tw = page.tilelength, page.tilewidth
+        else:
+            th, tw = page.rowsperstrip, W
+        n_tx = -(-W // tw)
+        rows = range(y0 // th, (y1 - 1) // th + 1)
+        cols = range(x0 // tw, (x1 - 1) // tw + 1)
+        indices = [ty * n_tx + tx for ty in rows for tx in cols]
+        out = np.zeros((y1 - y0, x1 - x0) + page.shape[2:], dtype=page.dtype)
+        fh = tf.filehandle
+        offsets = [page.dataoffsets[i] for i in indices]
+        bytecounts = [page.databytecounts[i] for i in indices]
+        for data, index in fh.read_segments(offsets, bytecounts, indices):
+            segment, (_, _, sy, sx, _), _ = page.decode(data, index, jpegtables=page.jpegtables)
+            segment = segment[0].reshape(segment.shape[1:3] + page.shape[2:])
+            # intersect the segment with the ROI
+            ya, yb = max(sy, y0), min(sy + segment.shape[0], y1)
+            xa, xb = max(sx, x0), min(sx + segment.shape[1], x1)
+            if ya < yb and xa < xb:
+                out[ya - y0:yb - y0, xa - x0:xb - x0] = segment[ya - sy:yb - sy, xa - sx:xb - sx]
+        return out
+
+
+def read_crop(path, coords_path, level=0, capillary=0):
+    """
+    Read the box (y_min, y_max, x_min, x_max) of capillary id `capillary` from a capillary
+    index written by segmentation/detection_utils.py, or from a crop_coords.json style file.
+    """
+    with open(coords_path) as f:
+        c = json.load(f)
+    if 'capillaries' in c:
+        c = next(cap for cap in c['capillaries'] if cap['id'] == capillary)
+    return read_roi(path, c['y_min'], c['y_max'], c['x_min'], c['x_max'], level=level)
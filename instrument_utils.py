@@ -0,0 +1,217 @@
+import argparse
+import atexit
+import functools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import uuid
+
+import numpy as np
+
+# Stage instrumentation for production runs, without attaching a profiler. Functions decorated
+# with @stage (or blocks in `with stage('name'):`) record wall and CPU time, resident memory
+# (current and the process high-water mark) and the bytes of the arrays going in and out.
+# Recording is off unless enabled: set CAPILLARY_PROFILE=<run.jsonl> (or call enable()), and
+# every process of the run, pool workers included, appends one JSON line per stage call.
+# The process that enabled it writes <run>.summary.json (per-stage totals) and <run>.folded
+# (collapsed stacks of self time, for flamegraph.pl / speedscope) when it exits;
+# `python instrument_utils.py run.jsonl` summarizes any run afterwards.
+# Entry points put the repo root on sys.path with append, not insert, so the root's
+# convert_image.py never shadows image_conversion/convert_image.py. The segmentation modules
+# take stage from segmentation/stage_utils.py, which also finds this file from notebooks
+# run in segmentation/.
+
+ENV_PATH = 'CAPILLARY_PROFILE'
+ENV_RUN = 'CAPILLARY_PROFILE_RUN'
+
+_local = threading.local()
+_write_lock = threading.Lock()
+
+def _rss_mb():
+    """Current resident set size (Linux /proc), None elsewhere."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1e6
+    except (OSError, ValueError):
+        return None
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1e6 if sys.platform == 'darwin' else peak / 1e3   # bytes on macOS, KiB on Linux
+
+def array_bytes(obj):
+    """Bytes of the numpy arrays in obj (an array, or a tuple / list / dict of them, one level deep)."""
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, (tuple, list)):
+        return sum(o.nbytes for o in obj if isinstance(o, np.ndarray))
+    if isinstance(obj, dict):
+        return sum(o.nbytes for o in obj.values() if isinstance(o, np.ndarray))
+    return 0
+
+def enabled():
+    return bool(os.environ.get(ENV_PATH))
+
+def enable(path, run=None):
+    """
+    Record stages to path (JSON lines) from now on, in this process and the workers it starts.
+    The summary and folded stacks are written next to it when this process exits.
+    """
+    os.environ[ENV_PATH] = os.path.abspath(path)
+    os.environ[ENV_RUN] = run or time.strftime('%Y%m%d-%H%M%S-') + uuid.uuid4().hex[:6]
+    atexit.register(_write_outputs, os.environ[ENV_PATH], os.getpid(), os.environ[ENV_RUN])
+
+def _write_outputs(path, pid, run):
+    if os.getpid() == pid and os.path.exists(path):
+        write_summary(path, run)
+
+def stage(name=None):
+    """
+    Record one pipeline stage. As a decorator (@stage or @stage('name')) every call is a
+    stage named after the function; as a context manager (with stage('name') as s:) the
+    block is, and s.add_bytes(arr) counts arrays produced inside it.
+    Nested stages form the call path ('detect_capillaries;meijering').
+    """
+    if callable(name):
+        return Stage(None)(name)
+    return Stage(name)
+
+def _instrumented(func, name):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not os.environ.get(ENV_PATH):
+            return func(*args, **kwargs)
+        with Stage(name) as s:
+            s.in_bytes = array_bytes(args) + array_bytes(kwargs)
+            out = func(*args, **kwargs)
+            s.out_bytes = array_bytes(out)
+            return out
+    return wrapper
+
+class Stage:
+    def __init__(self, name):
+        self.name = name
+        self.in_bytes = 0
+        self.out_bytes = 0
+
+    def __call__(self, func):
+        return _instrumented(func, self.name or func.__name__)
+
+    def add_bytes(self, obj):
+        self.out_bytes += array_bytes(obj)
+
+    def __enter__(self):
+        self._on = bool(os.environ.get(ENV_PATH))
+        if not self._on:
+            return self
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        self._child_s = 0.
+        self._path = ';'.join([f.name for f in stack] + [self.name])
+        self._peak0 = _peak_rss_mb()
+        self._cpu0 = time.thread_time()
+        self._t_epoch = time.time()
+        self._t0 = time.perf_counter()
+        stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if not self._on:
+            return False
+        wall = time.perf_counter() - self._t0
+        cpu = time.thread_time() - self._cpu0
+        _local.stack.pop()
+        if _local.stack:
+            _local.stack[-1]._child_s += wall
+        peak = _peak_rss_mb()
+        _emit(dict(run=os.environ.get(ENV_RUN), pid=os.getpid(), thread=threading.current_thread().name,
+                   stage=self.name, path=self._path, start=self._t_epoch, wall_s=wall,
+                   self_s=max(wall - self._child_s, 0.), cpu_s=cpu, rss_mb=_rss_mb(), peak_rss_mb=peak,
+                   peak_growth_mb=peak - self._peak0, in_mb=self.in_bytes / 1e6, out_mb=self.out_bytes / 1e6,
+                   error=exc_type.__name__ if exc_type else None))
+        return False
+
+def _emit(event):
+    path = os.environ.get(ENV_PATH)
+    if not path:
+        return
+    line = json.dumps(event) + '\n'
+    # one short O_APPEND write per event, so lines from several processes do not interleave
+    with _write_lock:
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode())
+        finally:
+            os.close(fd)
+
+def load_events(path, run=None):
+    """Events of a run file (the latest run in it unless run is given)."""
+    with open(path) as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    if run is None and events:
+        run = max(events, key=lambda e: e['start'])['run']
+    return [e for e in events if e['run'] == run]
+
+def summarize(events):
+    """Per call path: calls, wall / self / CPU time, memory high-water marks and array traffic."""
+    stages = {}
+    for e in events:
+        s = stages.setdefault(e['path'], dict(stage=e['stage'], calls=0, errors=0, wall_s=0., self_s=0., cpu_s=0.,
+                                              max_wall_s=0., peak_rss_mb=0., peak_growth_mb=0., in_mb=0.,
+                                              out_mb=0., pids=set()))
+        s['calls'] += 1
+        s['errors'] += e['error'] is not None
+        for k in ('wall_s', 'self_s', 'cpu_s', 'in_mb', 'out_mb'):
+            s[k] += e[k]
+        s['max_wall_s'] = max(s['max_wall_s'], e['wall_s'])
+        s['peak_rss_mb'] = max(s['peak_rss_mb'], e['peak_rss_mb'])
+        s['peak_growth_mb'] = max(s['peak_growth_mb'], e['peak_growth_mb'])
+        s['pids'].add(e['pid'])
+    for s in stages.values():
+        s['processes'] = len(s.pop('pids'))
+        s['mean_wall_s'] = s['wall_s'] / s['calls']
+    wall = (max(e['start'] + e['wall_s'] for e in events) - min(e['start'] for e in events)) if events else 0.
+    return dict(run=events[0]['run'] if events else None, wall_s=wall,
+                stages=dict(sorted(stages.items(), key=lambda kv: -kv[1]['wall_s'])))
+
+def folded(events):
+    """Collapsed stacks ('a;b;c <microseconds of self time>') for flamegraph.pl or speedscope."""
+    totals = {}
+    for e in events:
+        totals[e['path']] = totals.get(e['path'], 0.) + e['self_s']
+    return ''.join(f'{p} {int(round(s * 1e6))}\n' for p, s in sorted(totals.items()))
+
+def write_summary(path, run=None):
+    """<run>.summary.json and <run>.folded next to the events file; returns the summary."""
+    events = load_events(path, run)
+    summary = summarize(events)
+    base = os.path.splitext(path)[0]
+    with open(base + '.summary.json', 'w') as f:
+        json.dump(summary, f, indent=1)
+    with open(base + '.folded', 'w') as f:
+        f.write(folded(events))
+    return summary
+
+def report(summary):
+    print(f"run {summary['run']}: {summary['wall_s']:.2f} s")
+    print(f"{'stage':<44} {'calls':>6} {'wall[s]':>9} {'self[s]':>9} {'cpu[s]':>8} {'max[s]':>8} "
+          f"{'peak RSS[MB]':>12} {'+peak[MB]':>9} {'in[MB]':>8} {'out[MB]':>8}")
+    for path, s in summary['stages'].items():
+        print(f"{path[-44:]:<44} {s['calls']:>6} {s['wall_s']:>9.3f} {s['self_s']:>9.3f} {s['cpu_s']:>8.3f} "
+              f"{s['max_wall_s']:>8.3f} {s['peak_rss_mb']:>12.1f} {s['peak_growth_mb']:>9.1f} "
+              f"{s['in_mb']:>8.1f} {s['out_mb']:>8.1f}")
+
+# CAPILLARY_PROFILE set in the environment: the first process to import this module owns the run
+if os.environ.get(ENV_PATH) and not os.environ.get(ENV_RUN) and __name__ != '__main__':
+    enable(os.environ[ENV_PATH])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize a CAPILLARY_PROFILE stage recording.')
+    parser.add_argument('events', help='JSON lines written by the instrumented run')
+    parser.add_argument('--run', default=None, help='run id (default: the latest in the file)')
+    args = parser.parse_args()
+    report(write_summary(args.events, args.run))
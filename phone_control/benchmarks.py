@@ -0,0 +1,70 @@
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from capture_utils import CaptureWatcher, shoot_fixed, shoot_polling
+from device_utils import AdbDevice, FakeDevice, write_mock_adb
+
+# usage: python benchmarks.py [name ...]  (runs every benchmark if no name is given)
+
+def _rate(func, n):
+    t0 = time.perf_counter()
+    func(n)
+    return n / (time.perf_counter() - t0)
+
+def bench_session(n_cmds=200, startups=(0.0, 0.02, 0.05), tool_s=0.0):
+    """ commands/s: one adb process per command vs one persistent shell (single and batched) """
+    print('adb shell input: subprocess per command vs persistent session (mock adb)')
+    print(f'{"startup[s]":>10} {"subprocess":>11} {"session":>9} {"batched":>9} {"speedup":>8}')
+    for startup in startups:
+        adb = write_mock_adb(tempfile.mkdtemp(prefix='mock_adb_'), startup_s=startup, tool_s=tool_s)
+        per_cmd = AdbDevice(adb=adb, persistent=False)
+        session = AdbDevice(adb=adb)
+        session.shell('true')  # open the session outside the timing
+        swipes = lambda n: [f'input swipe 445 525 445 {545 + i % 2} 60' for i in range(n)]
+        r_sub = _rate(lambda n: [per_cmd.tap(100, 200) for _ in range(n)], max(n_cmds // 4, 10))
+        r_ses = _rate(lambda n: [session.tap(100, 200) for _ in range(n)], n_cmds)
+        r_bat = _rate(lambda n: session.shell_many(swipes(n)), n_cmds)
+        session.close()
+        print(f'{startup:>10.2f} {r_sub:>11.1f} {r_ses:>9.1f} {r_bat:>9.1f} {r_ses / r_sub:>7.1f}x')
+
+def _fake_frame(seed):
+    return np.zeros((64, 64), np.uint16)
+
+def bench_capture(n_shots=10, save_latency=0.3, jitter=0.3, command_s=0.05):
+    """ sweep time of n_shots: fixed POST_SHOT_SEC sleep vs MediaStore polling vs file events """
+    print(f'capture completion, {n_shots} shots, save latency {save_latency}-{save_latency + jitter} s, '
+          f'{command_s} s per adb command (fake device)')
+    print(f'{"method":>8} {"total[s]":>9} {"per shot[s]":>12} {"missed":>7} {"queries":>8}')
+    pure = n_shots * (save_latency + jitter / 2)
+    for method in ('fixed', 'polling', 'events'):
+        dev = FakeDevice(tempfile.mkdtemp(prefix='fake_phone_'), save_latency=save_latency, jitter=jitter,
+                         payload=_fake_frame, command_latency=command_s)
+        watcher = CaptureWatcher(dev, dev.camera_dir) if method == 'events' else None
+        missed = 0
+        t0 = time.perf_counter()
+        for _ in range(n_shots):
+            if method == 'fixed':
+                row, _ = shoot_fixed(dev, 0.8)
+            elif method == 'polling':
+                row, _ = shoot_polling(dev, poll_s=0.3)
+            else:
+                row, _ = watcher.shoot()
+            missed += row is None and method != 'fixed'
+        total = time.perf_counter() - t0
+        if watcher:
+            watcher.close()
+        queries = sum(c.startswith('content query') for c in dev.commands)
+        print(f'{method:>8} {total:>9.2f} {total / n_shots:>12.3f} {missed:>7} {queries:>8}')
+    print(f'{"saving":>8} {pure:>9.2f} {pure / n_shots:>12.3f}  (mean save latency only)')
+
+BENCHMARKS = {
+    'session': bench_session,
+    'capture': bench_capture,
+}
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or list(BENCHMARKS):
+        BENCHMARKS[name]()
@@ -2,7 +2,9 @@
 set -euo pipefail
 
 N=${1:-5}          # number of shots
-DELAY=${2:-2}      # seconds between shots
+DELAY=${2:-2}      # seconds between shots; with WAIT=events, the longest wait for a saved file
+WAIT=${WAIT:-events}              # events: next shot as soon as the file is saved; sleep: fixed DELAY
+CAMERA_DIR=${CAMERA_DIR:-/sdcard/DCIM/Camera}
 
 # Ensure phone is connected
 adb get-state 1>/dev/null
@@ -11,8 +13,30 @@ adb get-state 1>/dev/null
 adb shell monkey -p com.samsung.android.app.galaxyraw -c android.intent.category.LAUNCHER 1
 sleep 1
 
+if [ "$WAIT" = "events" ]; then
+  # one listener for the whole burst: a line per file closed after writing (w) or moved in (y)
+  coproc WATCH { adb shell inotifyd - "$CAMERA_DIR:wy"; }
+  trap 'kill "$WATCH_PID" 2>/dev/null || true' EXIT
+fi
+
 for i in $(seq 1 "$N"); do
   echo "Shot $i / $N"
   adb shell input keyevent 27 # 27 = CAMERA
-  sleep "$DELAY"
+  if [ "$WAIT" = "events" ]; then
+    start=$(date +%s.%N)
+    saved=""
+    # skip hidden .pending-* files; the shot is done when a visible file lands
+    while IFS=$'\t' read -r -t "$DELAY" -u "${WATCH[0]}" ev dir name; do
+      name=${name%$'\r'}
+      case "$name" in .*|"") continue ;; esac
+      saved=$name; break
+    done || true
+    if [ -n "$saved" ]; then
+      echo "  saved $saved after $(echo "$(date +%s.%N) - $start" | bc) s"
+    else
+      echo "  ! no file within $DELAY s (continuing)"
+    fi
+  else
+    sleep "$DELAY"
+  fi
 done
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+import queue
+import threading
+import time
+
+import numpy as np
+
+from device_utils import CAMERA_DIR, MediaRow, wait_for_new_image
+
+# Event-driven capture completion: one long-running file listener per device (inotifyd on the
+# camera folder) resolves shots as their files land, instead of fixed sleeps or a new adb
+# process per MediaStore poll. Timeouts adapt to the save latencies observed so far.
+
+RAW_EXTENSIONS = ('.dng', '.tif', '.tiff')
+
+class LatencyModel:
+    """
+    Save latency beyond the exposure (processing + write), tracked as an exponentially weighted
+    mean and variance. timeout(exposure) = exposure + mean + k*std, clamped to [min_s, max_s];
+    until warmup observations exist it is control_tap.exposure_timeout_s (1.5 s + 0.2*exposure).
+    """
+
+    def __init__(self, k=4.0, alpha=0.2, warmup=3, min_s=0.5, max_s=30.0):
+        self.k, self.alpha, self.warmup = k, alpha, warmup
+        self.min_s, self.max_s = min_s, max_s
+        self.n = 0
+        self.mean = 0.
+        self.var = 0.
+
+    def observe(self, latency_s, exposure_s=0.):
+        x = max(latency_s - exposure_s, 0.)
+        self.n += 1
+        if self.n == 1:
+            self.mean = x
+            return
+        d = x - self.mean
+        self.mean += self.alpha * d
+        self.var = (1 - self.alpha) * (self.var + self.alpha * d * d)
+
+    def timeout(self, exposure_s=0.):
+        exposure_s = max(float(exposure_s), 0.)
+        if self.n < self.warmup:
+            return exposure_s + 1.5 + 0.2 * exposure_s
+        return exposure_s + float(np.clip(self.mean + self.k * np.sqrt(self.var), self.min_s, self.max_s))
+
+class CaptureWatcher:
+    """
+    Resolves shots from the device's file events. A reader thread parses inotifyd lines
+    ('<event>\\t<folder>\\t<name>'), ignores hidden / pending files, other extensions and
+    repeated events of one file, and queues every new capture as a MediaRow (id None).
+    If the listener dies, wait() falls back to polling MediaStore.
+    """
+
+    def __init__(self, device, folder=CAMERA_DIR, extensions=RAW_EXTENSIONS, model=None):
+        self.device = device
+        self.folder = folder
+        self.extensions = tuple(e.lower() for e in extensions)
+        self.model = model or LatencyModel()
+        self.latencies = []
+        self._events = queue.Queue()
+        self._seen = set()
+        self._stream = device.watch_files(folder)
+        self._reader = threading.Thread(target=self._read, daemon=True)
+        self.alive = True
+        self._reader.start()
+
+    def _read(self):
+        try:
+            for line in self._stream:
+                parts = line.rstrip('\r\n').split('\t')
+                if len(parts) < 3:
+                    continue
+                folder, name = parts[1], parts[2]
+                if name.startswith('.') or not name.lower().endswith(self.extensions) or name in self._seen:
+                    continue
+                self._seen.add(name)
+                self._events.put((time.perf_counter(), MediaRow(None, name, int(time.time()),
+                                                                f'{folder.rstrip("/")}/{name}')))
+        finally:
+            self.alive = False
+
+    def drain(self):
+        """Drop captures that arrived before now (e.g. late files of a timed-out shot)."""
+        while True:
+            try:
+                self._events.get_nowait()
+            except queue.Empty:
+                return
+
+    def wait(self, timeout_s, prev=None, events=None):
+        """
+        Next capture within timeout_s as (MediaRow, arrival perf_counter), or (None, None).
+        prev: newest MediaStore row before the shot, for the polling fallback.
+        events: wait on file events (True) or poll (False); default: events while the listener is alive.
+        """
+        if events is None:
+            events = self.alive
+        if not events:
+            row = wait_for_new_image(self.device, prev.id if prev else None, timeout_s=timeout_s)
+            return row, (time.perf_counter() if row else None)
+        try:
+            t, row = self._events.get(timeout=timeout_s)
+            return row, t
+        except queue.Empty:
+            return None, None
+
+    def shoot(self, exposure_s=0., timeout_s=None, press=None):
+        """
+        Press the shutter (press(), default device.shutter) and wait for its file.
+        Returns (MediaRow or None, latency_s). The timeout comes from the latency model unless
+        given; every resolved shot updates it.
+        """
+        self.drain()
+        # decided once per shot: a listener dying mid-shot then costs a miss, never an old image
+        events = self.alive
+        prev = None if events else self.device.latest_image_row()
+        t0 = time.perf_counter()
+        (press or self.device.shutter)()
+        row, t = self.wait(timeout_s or self.model.timeout(exposure_s), prev, events)
+        if row is None:
+            return None, time.perf_counter() - t0
+        latency = t - t0
+        self.model.observe(latency, exposure_s)
+        self.latencies.append(latency)
+        return row, latency
+
+    def close(self):
+        self._stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def shoot_polling(device, exposure_s=0., poll_s=0.3, timeout_s=None):
+    """The original shot loop: shutter, then poll MediaStore (one query per poll)."""
+    prev = device.latest_image_row()
+    t0 = time.perf_counter()
+    device.shutter()
+    row = wait_for_new_image(device, prev.id if prev else None,
+                             timeout_s=timeout_s or exposure_s + 1.5 + 0.2 * exposure_s, poll_s=poll_s)
+    return row, time.perf_counter() - t0
+
+def shoot_fixed(device, post_shot_s=0.8):
+    """control_drag / burst_raw.sh: shutter, then a fixed sleep."""
+    t0 = time.perf_counter()
+    device.shutter()
+    time.sleep(post_shot_s)
+    return None, time.perf_counter() - t0
@@ -1,5 +1,4 @@
 #!/usr/bin/env python3
-import itertools
 import subprocess
 import time
 from dataclasses import dataclass
@@ -25,6 +24,8 @@ REPEAT_SHOTS     = 1
 
 # Sweep mode: "product" = all combinations; "single" = sweep one control at a time
 SWEEP_MODE       = "single"
+# Product order: "snake" = Gray-code path from the current slider state; "baseline" = undo every combo
+SWEEP_ORDER      = "snake"
 
 # ============= Motion / Timing (tune as needed) =============
 DY_PER_STEP      = 20    # vertical pixels per micro-step (typ. 15–25)
@@ -36,15 +37,45 @@ POST_SHOT_SEC    = 0.8   # wait after shutter
 POST_SHOT_TAP    = (1000, 510)  # optional (x,y) to tap after every shot; None to skip
 # POST_SHOT_TAP = None
 DRY_RUN          = False # True prints commands without sending to device
+PERSISTENT_SHELL = True  # send adb shell commands through one long-lived shell
+CAPTURE_EVENTS   = True  # wait for the saved file (adaptive timeout) instead of POST_SHOT_SEC
+CAMERA_DIR       = "/sdcard/DCIM/Camera"
 # ============================================================
 
 
+_DEVICE = None
+_WATCHER = None
+
 def sh(cmd: str):
     if DRY_RUN:
         print(f"[DRY] {cmd}")
         return
+    if PERSISTENT_SHELL and cmd.startswith("adb shell "):
+        session().run(cmd[len("adb shell "):])
+        return
     subprocess.run(cmd, shell=True, check=True)
 
+def device():
+    """The phone as a device_utils.AdbDevice (DRY_RUN / PERSISTENT_SHELL as set above)."""
+    global _DEVICE
+    if _DEVICE is None:
+        from device_utils import AdbDevice
+        _DEVICE = AdbDevice(dry_run=DRY_RUN, persistent=PERSISTENT_SHELL)
+    return _DEVICE
+
+def session():
+    """The long-lived `adb shell` used for input commands (device_utils.ShellSession)."""
+    return device().session
+
+def watcher():
+    """File listener on the camera folder (capture_utils.CaptureWatcher), started on first use."""
+    global _WATCHER
+    if _WATCHER is None:
+        from capture_utils import CaptureWatcher
+        from device_utils import AdbDevice
+        _WATCHER = CaptureWatcher(AdbDevice(persistent=False), CAMERA_DIR)
+    return _WATCHER
+
 def tap(xy):
     x, y = xy
     sh(f"adb shell input tap {x} {y}")
@@ -52,9 +83,39 @@ def tap(xy):
 def swipe_v(x, y, dy, ms):
     sh(f"adb shell input swipe {x} {y} {x} {y + dy} {ms}")
 
+def swipes_v(x, y, dy, ms, n, pause):
+    """n identical micro-swipes; with the persistent shell they go out as one batch, paced on the device."""
+    if DRY_RUN or not PERSISTENT_SHELL:
+        for _ in range(n):
+            swipe_v(x, y, dy, ms)
+            time.sleep(pause)
+        return
+    session().run_many([f"input swipe {x} {y} {x} {y + dy} {ms}", f"sleep {pause}"] * n)
+
 def shutter():
     sh("adb shell input keyevent 27")  # 27 = camera; helps take picture
 
+def take_shot():
+    """Shutter, then wait until the capture is saved (or POST_SHOT_SEC without CAPTURE_EVENTS)."""
+    if not CAPTURE_EVENTS or DRY_RUN:
+        shutter(); time.sleep(POST_SHOT_SEC)
+        return
+    w = watcher()
+    tmo = w.model.timeout()
+    row, latency = w.shoot(press=shutter)
+    if row is None:
+        print(f"     ! no file after {tmo:.1f}s (continuing)")
+    else:
+        print(f"     saved {row.name} after {latency:.2f}s")
+
+def sweep_timing():
+    """Per-action costs for the sweep estimator (sweep_utils.Timing) from the settings above."""
+    from sweep_utils import Timing
+    cmd = 0.01 if PERSISTENT_SHELL else 0.1
+    shot = POST_SHOT_SEC + cmd + REVEAL_PAUSE + cmd + ((0.1 + cmd) if POST_SHOT_TAP else 0.)
+    return Timing(swipe_s=SWIPE_MS / 1000, step_pause_s=STEP_PAUSE, reveal_s=REVEAL_PAUSE,
+                  settle_s=SETTLE_SEC, shot_s=shot, cmd_s=cmd)
+
 def ensure_device_and_open():
     sh("adb get-state")
     sh("adb shell monkey -p com.samsung.android.app.galaxyraw -c android.intent.category.LAUNCHER 1")
@@ -83,9 +144,7 @@ class VControl:
         self.reveal()
         x0, y0 = self.track_xy
         sign = 1 if n > 0 else -1
-        for _ in range(abs(n)):
-            swipe_v(x0, y0, sign * DY_PER_STEP, SWIPE_MS)
-            time.sleep(STEP_PAUSE)
+        swipes_v(x0, y0, sign * DY_PER_STEP, SWIPE_MS, abs(n), STEP_PAUSE)
 
     def settle(self):
         time.sleep(SETTLE_SEC)
@@ -108,32 +167,28 @@ def main():
     shot_count = 0
 
     if SWEEP_MODE == "product":
-        combos = list(itertools.product(focus.steps, shut.steps, iso.steps, wb.steps))
-        total  = len(combos) * REPEAT_SHOTS
-
-        for (fs, ss, is_, wbs) in combos:
-            label = f"[F{fs:+d} S{ss:+d} I{is_:+d} W{wbs:+d}]"
-            print(f"\nSetting combo {label}")
-
-            focus.move_relative_steps(fs); focus.settle()
-            shut.move_relative_steps(ss);  shut.settle()
-            iso.move_relative_steps(is_);  iso.settle()
-            wb.move_relative_steps(wbs);   wb.settle()
-
-            for r in range(REPEAT_SHOTS):
-                shot_count += 1
-                print(f"  -> Shot {shot_count}/{total} {label} (rep {r+1}/{REPEAT_SHOTS})")
-                shutter(); time.sleep(POST_SHOT_SEC)
-                if POST_SHOT_TAP:
-                    tap(POST_SHOT_TAP); time.sleep(0.1)
-                re_show_control(wb)
-
-            # Undo to baseline for reproducibility
-            wb.move_relative_steps(-wbs)
-            iso.move_relative_steps(-is_)
-            shut.move_relative_steps(-ss)
-            focus.move_relative_steps(-fs)
-            time.sleep(0.15)
+        from sweep_utils import baseline_plan, format_summary, plan_sweep, summarize
+        axes = [c.steps for c in controls]
+        timing = sweep_timing()
+        base = baseline_plan(axes)
+        if SWEEP_ORDER == "snake":
+            plan, nesting, _ = plan_sweep(axes, timing, REPEAT_SHOTS)
+            print("Nesting (slowest -> fastest):", [controls[k].name for k in nesting])
+        elif SWEEP_ORDER == "baseline":
+            plan = base
+        else:
+            raise ValueError("SWEEP_ORDER must be 'snake' or 'baseline'")
+        print(format_summary("baseline", summarize(base, timing, REPEAT_SHOTS)))
+        if plan is not base:
+            print(format_summary("snake", summarize(plan, timing, REPEAT_SHOTS)))
+
+        # the same plan executor as orchestrate_utils' multi-phone sweeps, on this phone
+        from orchestrate_utils import DeviceSweep, default_profile
+        sweep = DeviceSweep(device(), default_profile(), [c.name for c in controls], REPEAT_SHOTS)
+        report = sweep.run(plan, watcher() if CAPTURE_EVENTS and not DRY_RUN else None, verbose=True)
+        shot_count = report.shots
+        if report.error:
+            raise RuntimeError(report.error)
 
     elif SWEEP_MODE == "single":
         for c in controls:
@@ -144,7 +199,7 @@ def main():
                 for r in range(REPEAT_SHOTS):
                     shot_count += 1
                     print(f"  -> Shot {shot_count} [{c.name}{s:+d}] (rep {r+1}/{REPEAT_SHOTS})")
-                    shutter(); time.sleep(POST_SHOT_SEC)
+                    take_shot()
                     if POST_SHOT_TAP:
                         tap(POST_SHOT_TAP); time.sleep(0.1)
                     re_show_control(c)
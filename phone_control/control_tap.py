@@ -48,24 +48,55 @@ CAPTURE_BASELINE = True
 BASELINE_PER_CONTROL = True
 
 DRY_RUN = False  # see how it runs without touching the device
+PERSISTENT_SHELL = True  # send adb shell commands through one long-lived shell
+CAPTURE_EVENTS = True    # resolve shots from file events in CAMERA_DIR instead of polling MediaStore
+CAMERA_DIR = "/sdcard/DCIM/Camera"
+
+# Pull and analyze every capture while the sweep goes on (see pipeline_utils.py); None to disable
+PIPELINE_DIR = None
 
 # =========================
 # ADB helpers and IO waits
 # =========================
 
+_SESSION = None
+_WATCHER = None
+
 def sh(cmd: str):
     if DRY_RUN:
         print(f"[DRY] {cmd}")
         return
+    if PERSISTENT_SHELL and cmd.startswith("adb shell "):
+        session().run(cmd[len("adb shell "):])
+        return
     subprocess.run(cmd, shell=True, check=True)
 
+def session():
+    """The long-lived `adb shell` used for input commands (device_utils.ShellSession)."""
+    global _SESSION
+    if _SESSION is None:
+        from device_utils import ShellSession
+        _SESSION = ShellSession()
+    return _SESSION
+
 def adb_out(cmd: str) -> str:
     """Run an adb command and return stdout (text)."""
     if DRY_RUN:
         print(f"[DRY OUT] {cmd}")
         return ""
+    if PERSISTENT_SHELL and cmd.startswith("adb shell "):
+        return session().run(cmd[len("adb shell "):]).strip()
     return subprocess.check_output(cmd, shell=True, text=True).strip()
 
+def watcher():
+    """File listener on the camera folder (capture_utils.CaptureWatcher), started on first use."""
+    global _WATCHER
+    if _WATCHER is None:
+        from capture_utils import CaptureWatcher
+        from device_utils import AdbDevice
+        _WATCHER = CaptureWatcher(AdbDevice(persistent=False), CAMERA_DIR)
+    return _WATCHER
+
 def tap(x: int | float, y: int | float):
     x = int(round(x)); y = int(round(y))
     sh(f"adb shell input tap {x} {y}")
@@ -126,17 +157,37 @@ def exposure_timeout_s(shutter_value_s: float) -> float:
 
 def shoot_with_wait(current_shutter_value_s: float, label: str = ""):
     """
-    Press shutter and wait for MediaStore to publish the new image.
+    Press shutter and wait for the new image: its file event (CAPTURE_EVENTS, adaptive
+    timeout) or MediaStore publishing it. Returns the capture, or None on timeout.
     """
+    if CAPTURE_EVENTS and not DRY_RUN:
+        w = watcher()
+        tmo = w.model.timeout(current_shutter_value_s)
+        row, latency = w.shoot(current_shutter_value_s, press=shutter)
+        if row is not None:
+            print(f"   ✓ Capture saved: {row.name} ({latency:.2f}s, timeout {tmo:.1f}s) {label}")
+        else:
+            print(f"   ! Timed out after {tmo:.1f}s waiting for the file (continuing). {label}")
+        return row
     prev_id, prev_name, _ = latest_image_row()
     shutter()
     tmo = exposure_timeout_s(current_shutter_value_s)
     ok, cur = wait_for_new_image(prev_id, timeout_s=tmo, poll_s=0.3)
     if ok:
         print(f"   ✓ Capture saved: id={cur[0]} name={cur[1]} (≤ {tmo:.1f}s) {label}")
+        return cur
     else:
         print(f"   ! Timed out after {tmo:.1f}s waiting for MediaStore (continuing). {label}")
         time.sleep(0.8)
+        return None
+
+def hand_off(pipeline, cur, label=""):
+    """Give a saved capture to the analysis pipeline (blocks while it is saturated)."""
+    if pipeline is None or cur is None:
+        return
+    row = pipeline.device.image_row(cur[0]) if isinstance(cur, tuple) else cur
+    if row is not None:
+        pipeline.submit(row, label)
 
 # =========================
 # UI control abstraction
@@ -179,6 +230,13 @@ class VControl:
 def main():
     ensure_device_and_open()
 
+    pipeline = None
+    if PIPELINE_DIR and not DRY_RUN:
+        from device_utils import AdbDevice
+        from pipeline_utils import CapturePipeline
+        pipeline = CapturePipeline(AdbDevice(), PIPELINE_DIR)
+    t_start = time.time()
+
     focus = VControl("FOCUS",  FOCUS_TOGGLE_XY, FOCUS_X, FOCUS_Y, FOCUS_PCTS, "repeats=len(values)")
     shut  = VControl("SHUTTER", SHUT_TOGGLE_XY, SHUT_X, SHUT_Y, SHUT_PCTS, "repeats=len(values)")
     iso   = VControl("ISO",     ISO_TOGGLE_XY,  ISO_X, ISO_Y, ISO_PCTS, "repeats=len(values)")
@@ -209,7 +267,7 @@ def main():
                 shot_count += 1
                 print(f"  -> Shot {shot_count}/{total} {label} (rep {r+1}/{REPEAT_SHOTS})")
                 # Wait until the *actual* image is saved:
-                shoot_with_wait(ps, label=label)
+                hand_off(pipeline, shoot_with_wait(ps, label=label), label)
                 if POST_SHOT_TAP:
                     tap(*POST_SHOT_TAP); time.sleep(0.1)
             # Re-expose WB drawer so the UI stays predictable between combos
@@ -226,7 +284,7 @@ def main():
                     # Use true exposure when sweeping shutter; else a nominal fast time
                     cur_exp = float(v) if (c.name == "SHUTTER" and isinstance(v, (int, float))) else (1/125)
                     print(f"  -> Shot {shot_count} [{c.name}={label}] (rep {r+1}/{REPEAT_SHOTS})")
-                    shoot_with_wait(cur_exp, label=f"[{c.name}={label}]")
+                    hand_off(pipeline, shoot_with_wait(cur_exp, label=f"[{c.name}={label}]"), f"[{c.name}={label}]")
                     if POST_SHOT_TAP:
                         tap(*POST_SHOT_TAP); time.sleep(0.1)
 
@@ -234,6 +292,9 @@ def main():
         raise ValueError("SWEEP_MODE must be 'product' or 'single'")
 
     print(f"\nDone. Total shots: {shot_count}")
+    if pipeline:
+        from pipeline_utils import report
+        report(pipeline.close(), time.time() - t_start)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,499 @@
+#!/usr/bin/env python3
+import os
+import queue
+import re
+import shlex
+import shutil
+import subprocess
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+
+import numpy as np
+
+# Device layer shared by the capture scripts: everything goes through shell() / shell_out()
+# and pull(), so the same sweep / pipeline code runs against a phone over adb (AdbDevice) or
+# a local stand-in (FakeDevice) that simulates the camera saving files into MediaStore.
+
+CAMERA_PACKAGE = "com.samsung.android.app.galaxyraw"
+CAMERA_DIR = "/sdcard/DCIM/Camera"
+MEDIA_URI = "content://media/external/images/media"
+KEYCODE_CAMERA = 27
+# names of the primary shared storage; MediaStore reports _data under the first
+STORAGE_ALIASES = ("/storage/emulated/0", "/storage/self/primary", "/mnt/sdcard")
+
+@dataclass
+class MediaRow:
+    id: int
+    name: str
+    ts: int         # date_added (s)
+    path: str       # _data, path on the device
+
+def sdcard_path(path: str) -> str:
+    """A device path with the primary storage spelled /sdcard, so MediaStore and inotifyd paths compare equal."""
+    for alias in STORAGE_ALIASES:
+        if path == alias or path.startswith(alias + "/"):
+            return "/sdcard" + path[len(alias):]
+    return path
+
+def parse_rows(out: str) -> list[MediaRow]:
+    """Rows of `adb shell content query` output (Row: 0 _id=1, _display_name=..., ...)."""
+    rows = []
+    for line in out.splitlines():
+        if not line.startswith("Row:"):
+            continue
+        m_id = re.search(r"_id=(\d+)", line)
+        m_nm = re.search(r"_display_name=([^,\n]+)", line)
+        m_ts = re.search(r"date_added=(\d+)", line)
+        m_pa = re.search(r"_data=([^,\n]+)", line)
+        rows.append(MediaRow(int(m_id.group(1)) if m_id else None, m_nm.group(1) if m_nm else None,
+                             int(m_ts.group(1)) if m_ts else None, m_pa.group(1) if m_pa else None))
+    return rows
+
+class ShellSession:
+    """
+    One long-lived shell (`adb [-s serial] shell`) fed through stdin instead of a new adb
+    process per command. Every command is followed by a unique completion marker carrying
+    its exit status; output is read up to the marker. run_many() writes a whole batch before
+    reading, so consecutive commands (e.g. micro-swipes) run back to back on the device.
+    Commands get </dev/null so they cannot swallow the rest of the stream.
+    """
+
+    def __init__(self, argv=("adb", "shell"), timeout_s=30.0):
+        self.argv = list(argv)
+        self.timeout_s = timeout_s
+        self.proc = None
+        self._lines = None
+        self._lock = threading.Lock()
+        self._n = 0
+        self._tag = uuid.uuid4().hex[:8]
+
+    def start(self):
+        self.proc = subprocess.Popen(self.argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT, text=True, bufsize=1)
+        self._lines = queue.Queue()
+        threading.Thread(target=self._read, args=(self.proc, self._lines), daemon=True).start()
+
+    @staticmethod
+    def _read(proc, lines):
+        for line in proc.stdout:
+            lines.put(line)
+        lines.put(None)
+
+    @property
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def _marker(self):
+        self._n += 1
+        return f"__DONE_{self._tag}_{self._n}__"
+
+    def _wait(self, marker, cmd, timeout_s):
+        """(exit status, output) of the command whose marker is marker."""
+        out = []
+        deadline = time.monotonic() + (timeout_s or self.timeout_s)
+        while True:
+            try:
+                line = self._lines.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                self.close()
+                raise TimeoutError(f"no completion marker for {cmd!r}")
+            if line is None:
+                self.proc = None
+                raise ConnectionError(f"shell exited while running {cmd!r}")
+            if line.startswith(marker + " "):
+                text = "".join(out).replace("\r", "")
+                text = text[:-1] if text.endswith("\n") else text   # newline printed before the marker
+                return int(line.split()[-1]), text
+            if line.startswith(f"__DONE_{self._tag}_"):
+                out = []   # an earlier command's marker: what came before it is not ours
+                continue
+            out.append(line)
+
+    def run_many(self, cmds, timeout_s=None, check=True) -> list[str]:
+        """Run commands in order; returns their outputs (stdout + stderr)."""
+        with self._lock:
+            if not self.alive:
+                self.start()
+            markers = [self._marker() for _ in cmds]
+            script = "".join(f"{c} </dev/null; printf '\\n%s %d\\n' {m} $?\n" for c, m in zip(cmds, markers))
+            self.proc.stdin.write(script)
+            self.proc.stdin.flush()
+            # read the whole batch before raising, so no output is left for the next call
+            results = [self._wait(m, c, timeout_s) for c, m in zip(cmds, markers)]
+        if check:
+            for c, (code, text) in zip(cmds, results):
+                if code != 0:
+                    raise subprocess.CalledProcessError(code, c, text)
+        return [text for _, text in results]
+
+    def run(self, cmd, timeout_s=None, check=True) -> str:
+        return self.run_many([cmd], timeout_s, check)[0]
+
+    def close(self):
+        if self.proc is not None:
+            try:
+                self.proc.stdin.close()
+            except OSError:
+                pass
+            try:
+                self.proc.wait(timeout=2)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+            self.proc = None
+
+class LineStream:
+    """Lines of a long-running listener (a process' stdout or a queue); close() stops it."""
+
+    def __init__(self, lines, close=None):
+        self._lines = lines
+        self._close = close
+
+    def __iter__(self):
+        return iter(self._lines)
+
+    def close(self):
+        if self._close:
+            self._close()
+
+class Device:
+    """Commands built on shell()/shell_out(); subclasses provide those and pull()."""
+    serial: str = None
+
+    def shell(self, cmd: str):
+        raise NotImplementedError
+
+    def shell_out(self, cmd: str) -> str:
+        raise NotImplementedError
+
+    def shell_many(self, cmds):
+        for cmd in cmds:
+            self.shell(cmd)
+
+    def watch_files(self, folder: str) -> LineStream:
+        """inotifyd-style lines ('w\\t<folder>\\t<name>') for files written / moved into folder."""
+        raise NotImplementedError
+
+    def pull(self, remote: str, local: str) -> str:
+        raise NotImplementedError
+
+    def read_bytes(self, remote: str) -> bytes:
+        """Contents of a device file, streamed to memory without a local copy."""
+        raise NotImplementedError
+
+    def tap(self, x, y):
+        self.shell(f"input tap {int(round(x))} {int(round(y))}")
+
+    def swipe(self, x0, y0, x1, y1, ms):
+        self.shell(f"input swipe {int(x0)} {int(y0)} {int(x1)} {int(y1)} {int(ms)}")
+
+    def keyevent(self, code: int):
+        self.shell(f"input keyevent {code}")
+
+    def shutter(self):
+        self.keyevent(KEYCODE_CAMERA)
+
+    def open_camera(self, package=CAMERA_PACKAGE):
+        self.shell(f"monkey -p {package} -c android.intent.category.LAUNCHER 1")
+
+    def query_images(self, where=None, limit=1) -> list[MediaRow]:
+        """Newest MediaStore images first."""
+        q = (f"content query --uri {MEDIA_URI} --projection _id,_display_name,date_added,_data "
+             f"--sort 'date_added DESC, _id DESC'")
+        if where:
+            q += f" --where \"{where}\""
+        if limit:
+            q += f" --limit {limit}"
+        return parse_rows(self.shell_out(q))
+
+    def latest_image_row(self) -> MediaRow | None:
+        rows = self.query_images()
+        return rows[0] if rows else None
+
+    def image_row(self, image_id) -> MediaRow | None:
+        rows = self.query_images(f"_id={int(image_id)}")
+        return rows[0] if rows else None
+
+    def new_images(self, after_id) -> list[MediaRow]:
+        """Images with _id > after_id, oldest first."""
+        where = None if after_id is None else f"_id>{int(after_id)}"
+        return self.query_images(where, limit=None)[::-1]
+
+class AdbDevice(Device):
+    """
+    A phone over adb. Shell commands go through one persistent ShellSession
+    (persistent=False: one adb subprocess per command, as the original scripts).
+    """
+
+    def __init__(self, serial: str = None, dry_run: bool = False, adb: str = "adb", persistent: bool = True):
+        self.serial = serial
+        self.dry_run = dry_run
+        self.argv = [adb] + (["-s", serial] if serial else [])
+        self.session = ShellSession(self.argv + ["shell"]) if persistent and not dry_run else None
+
+    # adb arguments go as an argv list, never through a local shell: a remote command is one
+    # argument, which adb hands to the device shell as is (its quoting is parsed only there)
+
+    def adb(self, *args: str):
+        argv = self.argv + list(args)
+        if self.dry_run:
+            print(f"[DRY] {shlex.join(argv)}")
+            return
+        subprocess.run(argv, check=True)
+
+    def adb_out(self, *args: str) -> str:
+        argv = self.argv + list(args)
+        if self.dry_run:
+            print(f"[DRY OUT] {shlex.join(argv)}")
+            return ""
+        return subprocess.check_output(argv, text=True).strip()
+
+    def shell(self, cmd: str):
+        if self.session:
+            self.session.run(cmd)
+        else:
+            self.adb("shell", cmd)
+
+    def shell_out(self, cmd: str) -> str:
+        if self.session:
+            return self.session.run(cmd).strip()
+        return self.adb_out("shell", cmd)
+
+    def shell_many(self, cmds):
+        if self.session:
+            self.session.run_many(list(cmds))
+        else:
+            super().shell_many(cmds)
+
+    def pull(self, remote: str, local: str) -> str:
+        self.adb("pull", remote, local)
+        return local
+
+    def read_bytes(self, remote: str) -> bytes:
+        """`adb exec-out cat`: raw stdout pipe, no tty newline mangling, no temp file on either side."""
+        proc = subprocess.run(self.argv + ["exec-out", f"cat {shlex.quote(remote)}"],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        return proc.stdout
+
+    def open_camera(self, package=CAMERA_PACKAGE):
+        self.adb("get-state")
+        super().open_camera(package)
+
+    def watch_files(self, folder: str = CAMERA_DIR) -> LineStream:
+        """One `inotifyd` on the device (toybox), reporting close-after-write (w) and moved-in (y) files."""
+        proc = subprocess.Popen(self.argv + ["shell", f"inotifyd - {shlex.quote(folder + ':wy')}"],
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, bufsize=1)
+        return LineStream(proc.stdout, proc.terminate)
+
+    def close(self):
+        if self.session:
+            self.session.close()
+
+def list_serials(adb: str = "adb") -> list[str]:
+    """Serials of the attached devices that are ready (`adb devices` state "device")."""
+    out = subprocess.check_output([adb, "devices"], text=True)
+    return [line.split("\t")[0] for line in out.splitlines()
+            if "\t" in line and line.split("\t")[1].strip() == "device"]
+
+MOCK_ADB = """#!/bin/sh
+# mock adb: [-s serial] shell [cmd] | exec-out cmd | get-state | pull src dst | devices
+[ "$1" = "-s" ] && shift 2
+sleep {startup_s}
+case "$1" in
+  shell) shift; if [ $# -eq 0 ]; then exec sh; else exec sh -c "$*"; fi ;;
+  exec-out) shift; exec sh -c "$*" ;;
+  get-state) echo device ;;
+  pull) cp "$2" "$3" ;;
+  devices) printf 'List of devices attached\\n{serials}' ;;
+esac
+"""
+
+MOCK_TOOL = """#!/bin/sh
+[ -n "$MOCK_ADB_LOG" ] && echo "$(basename "$0") $*" >> "$MOCK_ADB_LOG"
+sleep {tool_s}
+"""
+
+def write_mock_adb(folder, startup_s=0.02, tool_s=0., serials=("mock-0",)):
+    """
+    Mock adb executable for tests and benchmarks: `shell` runs a local sh with stub
+    input/monkey/content tools on PATH, each adb invocation pays startup_s and every stub
+    tool_s (the on-device cost of `input`). Set MOCK_ADB_LOG to record the tool calls.
+    Returns the path to pass as AdbDevice(adb=...).
+    """
+    bin_dir = os.path.join(folder, "bin")
+    os.makedirs(bin_dir, exist_ok=True)
+    for tool in ("input", "monkey", "content"):
+        path = os.path.join(bin_dir, tool)
+        with open(path, "w") as f:
+            f.write(MOCK_TOOL.format(tool_s=tool_s))
+        os.chmod(path, 0o755)
+    adb = os.path.join(folder, "adb")
+    with open(adb, "w") as f:
+        f.write(f'#!/bin/sh\nPATH="{bin_dir}:$PATH"; export PATH\n' + MOCK_ADB.split("\n", 1)[1].format(
+            startup_s=startup_s, serials="".join(f"{s}\\tdevice\\n" for s in serials)))
+    os.chmod(adb, 0o755)
+    return adb
+
+def synthetic_frame(seed: int, shape=(768, 1024), n_vessels=6) -> np.ndarray:
+    """uint16 test frame: smooth illumination with dark, wavy vertical capillaries and noise."""
+    rng = np.random.default_rng(seed)
+    H, W = shape
+    y, x = np.mgrid[:H, :W].astype(np.float32)
+    img = 20000 + 8000 * np.exp(-((x - W / 2)**2 + (y - H / 2)**2) / (2 * (0.6 * W)**2))
+    for cx in rng.uniform(0.1, 0.9, n_vessels) * W:
+        path = cx + 12 * np.sin(2 * np.pi * y / rng.uniform(200, 400) + rng.uniform(0, 6))
+        img -= 6000 * np.exp(-(x - path)**2 / (2 * 3.0**2))
+    img += rng.normal(0, 300, img.shape)
+    return np.clip(img, 0, 65535).astype(np.uint16)
+
+def write_synthetic_dng(path, frame: np.ndarray, white_level=1023):
+    """
+    Minimal Bayer DNG (RGGB, 10-bit, black level 64) that rawpy/LibRaw can open: frame is
+    scaled into the sensor range and mosaicked with R/B sites a bit darker than green.
+    """
+    import tifffile
+    bayer = 64 + frame.astype(np.float32) * ((white_level - 64) / 65535)
+    bayer[0::2, 0::2] *= 0.6
+    bayer[1::2, 1::2] *= 0.5
+    tags = [(50706, "B", 4, (1, 4, 0, 0), True),      # DNGVersion
+            (50707, "B", 4, (1, 1, 0, 0), True),      # DNGBackwardVersion
+            (271, "s", 0, "Samsung", True), (272, "s", 0, "FakeDevice", True),
+            (50708, "s", 0, "Samsung FakeDevice", True),
+            (33421, "H", 2, (2, 2), True),            # CFARepeatPatternDim
+            (33422, "B", 4, (0, 1, 1, 2), True),      # CFAPattern RGGB
+            (50714, "H", 1, (64,), True),             # BlackLevel
+            (50717, "H", 1, (white_level,), True),    # WhiteLevel
+            (50721, "2i", 9, (1, 1, 0, 1, 0, 1, 0, 1, 1, 1, 0, 1, 0, 1, 0, 1, 1, 1), True),  # ColorMatrix1
+            (50778, "H", 1, (21,), True)]             # CalibrationIlluminant1 D65
+    tifffile.imwrite(path, np.clip(np.round(bayer), 0, white_level).astype(np.uint16),
+                     photometric=32803, extratags=tags)
+
+class FakeDevice(Device):
+    """
+    Local stand-in for a phone: root is its storage, MediaStore is a list of rows, and the
+    shutter key publishes a new frame after save_latency (+ uniform jitter) seconds, like the
+    camera app saving a capture in the background. Every shell command is recorded.
+    payload(seed) -> array written as TIFF (default synthetic_frame), or as a Bayer DNG with raw=True.
+    """
+
+    def __init__(self, root: str, save_latency: float = 0.5, jitter: float = 0., payload=None,
+                 serial: str = "fake-0", command_latency: float = 0., pull_rate_mb_s: float = None, seed: int = 0,
+                 raw: bool = False):
+        self.root = root
+        self.serial = serial
+        self.save_latency = save_latency
+        self.jitter = jitter
+        self.payload = payload or synthetic_frame
+        self.command_latency = command_latency
+        self.pull_rate_mb_s = pull_rate_mb_s
+        self.raw = raw
+        self.rng = np.random.default_rng(seed)
+        self.rows: list[MediaRow] = []
+        self.commands: list[str] = []
+        self.shots = 0
+        self._lock = threading.Lock()
+        self._timers = []
+        self._watchers = []
+        self.camera_dir = os.path.join(root, "DCIM", "Camera")
+        os.makedirs(self.camera_dir, exist_ok=True)
+
+    def _publish(self, shot: int):
+        import tifffile
+        name = f"IMG_{shot:05d}.{'dng' if self.raw else 'tif'}"
+        path = os.path.join(self.camera_dir, name)
+        tmp = os.path.join(self.camera_dir, f".pending-{name}")
+        if self.raw:
+            write_synthetic_dng(tmp, self.payload(shot))
+        else:
+            tifffile.imwrite(tmp, self.payload(shot))
+        os.replace(tmp, path)
+        with self._lock:
+            self.rows.append(MediaRow(len(self.rows) + 1, name, int(time.time()), path))
+            watchers = list(self._watchers)
+        for q in watchers:
+            q.put(f"w\t{self.camera_dir}\t.pending-{name}\n")
+            q.put(f"y\t{self.camera_dir}\t{name}\n")
+
+    def _shutter(self):
+        with self._lock:
+            self.shots += 1
+            shot = self.shots
+        delay = self.save_latency + (self.rng.uniform(0, self.jitter) if self.jitter else 0.)
+        t = threading.Timer(delay, self._publish, args=(shot,))
+        t.daemon = True
+        t.start()
+        self._timers.append(t)
+
+    def _query(self, cmd: str) -> str:
+        with self._lock:
+            rows = list(self.rows)
+        m = re.search(r"_id([>=])(\d+)", cmd)
+        if m:
+            i = int(m.group(2))
+            rows = [r for r in rows if (r.id > i if m.group(1) == ">" else r.id == i)]
+        rows = rows[::-1]
+        m = re.search(r"--limit (\d+)", cmd)
+        if m:
+            rows = rows[:int(m.group(1))]
+        return "\n".join(f"Row: {i} _id={r.id}, _display_name={r.name}, date_added={r.ts}, _data={r.path}"
+                         for i, r in enumerate(rows)) or "No result found."
+
+    def shell_out(self, cmd: str) -> str:
+        self.commands.append(cmd)
+        if self.command_latency:
+            time.sleep(self.command_latency)
+        if cmd.startswith("input keyevent") and int(cmd.split()[-1]) == KEYCODE_CAMERA:
+            self._shutter()
+        elif cmd.startswith("content query"):
+            return self._query(cmd)
+        elif cmd.startswith("sleep "):
+            time.sleep(float(cmd.split()[1]))
+        return ""
+
+    def shell(self, cmd: str):
+        self.shell_out(cmd)
+
+    def pull(self, remote: str, local: str) -> str:
+        if self.pull_rate_mb_s:
+            time.sleep(os.path.getsize(remote) / 1e6 / self.pull_rate_mb_s)
+        shutil.copyfile(remote, local)
+        return local
+
+    def read_bytes(self, remote: str) -> bytes:
+        self.commands.append(f"exec-out cat {remote}")
+        if self.pull_rate_mb_s:
+            time.sleep(os.path.getsize(remote) / 1e6 / self.pull_rate_mb_s)
+        with open(remote, "rb") as f:
+            return f.read()
+
+    def watch_files(self, folder: str = None) -> LineStream:
+        """inotifyd-like events of the camera folder (the pending file, then the rename)."""
+        q = queue.Queue()
+        with self._lock:
+            self._watchers.append(q)
+
+        def lines():
+            while (line := q.get()) is not None:
+                yield line
+
+        def close():
+            with self._lock:
+                self._watchers.remove(q)
+            q.put(None)
+        return LineStream(lines(), close)
+
+    def wait_idle(self):
+        """Block until every pending capture has been published."""
+        for t in list(self._timers):
+            t.join()
+
+def wait_for_new_image(device: Device, prev_id, timeout_s=10.0, poll_s=0.25) -> MediaRow | None:
+    """Poll MediaStore until an image other than prev_id is newest; None on timeout."""
+    start = time.time()
+    while time.time() - start < timeout_s:
+        cur = device.latest_image_row()
+        if cur is not None and cur.id != prev_id:
+            return cur
+        time.sleep(poll_s)
+    return None
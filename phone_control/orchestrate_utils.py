@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import tempfile
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field, replace
+
+import numpy as np
+
+from capture_utils import CaptureWatcher
+from device_utils import CAMERA_DIR, AdbDevice, FakeDevice, list_serials
+from sweep_utils import Timing, plan_sweep
+
+# Multi-device sweeps: one thread per phone, each with its own Device (own adb shell session),
+# coordinate profile and capture watcher, running the control_drag product sweep planned by
+# sweep_utils (DeviceSweep is also what control_drag's product mode runs on its one phone).
+# Devices are independent: a failure stops that phone's sweep only and is reported with the
+# per-device timings.
+#
+# Profiles (JSON) map serials to overrides of "default", e.g.
+#   {"default": {"FOCUS": {"toggle": [490, 107], "track": [445, 525]}, "dy_per_step": 20},
+#    "R5CT11ABCDE": {"SHUTTER": {"toggle": [1200, 990]}, "settle_sec": 0.7}}
+# Anything left out comes from the control_drag constants.
+
+CONTROLS = ("FOCUS", "SHUTTER", "ISO", "WB")
+
+@dataclass
+class ControlXY:
+    toggle: tuple
+    track: tuple
+
+@dataclass
+class Profile:
+    """Screen coordinates and motion timing of one rig (control_drag's *_XY and timing constants)."""
+    controls: dict                       # control name -> ControlXY
+    dy_per_step: int = 20
+    swipe_ms: int = 60
+    step_pause: float = 0.06
+    reveal_pause: float = 0.25
+    settle_sec: float = 0.5
+    post_shot_sec: float = 0.8          # wait after the shutter when no capture watcher is used
+    post_shot_tap: tuple = (1000, 510)   # None to skip
+    camera_dir: str = CAMERA_DIR
+
+    def timing(self, shot_s=None, cmd_s=0.01) -> Timing:
+        shot = (self.post_shot_sec if shot_s is None else shot_s) + self.reveal_pause + 2 * cmd_s + ((0.1 + cmd_s) if self.post_shot_tap else 0.)
+        return Timing(swipe_s=self.swipe_ms / 1000, step_pause_s=self.step_pause, reveal_s=self.reveal_pause,
+                      settle_s=self.settle_sec, shot_s=shot, cmd_s=cmd_s)
+
+def default_profile() -> Profile:
+    import control_drag as cd
+    return Profile({"FOCUS": ControlXY(cd.FOCUS_TOGGLE_XY, cd.FOCUS_TRACK_XY),
+                    "SHUTTER": ControlXY(cd.SHUT_TOGGLE_XY, cd.SHUT_TRACK_XY),
+                    "ISO": ControlXY(cd.ISO_TOGGLE_XY, cd.ISO_TRACK_XY),
+                    "WB": ControlXY(cd.WB_TOGGLE_XY, cd.WB_TRACK_XY)},
+                   dy_per_step=cd.DY_PER_STEP, swipe_ms=cd.SWIPE_MS, step_pause=cd.STEP_PAUSE,
+                   reveal_pause=cd.REVEAL_PAUSE, settle_sec=cd.SETTLE_SEC, post_shot_sec=cd.POST_SHOT_SEC,
+                   post_shot_tap=cd.POST_SHOT_TAP,
+                   camera_dir=cd.CAMERA_DIR)
+
+def default_steps() -> dict:
+    import control_drag as cd
+    return {"FOCUS": cd.FOCUS_STEPS, "SHUTTER": cd.SHUT_STEPS, "ISO": cd.ISO_STEPS, "WB": cd.WB_STEPS}
+
+def _apply(profile: Profile, overrides: dict) -> Profile:
+    controls = dict(profile.controls)
+    fields = {}
+    for key, value in overrides.items():
+        if key in CONTROLS:
+            base = controls[key]
+            controls[key] = ControlXY(tuple(value.get("toggle", base.toggle)), tuple(value.get("track", base.track)))
+        elif key == "post_shot_tap":
+            fields[key] = tuple(value) if value else None
+        else:
+            fields[key] = value
+    return replace(profile, controls=controls, **fields)
+
+def load_profiles(path, serials) -> dict:
+    """serial -> Profile: control_drag defaults, then the file's "default", then its serial entry."""
+    profiles = {}
+    data = {}
+    if path:
+        with open(path) as f:
+            data = json.load(f)
+    base = _apply(default_profile(), data.get("default", {}))
+    for s in serials:
+        profiles[s] = _apply(base, data.get(s, {}))
+    return profiles
+
+@dataclass
+class DeviceReport:
+    serial: str
+    planned_shots: int = 0
+    shots: int = 0
+    missed: int = 0
+    moves: int = 0
+    predicted_s: float = 0.
+    wall_s: float = 0.
+    move_s: float = 0.
+    shot_s: float = 0.
+    latencies: list = field(default_factory=list)
+    error: str = None
+
+    def summary(self) -> dict:
+        d = asdict(self)
+        lat = np.asarray(self.latencies)
+        d.update(latency_mean_s=float(lat.mean()) if lat.size else None,
+                 latency_max_s=float(lat.max()) if lat.size else None)
+        del d["latencies"]
+        return d
+
+class DeviceSweep:
+    """
+    The control_drag product sweep on one Device, with its own profile and capture watcher
+    (without one, every shot is the shutter and post_shot_sec).
+    """
+
+    def __init__(self, device, profile: Profile, names, repeat=1, exposure_s=0.):
+        self.device = device
+        self.profile = profile
+        self.names = list(names)
+        self.repeat = repeat
+        self.exposure_s = exposure_s
+        self.report = DeviceReport(device.serial)
+
+    def reveal(self, name):
+        self.device.tap(*self.profile.controls[name].toggle)
+        time.sleep(self.profile.reveal_pause)
+
+    def move(self, name, n):
+        """n micro-swipes along the control's track, paced on the device in one batch."""
+        if n == 0:
+            return
+        p = self.profile
+        self.reveal(name)
+        x, y = p.controls[name].track
+        dy = p.dy_per_step if n > 0 else -p.dy_per_step
+        self.device.shell_many([f"input swipe {x} {y} {x} {y + dy} {p.swipe_ms}", f"sleep {p.step_pause}"] * abs(n))
+
+    def shoot(self, watcher):
+        if watcher:
+            return watcher.shoot(self.exposure_s)
+        self.device.shutter()
+        time.sleep(self.profile.post_shot_sec)
+        return None, None
+
+    def run(self, plan, watcher=None, verbose=False):
+        r = self.report
+        tag = f"[{r.serial}] " if r.serial else ""
+        r.planned_shots = self.repeat * sum(a[0] == "shoot" for a in plan)
+        t_start = time.perf_counter()
+        last = self.names[-1]
+        try:
+            for action in plan:
+                t0 = time.perf_counter()
+                if action[0] == "move":
+                    _, k, n, settle = action
+                    self.move(self.names[k], n)
+                    if n:
+                        last = self.names[k]
+                        r.moves += 1
+                    if settle:
+                        time.sleep(self.profile.settle_sec)
+                    r.move_s += time.perf_counter() - t0
+                elif action[0] == "sleep":
+                    time.sleep(action[1])
+                else:
+                    label = " ".join(f"{n[0]}{s:+d}" for n, s in zip(self.names, action[1]))
+                    for _ in range(self.repeat):
+                        row, latency = self.shoot(watcher)
+                        r.shots += 1
+                        if row is not None:
+                            r.latencies.append(latency)
+                        elif watcher:
+                            r.missed += 1
+                        if verbose:
+                            saved = (f"saved {row.name} after {latency:.2f}s" if row else "no file") if watcher else "shot"
+                            print(f"{tag}[{label}] {r.shots}/{r.planned_shots} {saved}")
+                        if self.profile.post_shot_tap:
+                            self.device.tap(*self.profile.post_shot_tap)
+                            time.sleep(0.1)
+                        self.reveal(last)
+                    r.shot_s += time.perf_counter() - t0
+        except Exception as e:
+            r.error = f"{type(e).__name__}: {e}"
+            if verbose:
+                traceback.print_exc()
+        r.wall_s = time.perf_counter() - t_start
+        return r
+
+def sweep_device(device, profile, steps, names, repeat=1, open_camera=True, verbose=False):
+    """Plan, run and report one device's sweep; exceptions end up in the report, not the caller."""
+    sweep = DeviceSweep(device, profile, names, repeat)
+    watcher = None
+    try:
+        plan, _, sweep.report.predicted_s = plan_sweep([steps[n] for n in names], profile.timing(), repeat)
+        if open_camera:
+            device.open_camera()
+            time.sleep(1.0)
+        watcher = CaptureWatcher(device, profile.camera_dir)
+        sweep.run(plan, watcher, verbose)
+    except Exception as e:
+        sweep.report.error = f"{type(e).__name__}: {e}"
+    finally:
+        if watcher:
+            watcher.close()
+    return sweep.report
+
+def run_all(devices, profiles, steps=None, names=CONTROLS, repeat=1, open_camera=True, verbose=False):
+    """Concurrent sweeps, one thread per device; returns the DeviceReports in device order."""
+    steps = steps or default_steps()
+    with ThreadPoolExecutor(max_workers=max(len(devices), 1)) as pool:
+        futures = [pool.submit(sweep_device, d, profiles[d.serial], steps, names, repeat, open_camera, verbose)
+                   for d in devices]
+        return [f.result() for f in futures]
+
+def report(reports, wall_s):
+    print(f"\n{'serial':<16} {'shots':>9} {'missed':>7} {'moves':>6} {'predicted[s]':>13} {'wall[s]':>8} "
+          f"{'moving[s]':>10} {'shooting[s]':>12} {'latency[s]':>11}  status")
+    for r in reports:
+        lat = f"{np.mean(r.latencies):.2f}" if r.latencies else "-"
+        print(f"{r.serial:<16} {r.shots:>4}/{r.planned_shots:<4} {r.missed:>7} {r.moves:>6} {r.predicted_s:>13.1f} "
+              f"{r.wall_s:>8.1f} {r.move_s:>10.1f} {r.shot_s:>12.1f} {lat:>11}  {r.error or 'ok'}")
+    serial_s = sum(r.wall_s for r in reports)
+    print(f"\n{len(reports)} devices in {wall_s:.1f} s (sum of per-device sweeps {serial_s:.1f} s), "
+          f"{sum(r.error is not None for r in reports)} failed")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the control_drag product sweep on several phones at once.")
+    parser.add_argument("--serials", nargs="*", default=None, help="default: every device in `adb devices`")
+    parser.add_argument("--profiles", default=None, help="JSON coordinate profiles per serial")
+    parser.add_argument("--controls", default=",".join(CONTROLS), help="controls to sweep, e.g. FOCUS,WB")
+    parser.add_argument("--repeat", type=int, default=1, help="shots per combination")
+    parser.add_argument("--fake", type=int, default=0, help="run on N simulated devices")
+    parser.add_argument("--save-latency", type=float, default=0.5, help="--fake: seconds until a shot is saved")
+    parser.add_argument("--metrics", default=None, help="write per-device metrics as JSON")
+    parser.add_argument("--estimate", action="store_true", help="print the predicted sweep time and exit")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    names = [n.strip().upper() for n in args.controls.split(",") if n.strip()]
+    unknown = [n for n in names if n not in CONTROLS]
+    if unknown or not names:
+        parser.error(f"--controls: {', '.join(unknown) or 'none given'} (choose from {', '.join(CONTROLS)})")
+    if args.fake:
+        root = tempfile.mkdtemp(prefix="fake_phones_")
+        devices = [FakeDevice(os.path.join(root, f"fake-{i}"), save_latency=args.save_latency, jitter=0.2,
+                              serial=f"fake-{i}", seed=i) for i in range(args.fake)]
+    else:
+        devices = [AdbDevice(s) for s in (args.serials or list_serials())]
+    if not devices:
+        raise SystemExit("no devices")
+    profiles = load_profiles(args.profiles, [d.serial for d in devices])
+    if args.fake:
+        for d in devices:
+            profiles[d.serial] = replace(profiles[d.serial], camera_dir=d.camera_dir)
+
+    if args.estimate:
+        steps = default_steps()
+        for d in devices:
+            p = profiles[d.serial]
+            plan, _, t = plan_sweep([steps[n] for n in names], p.timing(), args.repeat)
+            print(f"{d.serial}: {args.repeat * sum(a[0] == 'shoot' for a in plan)} shots, predicted {t:.1f} s")
+        raise SystemExit
+
+    t0 = time.perf_counter()
+    reports = run_all(devices, profiles, names=names, repeat=args.repeat, open_camera=not args.fake,
+                      verbose=args.verbose)
+    wall = time.perf_counter() - t0
+    report(reports, wall)
+    if args.metrics:
+        with open(args.metrics, "w") as f:
+            json.dump(dict(wall_s=wall, devices=[r.summary() for r in reports]), f, indent=1)
+    for d in devices:
+        if hasattr(d, "close"):
+            d.close()
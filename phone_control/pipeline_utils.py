@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_HERE, '..', 'image_conversion'))
+sys.path.append(os.path.join(_HERE, '..'))
+sys.path.insert(0, os.path.join(_HERE, '..', 'segmentation'))
+
+from device_utils import CAMERA_DIR, AdbDevice, FakeDevice, MediaRow, wait_for_new_image
+import instrument_utils  # CAPILLARY_PROFILE: the run is owned here, not by the first pool worker
+
+# Streaming capture-to-analysis: every capture is handed to the pipeline as soon as MediaStore
+# publishes it. A pull thread copies it from the device while the next shot is being taken and
+# feeds a worker pool that converts, flat-fields and segments it. Both hand-offs are bounded
+# (max_queued captures waiting for a pull, max_in_flight frames in the pool), so when analysis
+# falls behind, submit() blocks and the capture loop slows down instead of piling up frames.
+
+@dataclass
+class Capture:
+    row: MediaRow
+    label: str = ''
+    t_saved: float = 0.        # perf_counter when the capture was submitted
+    local: str = None
+    result: dict = None
+    error: str = None
+    timings: dict = field(default_factory=dict)
+
+def analyze_frame(path, green='half', sigma=50, detect=True, workers=1):
+    """
+    Default analysis of one capture: DNG -> green TIFF (convert_green), flat field
+    (<name>_BS.tif) and capillary detection (capillary index next to it).
+    TIFF captures skip the conversion.
+    """
+    t = {}
+    t0 = time.perf_counter()
+    if path.lower().endswith('.dng'):
+        from convert_image import convert_green
+        tif = convert_green(path, mode=green)
+        if tif is None:
+            raise RuntimeError(f'conversion failed: {path}')
+    else:
+        tif = path
+    t['convert_s'] = time.perf_counter() - t0
+    from background_utils import flat_field_file
+    t0 = time.perf_counter()
+    corrected = flat_field_file(tif, sigma=sigma)
+    t['flat_field_s'] = time.perf_counter() - t0
+    out = dict(tif=tif, corrected=corrected, timings=t)
+    if detect:
+        from detection_utils import detect_capillaries
+        t0 = time.perf_counter()
+        index_path = os.path.splitext(corrected)[0] + '_index.json'
+        index = detect_capillaries(corrected, workers=workers, index_path=index_path)
+        t['detect_s'] = time.perf_counter() - t0
+        out.update(index=index_path, n_capillaries=len(index['capillaries']))
+    return out
+
+class CapturePipeline:
+    """
+    Pull + analysis stages fed by submit(row) from the capture loop.
+    analyze(local_path, **analyze_kwargs) runs in a process pool (executor='process') or a
+    thread pool ('thread', for light analyses); it must be a module-level function.
+    on_result(capture) is called from the pipeline threads as captures finish.
+    """
+
+    def __init__(self, device, out_dir, analyze=analyze_frame, analyze_kwargs=None, max_queued=4,
+                 pull_workers=1, workers=None, max_in_flight=None, executor='process', on_result=None):
+        self.device = device
+        self.out_dir = out_dir
+        self.analyze = analyze
+        self.analyze_kwargs = dict(analyze_kwargs or {})
+        self.on_result = on_result
+        os.makedirs(out_dir, exist_ok=True)
+        workers = workers or os.cpu_count() or 1
+        Pool = ProcessPoolExecutor if executor == 'process' else ThreadPoolExecutor
+        self._pool = Pool(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(max_in_flight or workers)
+        self._pull_q = queue.Queue(maxsize=max_queued)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._idle = threading.Condition(self._lock)
+        self.captures: list[Capture] = []
+        self.blocked_s = 0.     # time submit() waited on a full queue (backpressure)
+        self._pullers = [threading.Thread(target=self._pull_loop, daemon=True) for _ in range(pull_workers)]
+        for t in self._pullers:
+            t.start()
+
+    def submit(self, row: MediaRow, label=''):
+        """Queue a published capture; blocks while max_queued captures wait for a pull."""
+        cap = Capture(row, label, time.perf_counter())
+        with self._lock:
+            self.captures.append(cap)
+            self._pending += 1
+        t0 = time.perf_counter()
+        self._pull_q.put(cap)
+        self.blocked_s += time.perf_counter() - t0
+        return cap
+
+    def _pull_loop(self):
+        while True:
+            cap = self._pull_q.get()
+            if cap is None:
+                return
+            t0 = time.perf_counter()
+            try:
+                cap.local = self.device.pull(cap.row.path, os.path.join(self.out_dir, cap.row.name))
+            except Exception as e:
+                cap.error = f'pull: {e}'
+                self._finish(cap)
+                continue
+            cap.timings['pull_s'] = time.perf_counter() - t0
+            # at most max_in_flight frames decoded at once; waiting here backs up the pull queue
+            self._slots.acquire()
+            cap.timings['queued_s'] = time.perf_counter() - cap.t_saved - cap.timings['pull_s']
+            try:
+                fut = self._pool.submit(_timed, self.analyze, cap.local, self.analyze_kwargs)
+            except Exception as e:
+                self._slots.release()
+                cap.error = f'submit: {e}'
+                self._finish(cap)
+                continue
+            fut.add_done_callback(lambda f, cap=cap: self._analyzed(cap, f))
+
+    def _analyzed(self, cap, fut):
+        self._slots.release()
+        try:
+            cap.result, cap.timings['analyze_s'] = fut.result()
+        except Exception as e:
+            cap.error = f'analyze: {e}'
+        self._finish(cap)
+
+    def _finish(self, cap):
+        cap.timings['latency_s'] = time.perf_counter() - cap.t_saved
+        try:
+            if self.on_result:
+                self.on_result(cap)
+        except Exception as e:
+            # runs on a pipeline thread / future callback: keep the error, never skip the count
+            cap.error = f'{cap.error}; on_result: {e}' if cap.error else f'on_result: {e}'
+        finally:
+            with self._idle:
+                self._pending -= 1
+                self._idle.notify_all()
+
+    def join(self):
+        """Wait until every submitted capture is analyzed."""
+        with self._idle:
+            self._idle.wait_for(lambda: self._pending == 0)
+
+    def close(self):
+        self.join()
+        for _ in self._pullers:
+            self._pull_q.put(None)
+        for t in self._pullers:
+            t.join()
+        self._pool.shutdown()
+        return self.captures
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def _timed(func, path, kwargs):
+    t0 = time.perf_counter()
+    out = func(path, **kwargs)
+    return out, time.perf_counter() - t0
+
+def capture_session(device, pipeline, n_shots, timeout_s=None, poll_s=0.25, interval_s=0., watcher=None):
+    """
+    Shoot n_shots, handing every saved capture to the pipeline; returns the timed-out shots.
+    With a capture_utils.CaptureWatcher shots resolve on file events (adaptive timeout unless
+    timeout_s is given), otherwise by polling MediaStore (timeout_s, default 10 s).
+    """
+    missed = []
+    prev = None if watcher else device.latest_image_row()
+    for i in range(n_shots):
+        if watcher:
+            cur, _ = watcher.shoot(timeout_s=timeout_s)
+        else:
+            device.shutter()
+            cur = wait_for_new_image(device, prev.id if prev else None, timeout_s=timeout_s or 10.0,
+                                     poll_s=poll_s)
+        if cur is None:
+            print(f'  ! shot {i + 1}: timed out')
+            missed.append(i)
+            continue
+        pipeline.submit(cur, label=f'shot {i + 1}')
+        prev = cur
+        if interval_s:
+            time.sleep(interval_s)
+    return missed
+
+def report(captures, wall_s):
+    ok = [c for c in captures if c.error is None]
+    print(f"\n{'file':<22} {'pull[s]':>8} {'queued[s]':>9} {'analyze[s]':>10} {'latency[s]':>10}")
+    for c in captures:
+        t = c.timings
+        status = f'  FAILED ({c.error})' if c.error else ''
+        print(f"{c.row.name:<22} {t.get('pull_s', float('nan')):>8.2f} {t.get('queued_s', float('nan')):>9.2f} "
+              f"{t.get('analyze_s', float('nan')):>10.2f} {t.get('latency_s', float('nan')):>10.2f}{status}")
+    busy = sum(c.timings.get('analyze_s', 0) for c in ok)
+    print(f"\n{len(ok)}/{len(captures)} analyzed in {wall_s:.1f} s (analysis time {busy:.1f} s, "
+          f"overlapped with capture)")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Capture and analyze frames as the phone saves them.')
+    parser.add_argument('out_dir', help='local folder for pulled captures and results')
+    parser.add_argument('--shots', type=int, default=5)
+    parser.add_argument('--serial', default=None, help='adb serial (default: the only device)')
+    parser.add_argument('--fake', action='store_true', help='run against a simulated device')
+    parser.add_argument('--save-latency', type=float, default=0.5, help='--fake: seconds until a shot is saved')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--max-queued', type=int, default=4)
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='seconds to wait for each shot (default: adaptive when watching, 10 when polling)')
+    parser.add_argument('--no-detect', action='store_true', help='convert and flat-field only')
+    parser.add_argument('--poll', action='store_true', help='poll MediaStore instead of watching the camera folder')
+    args = parser.parse_args()
+
+    if args.fake:
+        device = FakeDevice(tempfile.mkdtemp(prefix='fake_phone_'), save_latency=args.save_latency)
+    else:
+        device = AdbDevice(args.serial)
+        device.open_camera()
+        time.sleep(1.0)
+    watcher = None
+    if not args.poll:
+        from capture_utils import CaptureWatcher
+        watcher = CaptureWatcher(device, device.camera_dir if args.fake else CAMERA_DIR)
+    t0 = time.perf_counter()
+    with CapturePipeline(device, args.out_dir, analyze_kwargs=dict(detect=not args.no_detect),
+                         workers=args.workers, max_queued=args.max_queued) as pipe:
+        capture_session(device, pipe, args.shots, timeout_s=args.timeout, watcher=watcher)
+    if watcher:
+        watcher.close()
+    report(pipe.captures, time.perf_counter() - t0)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+import itertools
+from dataclasses import dataclass
+
+# Sweep planning for control_drag's product mode. A plan is a list of actions
+#   ('move', axis, n_steps, settle)   micro-swipe one control by n steps, then SETTLE_SEC if settle
+#   ('shoot', combo)                   take REPEAT_SHOTS shots at combo (step offsets, control order)
+#   ('sleep', seconds)
+# that the estimator prices and orchestrate_utils.DeviceSweep executes (for control_drag and
+# multi-phone sweeps alike). The planned order walks the combinations along a reflected (snake)
+# Gray code, so consecutive combos differ in one control by one step, and it moves from the
+# current slider state instead of undoing every combo back to baseline.
+
+@dataclass
+class Timing:
+    """Seconds per UI action, from control_drag's Motion / Timing settings."""
+    swipe_s: float = 0.06        # SWIPE_MS / 1000, `input swipe` blocks for its duration
+    step_pause_s: float = 0.06   # STEP_PAUSE
+    reveal_s: float = 0.25       # REVEAL_PAUSE after the toggle tap
+    settle_s: float = 0.5        # SETTLE_SEC
+    shot_s: float = 1.05         # shutter + POST_SHOT_SEC (or save latency) + post-shot tap + re-show
+    cmd_s: float = 0.01          # per adb command (persistent shell; ~0.1 s with one adb process each)
+
+    def move_s(self, n, settle=True):
+        t = self.reveal_s + self.cmd_s + abs(n) * (self.swipe_s + self.step_pause_s + self.cmd_s) if n else 0.
+        return t + (self.settle_s if settle else 0.)
+
+def snake_order(sizes):
+    """
+    Index tuples of the product of range(n) for n in sizes, in reflected mixed-radix Gray order:
+    the last axis varies fastest and reverses direction on every pass.
+    """
+    order = [()]
+    for n in sizes:
+        order = [prefix + (j,) for i, prefix in enumerate(order)
+                 for j in (range(n) if i % 2 == 0 else range(n - 1, -1, -1))]
+    return order
+
+def baseline_plan(axes):
+    """control_drag's original product loop: absolute moves from baseline, undone after every combo."""
+    plan = []
+    for combo in itertools.product(*axes):
+        plan += [('move', k, s, True) for k, s in enumerate(combo)]
+        plan.append(('shoot', combo))
+        plan += [('move', k, -s, False) for k, s in reversed(list(enumerate(combo)))]
+        plan.append(('sleep', 0.15))
+    return plan
+
+def state_plan(axes, nesting):
+    """
+    Combos in snake order with axes nested as given (nesting[-1] varies fastest); every move is
+    the difference to the current slider state, and the sweep ends back at baseline.
+    """
+    state = [0] * len(axes)
+    plan = []
+    for idx in snake_order([len(axes[k]) for k in nesting]):
+        combo = [0] * len(axes)
+        for k, i in zip(nesting, idx):
+            combo[k] = axes[k][i]
+        for k, s in enumerate(combo):
+            if s != state[k]:
+                plan.append(('move', k, s - state[k], True))
+                state[k] = s
+        plan.append(('shoot', tuple(combo)))
+    plan += [('move', k, -s, False) for k, s in enumerate(state) if s]
+    return plan
+
+def plan_sweep(axes, timing=None, repeat=1):
+    """Cheapest state_plan over all axis nestings; returns (plan, nesting, predicted seconds)."""
+    timing = timing or Timing()
+    best = None
+    for nesting in itertools.permutations(range(len(axes))):
+        plan = state_plan(axes, nesting)
+        t = estimate(plan, timing, repeat)
+        if best is None or t < best[2]:
+            best = (plan, nesting, t)
+    return best
+
+def estimate(plan, timing=None, repeat=1):
+    """Predicted wall time of a plan in seconds."""
+    timing = timing or Timing()
+    t = 0.
+    for a in plan:
+        if a[0] == 'move':
+            t += timing.move_s(a[2], a[3])
+        elif a[0] == 'shoot':
+            t += repeat * timing.shot_s
+        else:
+            t += a[1]
+    return t
+
+def summarize(plan, timing=None, repeat=1):
+    """Counts and predicted time of a plan, for the dry-run report."""
+    moves = [a for a in plan if a[0] == 'move' and a[2]]
+    return dict(combos=sum(a[0] == 'shoot' for a in plan), shots=repeat * sum(a[0] == 'shoot' for a in plan),
+                moves=len(moves), steps=sum(abs(a[2]) for a in moves),
+                seconds=estimate(plan, timing, repeat))
+
+def format_summary(name, s):
+    m, sec = divmod(s['seconds'], 60)
+    return (f"{name:>9}: {s['combos']} combos, {s['shots']} shots, {s['moves']} moves / {s['steps']} steps, "
+            f"predicted {int(m)}m{sec:04.1f}s")
+
+if __name__ == '__main__':
+    import control_drag as cd
+    axes = [cd.FOCUS_STEPS, cd.SHUT_STEPS, cd.ISO_STEPS, cd.WB_STEPS]
+    timing = cd.sweep_timing()
+    base = summarize(baseline_plan(axes), timing, cd.REPEAT_SHOTS)
+    plan, nesting, _ = plan_sweep(axes, timing, cd.REPEAT_SHOTS)
+    snake = summarize(plan, timing, cd.REPEAT_SHOTS)
+    print(format_summary('baseline', base))
+    print(format_summary('snake', snake))
+    print(f"nesting (slowest -> fastest): {[('FOCUS', 'SHUTTER', 'ISO', 'WB')[k] for k in nesting]}, "
+          f"{base['seconds'] / snake['seconds']:.1f}x faster")
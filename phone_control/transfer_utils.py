@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+import argparse
+import hashlib
+import multiprocessing
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_HERE, '..', 'image_conversion'))
+sys.path.append(os.path.join(_HERE, '..'))
+
+from batch_convert import load_manifest, save_manifest
+from capture_utils import RAW_EXTENSIONS, CaptureWatcher
+from device_utils import CAMERA_DIR, AdbDevice, FakeDevice, sdcard_path
+import instrument_utils  # imported here so a CAPILLARY_PROFILE run belongs to this process
+
+# Transfer stage: captures stream off the phone as they appear (file events, after a MediaStore
+# listing that catches up on anything saved while no session was running) through
+# `adb exec-out cat` into memory. Several pulls run at once; every file is hashed (sha256) and
+# written once, and DNGs go from those same bytes to convert_green in a process pool, so nothing
+# is read back from disk. out_dir/.transfer_manifest.json records each finished file (keyed by
+# its /sdcard path, whichever storage alias reported it), and an interrupted session resumes
+# by skipping what it lists.
+
+MANIFEST_NAME = '.transfer_manifest.json'
+
+def _convert(local, data, mode):
+    from convert_image import convert_green
+    t0 = time.perf_counter()
+    out = convert_green(local, mode=mode, data=data)
+    return out, time.perf_counter() - t0
+
+class TransferStage:
+    """
+    submit(remote_path) queues a device file; pull_workers threads read it with
+    device.read_bytes, skip contents already transferred under another name, write it to
+    out_dir and (convert=True) hand DNG bytes to the conversion pool. At most max_in_flight
+    decoded files are held at once; pulls wait for a slot.
+    """
+
+    def __init__(self, device, out_dir, pull_workers=3, convert=True, workers=None, mode='half',
+                 max_in_flight=None, manifest_path=None):
+        self.device = device
+        self.out_dir = out_dir
+        self.convert = convert
+        self.mode = mode
+        os.makedirs(out_dir, exist_ok=True)
+        self.manifest_path = manifest_path or os.path.join(out_dir, MANIFEST_NAME)
+        self.manifest = load_manifest(self.manifest_path)
+        self._by_hash = {e['sha256']: remote for remote, e in self.manifest.items() if 'duplicate_of' not in e}
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._pending = 0
+        self.records = []
+        self.skipped = 0
+        workers = workers or os.cpu_count() or 1
+        # spawn: the parent runs pull threads, and rawpy's OpenMP is not fork-safe
+        self._pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) \
+            if convert else None
+        self._slots = threading.BoundedSemaphore(max_in_flight or workers)
+        self._pull_q = queue.Queue()
+        self._pullers = [threading.Thread(target=self._pull_loop, daemon=True) for _ in range(pull_workers)]
+        for t in self._pullers:
+            t.start()
+
+    def entry(self, remote):
+        """Manifest entry of a file; a duplicate resolves to the local copy and output of its original."""
+        e = self.manifest.get(sdcard_path(remote))
+        if e is not None and e.get('duplicate_of'):
+            first = self.manifest.get(e['duplicate_of'], {})
+            e = dict(e, local=first.get('local'), output=first.get('output'))
+        return e
+
+    def is_done(self, remote):
+        """Transferred (and converted, for DNGs) in this or an earlier session; duplicates once their original is."""
+        remote = sdcard_path(remote)
+        e = self.manifest.get(remote)
+        if e is not None and e.get('duplicate_of'):
+            return self.is_done(e['duplicate_of'])
+        if e is None or not e.get('local') or not os.path.exists(e['local']):
+            return False
+        return not self._wants_convert(remote) or (e.get('output') is not None and os.path.exists(e['output']))
+
+    def _wants_convert(self, remote):
+        return self.convert and remote.lower().endswith('.dng')
+
+    def submit(self, remote):
+        """Queue a device file; False if it is done already or queued in this session."""
+        remote = sdcard_path(remote)
+        with self._lock:
+            if remote in self._queued:
+                return False
+            self._queued.add(remote)
+            if self.is_done(remote):
+                self.skipped += 1
+                return False
+            self._pending += 1
+        self._pull_q.put(remote)
+        return True
+
+    def _pull_loop(self):
+        while True:
+            remote = self._pull_q.get()
+            if remote is None:
+                return
+            rec = dict(remote=remote, local=None, output=None, mbytes=0., pull_s=0., convert_s=0.,
+                       duplicate_of=None, error=None)
+            t0 = time.perf_counter()
+            try:
+                data = self.device.read_bytes(remote)
+            except Exception as e:
+                rec['error'] = f'pull: {e}'
+                self._finish(rec)
+                continue
+            rec['pull_s'] = time.perf_counter() - t0
+            rec['mbytes'] = len(data) / 1e6
+            rec['sha256'] = digest = hashlib.sha256(data).hexdigest()
+            with self._lock:
+                first = self._by_hash.setdefault(digest, remote)
+            if first != remote:
+                rec['duplicate_of'] = first
+                self._finish(rec)
+                continue
+            rec['local'] = local = os.path.join(self.out_dir, os.path.basename(remote))
+            try:
+                tmp = local + '.part'
+                with open(tmp, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp, local)
+            except OSError as e:
+                rec['error'] = f'write: {e}'
+                with self._lock:
+                    del self._by_hash[digest]
+                self._finish(rec)
+                continue
+            if not self._wants_convert(remote):
+                self._finish(rec)
+                continue
+            self._slots.acquire()
+            try:
+                fut = self._pool.submit(_convert, local, data, self.mode)
+            except Exception as e:
+                # e.g. BrokenProcessPool after a crashed worker: fail this file, keep the slot count right
+                self._slots.release()
+                rec['error'] = f'submit: {e}'
+                with self._lock:
+                    del self._by_hash[digest]
+                self._finish(rec)
+                continue
+            del data
+            fut.add_done_callback(lambda f, rec=rec: self._converted(rec, f))
+
+    def _converted(self, rec, fut):
+        self._slots.release()
+        try:
+            rec['output'], rec['convert_s'] = fut.result()
+            if rec['output'] is None:
+                rec['error'] = 'convert failed'
+        except Exception as e:
+            rec['error'] = f'convert: {e}'
+        self._finish(rec)
+
+    def _finish(self, rec):
+        with self._idle:
+            self.records.append(rec)
+            if rec['error'] is None:
+                if rec['duplicate_of']:
+                    # the original may still be converting: its paths are looked up in entry()
+                    entry = dict(sha256=rec['sha256'], mbytes=rec['mbytes'], pull_s=rec['pull_s'],
+                                 duplicate_of=rec['duplicate_of'])
+                else:
+                    entry = {k: rec[k] for k in ('sha256', 'local', 'output', 'mbytes', 'pull_s', 'convert_s')}
+                self.manifest[rec['remote']] = entry
+                save_manifest(self.manifest, self.manifest_path)
+            self._pending -= 1
+            self._idle.notify_all()
+
+    def join(self):
+        with self._idle:
+            self._idle.wait_for(lambda: self._pending == 0)
+
+    def close(self):
+        self.join()
+        for _ in self._pullers:
+            self._pull_q.put(None)
+        for t in self._pullers:
+            t.join()
+        if self._pool:
+            self._pool.shutdown()
+        return self.records
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def follow(device, stage, folder=CAMERA_DIR, duration_s=60., extensions=RAW_EXTENSIONS, poll_s=1.0):
+    """
+    Submit every image of folder already in MediaStore, then each new file as it lands, for
+    duration_s. The listener starts before the listing so no file falls in between; if it
+    dies, new MediaStore rows are polled instead.
+    """
+    extensions = tuple(e.lower() for e in extensions)
+    folder = sdcard_path(folder.rstrip('/'))
+
+    def wanted(row):
+        # MediaStore lists every image on the phone: only this folder's (not its subfolders)
+        return row.name.lower().endswith(extensions) and os.path.dirname(sdcard_path(row.path)) == folder
+
+    watcher = CaptureWatcher(device, folder, extensions)
+    rows = device.new_images(None)
+    last_id = rows[-1].id if rows else None
+    for row in rows:
+        if wanted(row):
+            stage.submit(row.path)
+    end = time.perf_counter() + duration_s
+    try:
+        while (left := end - time.perf_counter()) > 0:
+            if watcher.alive:
+                row, _ = watcher.wait(min(left, 1.0))
+                rows = [row] if row else []
+            else:
+                time.sleep(min(left, poll_s))
+                rows = device.new_images(last_id)
+                last_id = rows[-1].id if rows else last_id
+            for row in rows:
+                if wanted(row):
+                    stage.submit(row.path)
+    finally:
+        watcher.close()
+
+def report(stage, wall_s):
+    recs = stage.records
+    ok = [r for r in recs if r['error'] is None and not r['duplicate_of']]
+    dup = [r for r in recs if r['duplicate_of']]
+    failed = [r for r in recs if r['error']]
+    print(f"\n{'file':<24} {'MB':>7} {'pull[s]':>8} {'convert[s]':>10}  status")
+    for r in recs:
+        status = r['error'] or (f"duplicate of {os.path.basename(r['duplicate_of'])}" if r['duplicate_of'] else 'ok')
+        print(f"{os.path.basename(r['remote']):<24} {r['mbytes']:>7.1f} {r['pull_s']:>8.2f} {r['convert_s']:>10.2f}  {status}")
+    mb = sum(r['mbytes'] for r in ok)
+    pull_s = sum(r['pull_s'] for r in ok)
+    print(f"\n{len(ok)} transferred, {len(dup)} duplicates, {stage.skipped} skipped (manifest), {len(failed)} failed "
+          f"in {wall_s:.1f} s")
+    if ok and pull_s > 0:
+        print(f"{mb:.1f} MB, {mb / wall_s:.1f} MB/s overall ({mb / pull_s:.1f} MB/s per pull)")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stream captures off the phone as they are saved and convert them.')
+    parser.add_argument('out_dir', help='local folder for the transferred files (and the resume manifest)')
+    parser.add_argument('--serial', default=None, help='adb serial (default: the only device)')
+    parser.add_argument('--folder', default=CAMERA_DIR, help='device folder to watch')
+    parser.add_argument('--duration', type=float, default=60., help='seconds to keep watching for new files')
+    parser.add_argument('--pull-workers', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=None, help='conversion processes')
+    parser.add_argument('--mode', choices=['half', 'full'], default='half', help='convert_green mode')
+    parser.add_argument('--no-convert', action='store_true', help='transfer only')
+    parser.add_argument('--fake', type=int, default=0, help='simulated device taking N DNG shots meanwhile')
+    args = parser.parse_args()
+
+    if args.fake:
+        device = FakeDevice(tempfile.mkdtemp(prefix='fake_phone_'), save_latency=0.3, raw=True, pull_rate_mb_s=20)
+        args.folder = device.camera_dir
+
+        def shoot():
+            for _ in range(args.fake):
+                device.shutter()
+                time.sleep(0.5)
+        threading.Thread(target=shoot, daemon=True).start()
+    else:
+        device = AdbDevice(args.serial)
+    t0 = time.perf_counter()
+    with TransferStage(device, args.out_dir, pull_workers=args.pull_workers, convert=not args.no_convert,
+                       workers=args.workers, mode=args.mode) as stage:
+        follow(device, stage, args.folder, args.duration)
+    report(stage, time.perf_counter() - t0)
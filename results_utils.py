@@ -0,0 +1,276 @@
+import argparse
+import glob
+import json
+import os
+import uuid
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# Columnar results store: one Parquet dataset per table under a store root, hive-partitioned
+# by session (<root>/<table>/session=<session>/part-*.parquet). Writers never touch existing
+# files: every append writes a new uniquely named part (temp file + rename), so parallel
+# workers can append to the same table and session without locks. Reads go through
+# pyarrow.dataset, so column selection and filters are pushed down to the partition and
+# row-group level (session filters skip whole directories).
+
+TABLES = ('captures', 'crops', 'profiles', 'velocities', 'mtf')
+
+SCHEMAS = {
+    # one row per captured / converted frame
+    'captures': pa.schema([
+        ('image', pa.string()),          # frame id, e.g. the DNG / TIFF file name
+        ('path', pa.string()),
+        ('device', pa.string()),         # adb serial
+        ('captured_at', pa.timestamp('ms')),
+        ('focus', pa.float64()),
+        ('shutter', pa.float64()),
+        ('iso', pa.float64()),
+        ('wb', pa.float64()),
+        ('height', pa.int64()),
+        ('width', pa.int64()),
+        ('sha256', pa.string()),
+    ]),
+    # crop boxes (crop_coords.json and the capillaries of a detection index)
+    'crops': pa.schema([
+        ('image', pa.string()),
+        ('capillary', pa.int64()),
+        ('y_min', pa.int64()),
+        ('y_max', pa.int64()),
+        ('x_min', pa.int64()),
+        ('x_max', pa.int64()),
+        ('area', pa.int64()),
+        ('source', pa.string()),         # file the box came from
+    ]),
+    # concentration/profile_utils.profile_table (columns of the MATLAB CSVs)
+    'profiles': pa.schema([
+        ('Image', pa.string()),
+        ('Capillary', pa.int64()),
+        ('Sample', pa.int64()),
+        ('Dist_px', pa.float64()),
+        ('Dist_um', pa.float64()),
+        ('MeanIntensity', pa.float64()),
+        ('StdIntensity', pa.float64()),
+        ('BG_Poly', pa.float64()),
+        ('BG_Spline', pa.float64()),
+        ('BG_LinearInterp', pa.float64()),
+        ('Corr_Poly', pa.float64()),
+        ('Corr_Spline', pa.float64()),
+        ('Corr_LinearInterp', pa.float64()),
+        ('Lines', pa.list_(pa.float64())),
+    ]),
+    # kymograph_radon_transform output, one row per (line, dist, time) window
+    'velocities': pa.schema([
+        ('image', pa.string()),          # video / frame folder
+        ('capillary', pa.int64()),
+        ('line', pa.int64()),            # index of the parallel line (kymograph)
+        ('dist', pa.int64()),            # first pixel of the distance window
+        ('time', pa.int64()),            # first frame of the time window
+        ('velocity', pa.float64()),      # px / frame
+    ]),
+    # slanted-edge MTF results (*_MTFresults.mat)
+    'mtf': pa.schema([
+        ('image', pa.string()),
+        ('res_smoothed_um', pa.float64()),
+        ('res_fit_um', pa.float64()),
+        ('res_raw_um', pa.float64()),
+        ('lpmm_smoothed', pa.float64()),
+        ('lpmm_fit', pa.float64()),
+        ('lpmm_raw', pa.float64()),
+        ('angle_deg', pa.float64()),
+        ('freq', pa.list_(pa.float64())),   # lp/mm
+        ('mtf', pa.list_(pa.float64())),
+        ('source', pa.string()),
+    ]),
+}
+
+PARTITIONING = ds.partitioning(pa.schema([('session', pa.string())]), flavor='hive')
+
+def table_schema(table):
+    if table not in SCHEMAS:
+        raise ValueError(f"unknown table '{table}', expected one of {TABLES}")
+    return SCHEMAS[table]
+
+def to_arrow(table, records):
+    """ records (DataFrame, dict of columns or list of dicts) -> pa.Table in the table's schema """
+    schema = table_schema(table)
+    if isinstance(records, pa.Table):
+        df = records.to_pandas()
+    elif isinstance(records, pd.DataFrame):
+        df = records
+    else:
+        df = pd.DataFrame(records)
+    extra = set(df.columns) - set(schema.names)
+    if extra:
+        raise ValueError(f"columns {sorted(extra)} are not in the '{table}' schema")
+    cols = {}
+    for field in schema:
+        if field.name not in df:
+            cols[field.name] = pa.nulls(len(df), field.type)
+        elif pa.types.is_list(field.type):
+            cols[field.name] = pa.array([None if v is None else np.asarray(v, np.float64) for v in df[field.name]],
+                                        field.type)
+        else:
+            cols[field.name] = pa.array(df[field.name], field.type, from_pandas=True)
+    return pa.Table.from_pydict(cols, schema=schema)
+
+def _session_dir(root, table, session):
+    return os.path.join(root, table, f'session={session}')
+
+def append(root, table, records, session='default', row_group_size=64 * 1024):
+    """
+    Append records to a table as a new part file; safe from several processes at once.
+    Returns the part path (None if there were no rows).
+    """
+    data = to_arrow(table, records)
+    if data.num_rows == 0:
+        return None
+    part_dir = _session_dir(root, table, session)
+    os.makedirs(part_dir, exist_ok=True)
+    name = f'part-{uuid.uuid4().hex}.parquet'
+    tmp = os.path.join(part_dir, '.' + name + '.tmp')
+    pq.write_table(data, tmp, row_group_size=row_group_size)
+    path = os.path.join(part_dir, name)
+    os.replace(tmp, path)
+    return path
+
+def dataset(root, table):
+    """ pyarrow dataset of a table (all sessions); hidden temp files of running writers are ignored """
+    return ds.dataset(os.path.join(root, table), format='parquet', partitioning=PARTITIONING,
+                      schema=table_schema(table).append(pa.field('session', pa.string())))
+
+def _expression(filters):
+    if filters is None or isinstance(filters, ds.Expression):
+        return filters
+    return pq.filters_to_expression(filters)
+
+def query(root, table, columns=None, filters=None, sessions=None, as_pandas=True):
+    """
+    Read a table with projection and predicate pushdown.
+    filters: pyarrow expression (ds.field('Capillary') == 3) or DNF tuples
+             [('Capillary', '==', 3), ('Dist_um', '<', 20)]
+    sessions: restrict to these sessions (pruned by directory, files are not opened)
+    """
+    if not os.path.isdir(os.path.join(root, table)):
+        empty = table_schema(table).append(pa.field('session', pa.string())).empty_table()
+        empty = empty.select(columns) if columns else empty
+        return empty.to_pandas() if as_pandas else empty
+    expr = _expression(filters)
+    if sessions is not None:
+        sessions = [sessions] if isinstance(sessions, str) else list(sessions)
+        in_sessions = ds.field('session').isin(sessions)
+        expr = in_sessions if expr is None else expr & in_sessions
+    out = dataset(root, table).to_table(columns=columns, filter=expr)
+    return out.to_pandas() if as_pandas else out
+
+def sessions(root, table):
+    part_root = os.path.join(root, table)
+    if not os.path.isdir(part_root):
+        return []
+    return sorted(d.split('=', 1)[1] for d in os.listdir(part_root) if d.startswith('session='))
+
+def compact(root, table, session, row_group_size=64 * 1024):
+    """
+    Merge the part files of one session into a single file (run when no writer is active
+    on that session). Returns the number of files merged.
+    """
+    part_dir = _session_dir(root, table, session)
+    parts = sorted(glob.glob(os.path.join(part_dir, 'part-*.parquet')))
+    if len(parts) < 2:
+        return len(parts)
+    merged = pa.concat_tables([pq.read_table(p, schema=table_schema(table)) for p in parts])
+    name = f'part-{uuid.uuid4().hex}.parquet'
+    tmp = os.path.join(part_dir, '.' + name + '.tmp')
+    pq.write_table(merged, tmp, row_group_size=row_group_size)
+    os.replace(tmp, os.path.join(part_dir, name))
+    for p in parts:
+        os.remove(p)
+    return len(parts)
+
+# --- converters from the existing outputs ---
+
+def crop_records(coords, image=None, source=None):
+    """ crops rows from crop_coords.json ({y_min, ...}) or a detection index ({'capillaries': [...]}) """
+    caps = coords['capillaries'] if 'capillaries' in coords else [dict(coords, id=0)]
+    image = image if image is not None else coords.get('image')
+    return [dict(image=image, capillary=c['id'], y_min=c['y_min'], y_max=c['y_max'], x_min=c['x_min'],
+                 x_max=c['x_max'], area=c.get('area'), source=source) for c in caps]
+
+def velocity_records(vs_spacing, dist_step, time_step, image=None, capillary=0, line=0):
+    """ long-format rows of kymograph_radon_transform output (list over dist of arrays over time) """
+    vs = np.asarray(vs_spacing, np.float64)
+    dist, time = np.meshgrid(np.arange(vs.shape[0]) * dist_step, np.arange(vs.shape[1]) * time_step, indexing='ij')
+    return dict(image=np.full(vs.size, image, dtype=object), capillary=np.full(vs.size, capillary),
+                line=np.full(vs.size, line), dist=dist.ravel(), time=time.ravel(), velocity=vs.ravel())
+
+def profile_records(csv_path, image=None):
+    """ profiles rows from intensity_profile_corrected_all.csv-style CSVs """
+    df = pd.read_csv(csv_path)
+    df = df[[c for c in SCHEMAS['profiles'].names if c in df]]
+    if 'Image' not in df:
+        df.insert(0, 'Image', image or os.path.basename(csv_path))
+    if 'Capillary' not in df:
+        df.insert(1, 'Capillary', 0)
+    return df
+
+def _scalar(data, key):
+    return float(np.asarray(data[key]).ravel()[0]) if key in data else None
+
+def mtf_record(mat_path):
+    """ mtf row of one *_MTFresults.mat (resolutions in mm in the file, um in the store) """
+    from scipy.io import loadmat
+    data = loadmat(mat_path)
+    res = {k: _scalar(data, f'Resolution_{k}') for k in ('smoothed', 'fit', 'raw')}
+    rec = dict(image=os.path.basename(mat_path).replace('_MTFresults.mat', ''), source=os.path.abspath(mat_path))
+    for k, v in res.items():
+        rec[f'res_{k}_um'] = None if v is None else v * 1e3
+        rec[f'lpmm_{k}'] = None if not v else 1 / (2 * v)
+    rec['angle_deg'] = _scalar(data, 'Angle_degrees')
+    for key, col in (('freq', 'freq'), ('MTF', 'mtf')):
+        rec[col] = np.asarray(data[key], np.float64).ravel() if key in data else None
+    return rec
+
+def import_mtf_folder(root, folder, session='default'):
+    """
+    *_MTFresults.mat of a folder as one part (the read_mtf.ipynb loop); files whose source is
+    already stored in the session are skipped, so re-running picks up only new results.
+    Returns the part path, or None when there was nothing new.
+    """
+    mats = sorted(os.path.abspath(p) for p in glob.glob(os.path.join(folder, '*_MTFresults.mat')))
+    done = set(query(root, 'mtf', columns=['source'], sessions=session)['source'])
+    new = [p for p in mats if p not in done]
+    return append(root, 'mtf', [mtf_record(p) for p in new], session) if new else None
+
+def folder_session(folder):
+    """ session name of a folder: its normalized path, e.g. images_0625/0 -> images_0625_0 """
+    return os.path.normpath(folder).strip(os.sep).replace(os.sep, '_')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import existing outputs into the results store / query it.')
+    parser.add_argument('root', help='store directory')
+    parser.add_argument('--session', default='default')
+    parser.add_argument('--mtf', nargs='*', default=[], help='folders with *_MTFresults.mat')
+    parser.add_argument('--crops', nargs='*', default=[], help='crop_coords.json or capillary_index.json files')
+    parser.add_argument('--profiles', nargs='*', default=[], help='profile CSVs or Parquet files')
+    parser.add_argument('--compact', action='store_true', help='merge the part files of the session')
+    parser.add_argument('--show', choices=TABLES, help='print a table (all sessions)')
+    args = parser.parse_args()
+
+    for folder in args.mtf:
+        print('mtf ->', import_mtf_folder(args.root, folder, args.session) or 'nothing new')
+    for path in args.crops:
+        with open(path) as f:
+            print('crops ->', append(args.root, 'crops', crop_records(json.load(f), source=os.path.abspath(path)),
+                                     args.session))
+    for path in args.profiles:
+        df = pd.read_parquet(path) if path.endswith('.parquet') else profile_records(path)
+        print('profiles ->', append(args.root, 'profiles', df, args.session))
+    if args.compact:
+        for table in TABLES:
+            if args.session in sessions(args.root, table):
+                print(f'{table}: merged {compact(args.root, table, args.session)} parts')
+    if args.show:
+        print(query(args.root, args.show))
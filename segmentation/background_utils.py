@@ -0,0 +1,248 @@
+import os
+import numpy as np
+import cv2
+import tifffile
+from scipy.ndimage import gaussian_filter
+
+from stage_utils import stage
+
+# Python port of BackgroundSubtract.py (ImageJ: Gaussian blur sigma=50 of the green plane,
+# then divide) that estimates the background on a decimated image and works tile by tile.
+
+def _tiles(shape, tile):
+    H, W = shape[:2]
+    for y0 in range(0, H, tile):
+        for x0 in range(0, W, tile):
+            yield y0, min(y0+tile, H), x0, min(x0+tile, W)
+
+def _as_plane(img, channel):
+    return img[..., channel] if img.ndim == 3 else img
+
+def block_mean(img, factor):
+    """ mean over factor x factor blocks; the last partial block is edge padded """
+    img = np.asarray(img, dtype=np.float32)
+    H, W = img.shape
+    ph, pw = -H % factor, -W % factor
+    if ph or pw:
+        img = np.pad(img, ((0, ph), (0, pw)), mode='edge')
+    return img.reshape(img.shape[0]//factor, factor, img.shape[1]//factor, factor).mean(axis=(1, 3))
+
+def decimate(img, factor, mask=None, tile=4096, channel=1):
+    """
+    Block-mean decimation of a (possibly memory-mapped) image, one tile at a time.
+    With a vessel mask, masked pixels are left out of each block mean and the fraction
+    of valid pixels per block is returned as the weight (0 = fully masked).
+    """
+    img = _as_plane(img, channel)
+    H, W = img.shape
+    tile = max(tile // factor, 1) * factor
+    small = np.zeros((-(-H // factor), -(-W // factor)), dtype=np.float32)
+    weight = np.ones_like(small)
+    for y0, y1, x0, x1 in _tiles((H, W), tile):
+        sl = (slice(y0//factor, -(-y1 // factor)), slice(x0//factor, -(-x1 // factor)))
+        block = np.asarray(img[y0:y1, x0:x1], dtype=np.float32)
+        if mask is None:
+            small[sl] = block_mean(block, factor)
+        else:
+            valid = ~np.asarray(mask[y0:y1, x0:x1], dtype=bool)
+            weight[sl] = block_mean(valid, factor)
+            small[sl] = block_mean(block * valid, factor) / np.maximum(weight[sl], 1e-6)
+    return small, weight
+
+def _line_mean(line, factor):
+    line = np.asarray(line, dtype=np.float32)
+    return np.pad(line, (0, -len(line) % factor), mode='edge').reshape(-1, factor).mean(axis=1)
+
+def edge_lines(img, factor, mask=None, channel=1):
+    """
+    Decimated first/last rows and columns and the 4 corner pixels of img (only these lines
+    are read). They pad the decimated image exactly like the 'nearest' border of a
+    full-resolution Gaussian, where every outside pixel repeats the edge pixel.
+    With a mask, returns the (value*valid, valid) pair of line sets.
+    """
+    img = _as_plane(img, channel)
+    lines = [img[0, :], img[-1, :], img[:, 0], img[:, -1]]
+    corners = [img[0, 0], img[0, -1], img[-1, 0], img[-1, -1]]
+    if mask is None:
+        return [_line_mean(l, factor) for l in lines] + [np.float32(c) for c in corners]
+    valid = [~np.asarray(m, dtype=bool) for m in (mask[0, :], mask[-1, :], mask[:, 0], mask[:, -1])]
+    vcorners = [not mask[0, 0], not mask[0, -1], not mask[-1, 0], not mask[-1, -1]]
+    num = [_line_mean(np.asarray(l, dtype=np.float32)*v, factor) for l, v in zip(lines, valid)]
+    num += [np.float32(c)*v for c, v in zip(corners, vcorners)]
+    den = [_line_mean(v, factor) for v in valid] + [np.float32(v) for v in vcorners]
+    return num, den
+
+def _pad_with_edges(small, edges, n):
+    top, bottom, left, right, tl, tr, bl, br = edges
+    out = np.pad(small, n, mode='edge')
+    out[:n, n:-n], out[-n:, n:-n] = top, bottom
+    out[n:-n, :n], out[n:-n, -n:] = left[:, None], right[:, None]
+    out[:n, :n], out[:n, -n:], out[-n:, :n], out[-n:, -n:] = tl, tr, bl, br
+    return out
+
+def estimate_background_small(small, weight, sigma, edges=None, pad=1, inpaint='normalized'):
+    """
+    Gaussian background of a decimated image, returned with pad extra blocks on every side
+    for upsample_tile. edges (from edge_lines) reproduce the full-resolution 'nearest' border.
+    Masked blocks (weight<1) are filled by normalized convolution: G(img*w) / G(w),
+    the masked Gaussian divided by the blurred mask, or first inpainted with another
+    inpaint_masked method (fully masked blocks only).
+    """
+    n = int(np.ceil(4 * sigma)) + pad
+    if weight is not None and inpaint != 'normalized':
+        small = inpaint_masked(small, weight == 0, inpaint)
+        weight, edges = None, None
+    if weight is None or np.all(weight == 1):
+        if edges is not None and len(edges) == 2:
+            edges = edges[0]   # masked edge_lines with nothing masked: the values alone
+        padded = _pad_with_edges(small, edges, n) if edges is not None else np.pad(small, n, mode='edge')
+        bg = gaussian_filter(padded, sigma, mode='nearest')
+    else:
+        if edges is not None:
+            num = _pad_with_edges(small * weight, edges[0], n)
+            den = _pad_with_edges(weight, edges[1], n)
+        else:
+            num, den = np.pad(small * weight, n, mode='edge'), np.pad(weight, n, mode='edge')
+        bg = gaussian_filter(num, sigma, mode='nearest') / np.maximum(gaussian_filter(den, sigma, mode='nearest'), 1e-6)
+    return bg[n-pad:bg.shape[0]-n+pad, n-pad:bg.shape[1]-n+pad]
+
+def _pushpull(img, valid):
+    """ push-pull fill: average valid pixels down a 2x pyramid, then pull values back up into holes """
+    if valid.all() or img.shape[0] < 2 or img.shape[1] < 2 or not valid.any():
+        return np.where(valid, img, img[valid].mean() if valid.any() else 0).astype(np.float32)
+    w = valid.astype(np.float32)
+    H, W = img.shape
+    ph, pw = H % 2, W % 2
+    vw = np.pad(img * w, ((0, ph), (0, pw)), mode='edge')
+    ww = np.pad(w, ((0, ph), (0, pw)), mode='edge')
+    w_c = block_mean(ww, 2)
+    coarse = _pushpull(block_mean(vw, 2) / np.maximum(w_c, 1e-6), w_c > 0)
+    up = cv2.resize(coarse, (W + pw, H + ph), interpolation=cv2.INTER_LINEAR)[:H, :W]
+    return (w * img + (1 - w) * up).astype(np.float32)
+
+def inpaint_masked(img, mask, method='normalized', sigma=None):
+    """
+    Fill the masked (vessel) pixels of img before low-pass background estimation.
+    method:
+      'normalized' - normalized convolution G(img*v)/G(v), sigma doubling until every hole is reached
+      'pushpull'   - pyramid push-pull
+      'telea', 'ns' - cv2.inpaint (radius 3)
+      'biharmonic' - skimage inpaint_biharmonic (slow, reference)
+    """
+    img = np.asarray(img, dtype=np.float32)
+    mask = np.asarray(mask, dtype=bool)
+    if not mask.any():
+        return img.copy()
+    valid = ~mask
+    if method == 'normalized':
+        out = img.copy()
+        todo = mask.copy()
+        sigma = sigma or 2.
+        while todo.any():
+            num = gaussian_filter(img * valid, sigma, mode='nearest')
+            den = gaussian_filter(valid.astype(np.float32), sigma, mode='nearest')
+            ok = todo & (den > 1e-3)
+            out[ok] = num[ok] / den[ok]
+            todo &= ~ok
+            sigma *= 2
+            if sigma > 2 * max(img.shape):
+                out[todo] = img[valid].mean() if valid.any() else 0
+                break
+        return out
+    elif method == 'pushpull':
+        return _pushpull(img, valid)
+    elif method in ('telea', 'ns'):
+        flag = cv2.INPAINT_TELEA if method == 'telea' else cv2.INPAINT_NS
+        return cv2.inpaint(img, mask.astype(np.uint8), 3, flag)
+    elif method == 'biharmonic':
+        from skimage.restoration import inpaint_biharmonic
+        return inpaint_biharmonic(img, mask, channel_axis=None).astype(np.float32)
+    raise ValueError("method must be 'normalized', 'pushpull', 'telea', 'ns' or 'biharmonic'")
+
+def masked_background(img, mask, sigma=60, method='normalized'):
+    """
+    gaussian_filter(inpaint(img, mask), sigma), the vessel-masked background of the
+    segmentation notebooks. With method='normalized' the fill and the blur are one step,
+    G(img*v)/G(v); the other methods inpaint first (see inpaint_masked).
+    """
+    img = np.asarray(img, dtype=np.float32)
+    mask = np.asarray(mask, dtype=bool)
+    if method == 'normalized':
+        valid = (~mask).astype(np.float32)
+        num = gaussian_filter(img * valid, sigma)
+        return num / np.maximum(gaussian_filter(valid, sigma), 1e-6)
+    return gaussian_filter(inpaint_masked(img, mask, method), sigma)
+
+def _small_sigma(sigma, factor):
+    # the block mean and the linear upsampling already blur by about (f^2-1)/12 + f^2/6 px^2
+    var = sigma**2 - (factor**2 - 1) / 12 - factor**2 / 6
+    return np.sqrt(max(var, (sigma/2)**2)) / factor
+
+def upsample_tile(bg_small, factor, y0, y1, x0, x1, pad=1, margin=2):
+    """
+    Bilinear upsampling of bg_small (decimated, with pad blocks around the image)
+    restricted to the full-resolution tile y0:y1, x0:x1.
+    """
+    hs, ws = bg_small.shape
+    sy0, sx0 = max(y0//factor + pad - margin, 0), max(x0//factor + pad - margin, 0)
+    sy1, sx1 = min(-(-y1 // factor) + pad + margin, hs), min(-(-x1 // factor) + pad + margin, ws)
+    sub = bg_small[sy0:sy1, sx0:sx1]
+    # resizing a sub-window that starts on a block boundary is aligned with resizing the whole image
+    up = cv2.resize(sub, ((sx1-sx0)*factor, (sy1-sy0)*factor), interpolation=cv2.INTER_LINEAR)
+    oy, ox = (sy0 - pad)*factor, (sx0 - pad)*factor
+    return up[y0 - oy:y1 - oy, x0 - ox:x1 - ox]
+
+def estimate_background(img, sigma=50, factor=None, mask=None, tile=4096, channel=1, inpaint='normalized'):
+    """
+    Low-frequency background of img (full resolution, float32), i.e. an approximation of
+    gaussian_filter(img, sigma) computed on an image decimated by factor (default sigma//5).
+    mask: optional vessel mask (True = vessel) excluded from the estimate.
+    inpaint: how masked blocks are filled (see inpaint_masked).
+    """
+    factor = factor or max(int(sigma // 5), 1)
+    small, weight = decimate(img, factor, mask=mask, tile=tile, channel=channel)
+    edges = edge_lines(img, factor, mask=mask, channel=channel)
+    bg_small = estimate_background_small(small, weight, _small_sigma(sigma, factor), edges, inpaint=inpaint)
+    H, W = _as_plane(img, channel).shape
+    bg = np.empty((H, W), dtype=np.float32)
+    for y0, y1, x0, x1 in _tiles((H, W), tile):
+        bg[y0:y1, x0:x1] = upsample_tile(bg_small, factor, y0, y1, x0, x1)
+    return bg
+
+@stage
+def flat_field(img, sigma=50, factor=None, mask=None, tile=4096, channel=1, out=None, inpaint='normalized'):
+    """
+    Flat-fielded image img / background (the ImageJ 'Divide create 32-bit' step).
+    The background is only ever held at decimated resolution; upsampling and division
+    are done per tile into out (a new float32 array, or e.g. a memory-mapped TIFF).
+    """
+    factor = factor or max(int(sigma // 5), 1)
+    plane = _as_plane(img, channel)
+    small, weight = decimate(plane, factor, mask=mask, tile=tile)
+    edges = edge_lines(plane, factor, mask=mask)
+    bg_small = estimate_background_small(small, weight, _small_sigma(sigma, factor), edges, inpaint=inpaint)
+    if out is None:
+        out = np.empty(plane.shape, dtype=np.float32)
+    for y0, y1, x0, x1 in _tiles(plane.shape, tile):
+        bg = upsample_tile(bg_small, factor, y0, y1, x0, x1)
+        out[y0:y1, x0:x1] = np.asarray(plane[y0:y1, x0:x1], dtype=np.float32) / (bg + 1e-6)
+    return out
+
+@stage
+def flat_field_file(in_path, out_path=None, sigma=50, factor=None, tile=4096, channel=1):
+    """
+    Flat-field a TIFF on disk (e.g. C2-*.tif) into <name>_BS.tif, like BackgroundSubtract.py,
+    streaming from and to memory-mapped files when the layout allows it.
+    """
+    if out_path is None:
+        out_path = os.path.splitext(in_path)[0] + '_BS.tif'
+    try:
+        img = tifffile.memmap(in_path, mode='r')
+    except ValueError:
+        img = tifffile.imread(in_path)
+    shape = img.shape[:2]
+    out = tifffile.memmap(out_path, shape=shape, dtype=np.float32, bigtiff=np.prod(shape)*4 > 2**31)
+    flat_field(img, sigma=sigma, factor=factor, tile=tile, channel=channel, out=out)
+    out.flush()
+    del out
+    return out_path
@@ -0,0 +1,251 @@
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from flowmap_utils import *
+
+# usage: python benchmarks.py [name ...]  (runs every benchmark if no name is given)
+
+def _timeit(func, *args, repeat=1, **kwargs):
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = func(*args, **kwargs)
+        best = min(best, time.perf_counter() - t0)
+    return best, out
+
+def _noisy_curve(n_pts, seed=0):
+    ''' unordered, duplicated pixel points along a wiggly capillary-like curve '''
+    rng = np.random.default_rng(seed)
+    t = np.linspace(0, 1, n_pts)
+    pts = np.stack([0.6*n_pts*t, 0.1*n_pts*np.sin(4*np.pi*t)], axis=1)
+    pts = np.round(pts + rng.normal(0, 0.3, pts.shape)).astype(np.float32)
+    pts = np.concatenate([pts, pts[:n_pts//10]])  # repeated pixels, as from overlapping contours
+    return pts[rng.permutation(len(pts))]
+
+def _unique_pts_list(pts):
+    ''' the original list-membership deduplication '''
+    unique = []
+    for pt in pts:
+        pt = list(pt)
+        if pt not in unique:
+            unique.append(pt)
+    return np.array(unique)
+
+def bench_sort_path(point_counts=(250, 500, 1000, 2000, 4000)):
+    print('sort_path: greedy (list) vs kdtree')
+    print(f'{"n_pts":>7} {"greedy[s]":>10} {"kdtree[s]":>10} {"speedup":>8} {"same":>5}')
+    for n in point_counts:
+        pts = _noisy_curve(n)
+        start = pts[np.argmin(pts[:, 0])]
+        t_old, p_old = _timeit(sort_path, pts, start=start, method='greedy')
+        t_new, p_new = _timeit(sort_path, pts, start=start, method='kdtree', repeat=3)
+        same = p_old.shape == p_new.shape and np.allclose(p_old, p_new)
+        print(f'{n:>7} {t_old:>10.4f} {t_new:>10.4f} {t_old/t_new:>8.1f} {str(same):>5}')
+
+def bench_unique_pts(point_counts=(250, 500, 1000, 2000, 4000)):
+    print('unique_pts: list membership vs np.unique')
+    print(f'{"n_pts":>7} {"list[s]":>10} {"unique[s]":>10} {"speedup":>8} {"same":>5}')
+    for n in point_counts:
+        pts = _noisy_curve(n)
+        t_old, u_old = _timeit(_unique_pts_list, pts)
+        t_new, u_new = _timeit(unique_pts, pts, repeat=3)
+        same = np.array_equal(u_old, u_new)
+        print(f'{n:>7} {t_old:>10.4f} {t_new:>10.4f} {t_old/t_new:>8.1f} {str(same):>5}')
+
+def _illuminated_frame(shape, noise=0.0, seed=0):
+    ''' smooth vignetting-like illumination with dark vessel-like stripes '''
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[:shape[0], :shape[1]] / 1000.
+    illum = 1000 * (1 + 0.5*np.sin(yy*1.3 + 0.4)*np.cos(xx*0.9))
+    vessels = 1 - 0.3*(np.sin(xx*40 + 3*np.sin(yy*5)) > 0.95)
+    return (illum * vessels * (1 + noise*rng.standard_normal(shape))).astype(np.float32)
+
+def bench_background(shapes=((1500, 2000), (3000, 4000)), sigma=50):
+    from scipy.ndimage import gaussian_filter
+    from background_utils import estimate_background
+    print(f'background: full-resolution gaussian_filter vs decimated estimate (sigma={sigma})')
+    print(f'{"shape":>12} {"full[s]":>8} {"decim[s]":>9} {"speedup":>8} {"max rel err":>12} {"mean rel err":>13}')
+    for shape in shapes:
+        img = _illuminated_frame(shape)
+        t_old, ref = _timeit(gaussian_filter, img, sigma, mode='nearest')
+        t_new, bg = _timeit(estimate_background, img, sigma, repeat=3)
+        err = np.abs(bg / ref - 1)
+        print(f'{str(shape):>12} {t_old:>8.2f} {t_new:>9.3f} {t_old/t_new:>8.1f} {err.max():>12.2e} {err.mean():>13.2e}')
+
+def _vessel_crop(shape, seed=0):
+    ''' normalized crop with smooth background and a mask of curved ~12 px wide vessels '''
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[:shape[0], :shape[1]].astype(np.float32)
+    bg = 0.6 + 0.2*np.sin(yy/shape[0]*2.5)*np.cos(xx/shape[1]*2)
+    mask = np.abs(np.sin(xx/40 + 2*np.sin(yy/90))) > 0.85
+    img = bg - 0.3*mask + 0.02*rng.standard_normal(shape)
+    return img.astype(np.float32), mask
+
+def bench_inpaint(shapes=((150, 125), (300, 250), (600, 500), (1200, 1000)), sigma=60):
+    from background_utils import inpaint_masked, masked_background
+    methods = ['normalized', 'pushpull', 'telea', 'ns']
+    print(f'vessel-masked background (gaussian sigma={sigma}): fast inpainting vs inpaint_biharmonic')
+    print('(normalized convolution fills and blurs in one step, so its inpaint time is the total)')
+    print(f'{"shape":>12} {"method":>11} {"inpaint[s]":>11} {"speedup":>8} {"total[s]":>9} {"max rel err":>12}')
+    for shape in shapes:
+        img, mask = _vessel_crop(shape)
+        t_inp_ref, _ = _timeit(inpaint_masked, img, mask, 'biharmonic')
+        t_ref, ref = _timeit(masked_background, img, mask, sigma, 'biharmonic')
+        print(f'{str(shape):>12} {"biharmonic":>11} {t_inp_ref:>11.3f} {1:>8.1f} {t_ref:>9.3f} {0:>12.2e}')
+        for m in methods:
+            t, bg = _timeit(masked_background, img, mask, sigma, m, repeat=3)
+            t_inp = t if m == 'normalized' else _timeit(inpaint_masked, img, mask, m, repeat=3)[0]
+            err = np.abs(bg / ref - 1).max()
+            print(f'{"":>12} {m:>11} {t_inp:>11.3f} {t_inp_ref/t_inp:>8.1f} {t:>9.3f} {err:>12.2e}')
+
+def bench_vesselness(shapes=((750, 1000), (1500, 2000)), sigmas=np.geomspace(3, 17, 7), threshold=0.15):
+    from skimage import filters
+    import vesselness_utils as vu
+    print(f'vesselness: skimage vs pyramid + eigenvalue cache (sigmas {sigmas[0]:.0f}..{sigmas[-1]:.0f}, {len(sigmas)} scales)')
+    print(f'{"shape":>12} {"filter":>9} {"skimage[s]":>11} {"first[s]":>9} {"cached[s]":>10} {"speedup":>8} '
+          f'{"max err":>8} {"mask diff":>10}')
+    for shape in shapes:
+        img, _ = _vessel_crop(shape)
+        for name in ('meijering', 'frangi'):
+            vu.clear_cache()
+            t_ref, ref = _timeit(getattr(filters, name), img, sigmas=sigmas)
+            t_first, out = _timeit(getattr(vu, name), img, sigmas=sigmas)
+            t_cached, _ = _timeit(getattr(vu, name), img, sigmas=sigmas[1:], repeat=3)
+            diff = ((out > threshold) != (ref > threshold)).mean()
+            print(f'{str(shape):>12} {name:>9} {t_ref:>11.2f} {t_first:>9.2f} {t_cached:>10.3f} '
+                  f'{t_ref/t_first:>8.1f} {np.abs(out - ref).max():>8.3f} {diff:>10.2e}')
+
+def _dense_skeleton(shape, seed=0):
+    ''' largest component of the skeleton of a smoothed random blob mask (many branches and loops) '''
+    from scipy.ndimage import gaussian_filter
+    from skimage.measure import label
+    from skimage.morphology import skeletonize
+    rng = np.random.default_rng(seed)
+    skel = skeletonize(gaussian_filter(rng.standard_normal(shape), 3) > -0.01)
+    lab = label(skel, connectivity=2)
+    return lab == np.argmax(np.bincount(lab.ravel())[1:]) + 1
+
+def _longest_path_networkx(skel):
+    ''' the notebook's flow: cKDTree neighbours -> networkx graph -> all endpoint pairs '''
+    import networkx as nx
+    coords = np.column_stack(np.nonzero(skel))
+    tree = cKDTree(coords)
+    G = nx.Graph()
+    G.add_edges_from((i, n) for i, pt in enumerate(coords) for n in tree.query_ball_point(pt, 1.5) if n != i)
+    endpoints = [n for n, d in G.degree() if d == 1]
+    longest_path, max_len = [], 0
+    for i in range(len(endpoints)):
+        for j in range(i+1, len(endpoints)):
+            path = nx.shortest_path(G, endpoints[i], endpoints[j])
+            if len(path) > max_len:
+                max_len, longest_path = len(path), path
+    return coords[longest_path]
+
+def bench_skeleton(shapes=((150, 150), (200, 200), (300, 300))):
+    from skeleton_utils import longest_path, find_endpoints
+    print('skeleton longest path: cKDTree + networkx (notebook) vs CSR graph + BFS')
+    print(f'{"shape":>12} {"pixels":>7} {"ends":>5} {"networkx[s]":>12} {"csr[s]":>8} {"speedup":>8} {"same len":>9}')
+    for shape in shapes:
+        skel = _dense_skeleton(shape)
+        n_ends = int(find_endpoints(skel).sum())
+        t_old, p_old = _timeit(_longest_path_networkx, skel)
+        t_new, p_new = _timeit(longest_path, skel, repeat=3)
+        print(f'{str(shape):>12} {int(skel.sum()):>7} {n_ends:>5} {t_old:>12.3f} {t_new:>8.4f} {t_old/t_new:>8.1f} '
+              f'{str(len(p_old) == len(p_new)):>9}')
+
+def _tangent_direction_loop(path, time_window=5):
+    ''' the original per-point get_tangent_direction '''
+    ex_path = extend_path(path, time_window).astype(np.float32)
+    tangent_angles = []
+    for i in range(0, len(ex_path)-time_window+1):
+        tangent = ex_path[i+time_window-1] - ex_path[i]
+        tangent /= np.linalg.norm(tangent)
+        tangent_angles.append(tangent)
+    return np.array(tangent_angles)
+
+def _flow_direction_loop(path, time_windows):
+    ''' the original per-point get_flow_direction '''
+    ex_path = extend_path_tail(path, np.max(time_windows)).astype(np.float32)
+    tangent_angles = []
+    for i in range(0, len(path)):
+        tangent = ex_path[i+time_windows[i]-1] - ex_path[i]
+        tangent /= (np.linalg.norm(tangent)+1e-5)
+        tangent_angles.append(tangent)
+    return np.array(tangent_angles)
+
+def _direction_to_flow_loop(directions, path, img_shape):
+    ''' the original per-point direction_to_flow '''
+    path = np.array(path)
+    flow = np.zeros(img_shape+(2,), dtype=np.float32)
+    for i, d in enumerate(directions):
+        flow[int(path[i,1]), int(path[i,0])] = d
+    return flow
+
+def bench_directions(point_counts=(500, 2000, 8000, 32000)):
+    print('tangent / flow direction / flow rasterization: per-point loop vs array version')
+    print(f'{"n_pts":>7} {"function":>22} {"loop[s]":>9} {"array[s]":>9} {"speedup":>8} {"identical":>10}')
+    rng = np.random.default_rng(0)
+    for n in point_counts:
+        pts = _noisy_curve(n)
+        path = sort_path(pts, start=pts[np.argmin(pts[:, 0])], spacing=1.)
+        shape = (int(path[:, 1].max()) + 2, int(path[:, 0].max()) + 2)
+        windows = list(rng.integers(3, 15, len(path)))
+        dirs = get_tangent_direction(path, 5)
+        cases = [('get_tangent_direction', _tangent_direction_loop, get_tangent_direction, (path, 5)),
+                 ('get_flow_direction', _flow_direction_loop, get_flow_direction, (path, windows)),
+                 ('direction_to_flow', _direction_to_flow_loop, direction_to_flow, (dirs, path, shape))]
+        for name, old, new, args in cases:
+            t_old, r_old = _timeit(old, *args)
+            t_new, r_new = _timeit(new, *args, repeat=5)
+            same = r_old.dtype == r_new.dtype and np.array_equal(r_old, r_new)
+            print(f'{n:>7} {name:>22} {t_old:>9.4f} {t_new:>9.5f} {t_old/t_new:>8.1f} {str(same):>10}')
+
+def _straighten_notebook(frame, centerline, width):
+    ''' the notebook flow: spline fit, normals and one map_coordinates call per centerline point '''
+    from scipy.interpolate import splprep, splev
+    from scipy.ndimage import map_coordinates
+    tck, u = splprep([centerline[:,0], centerline[:,1]], s=0)
+    y_new, x_new = splev(np.linspace(0, 1, len(centerline)), tck)
+    c = np.column_stack([y_new, x_new])
+    d = c[2:] - c[:-2]
+    length = np.hypot(d[:,1], d[:,0])
+    normals = np.stack([-d[:,0]/length, d[:,1]/length], axis=1)
+    normals = np.concatenate([normals[:1], normals, normals[-1:]])
+    lines = [map_coordinates(frame, [y + np.arange(-width, width+1)*ny, x + np.arange(-width, width+1)*nx], order=1)
+             for (y, x), (nx, ny) in zip(c, normals)]
+    return np.array(lines).T
+
+def bench_straighten(frame_counts=(1, 10, 100), n_caps=8, width=30):
+    import straighten_utils as st
+    rng = np.random.default_rng(0)
+    shape = (600, 800)
+    t = np.linspace(0, 1, 300)
+    centerlines = [np.stack([60 + 60*k + 25*np.sin(6*t + k), 40 + 700*t], 1) for k in range(n_caps)]
+    print(f'straightening {n_caps} capillaries (width {width}): notebook loop per frame vs cached sampling grids')
+    print(f'{"frames":>7} {"notebook[s]":>12} {"first[s]":>9} {"cached[s]":>10} {"speedup":>8} {"max diff":>9}')
+    for T in frame_counts:
+        frames = rng.random((T,) + shape).astype(np.float32)
+        t_old, ref = _timeit(lambda: [np.stack([_straighten_notebook(f, cl, width) for f in frames]) for cl in centerlines])
+        st.clear_cache()
+        t_first, _ = _timeit(st.straighten_capillaries, frames, centerlines, width)
+        t_new, out = _timeit(st.straighten_capillaries, frames, centerlines, width, repeat=3)
+        diff = max(np.abs(a - b).max() for a, b in zip(ref, out))
+        print(f'{T:>7} {t_old:>12.3f} {t_first:>9.4f} {t_new:>10.4f} {t_old/t_new:>8.1f} {diff:>9.1e}')
+
+BENCHMARKS = {
+    'unique_pts': bench_unique_pts,
+    'sort_path': bench_sort_path,
+    'background': bench_background,
+    'inpaint': bench_inpaint,
+    'vesselness': bench_vesselness,
+    'skeleton': bench_skeleton,
+    'directions': bench_directions,
+    'straighten': bench_straighten,
+}
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or list(BENCHMARKS):
+        BENCHMARKS[name]()
@@ -0,0 +1,255 @@
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, asdict, field
+
+import numpy as np
+import tifffile
+from scipy import ndimage as ndi
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from skimage.filters import threshold_otsu
+from skimage.morphology import disk
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'image_conversion'))
+from tiff_utils import read_roi
+if __name__ == '__main__':
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from stage_utils import stage
+
+import vesselness_utils as vu
+
+# Whole-frame capillary detection: normalization, meijering vesselness, threshold and
+# morphology run tile by tile (with a halo) in parallel. All tiles share one calibration
+# learned on a representative ROI, so the stitched mask has no seams; capillaries are
+# labelled across tile borders and written as bounding boxes to a JSON index.
+
+EPS = 1e-6
+INDEX_NAME = 'capillary_index.json'
+
+@dataclass
+class DetectionCalib:
+    # normalization frozen from the ROI
+    p1: float
+    p99: float
+    # meijering config and the per-scale maxima found on the ROI
+    black_ridges: bool
+    sigmas: list
+    scale_max: list
+    # Otsu threshold of the ROI response
+    threshold: float
+    # morphology
+    min_size: int = 100
+    hole_area: int = 200
+    dilate_r: int = 1
+    roi: list = field(default_factory=list)
+
+def frame_shape(src):
+    if isinstance(src, str):
+        with tifffile.TiffFile(src) as tf:
+            return tuple(tf.series[0].shape[:2])
+    return tuple(src.shape[:2])
+
+def _read_box(src, y0, y1, x0, x1):
+    tile = read_roi(src, y0, y1, x0, x1) if isinstance(src, str) else np.asarray(src[y0:y1, x0:x1])
+    if tile.ndim == 3:
+        tile = tile[..., 1]  # green channel of an RGB frame
+    return tile.astype(np.float32)
+
+def normalize(img, p1, p99):
+    return np.clip((img - p1) / (p99 - p1 + EPS), 0, 1)
+
+@stage
+def calibrate(src, roi=None, sigmas=np.geomspace(3, 17, 7), polarity='dark', perc=(1, 99),
+              min_size=100, hole_area=200, dilate_r=1):
+    """
+    Learn normalization, per-scale meijering maxima and the Otsu threshold on a representative
+    ROI (y0, y1, x0, x1; default: a 2048 px box at the frame center).
+    polarity: 'dark' -> black_ridges=True, 'bright' -> False
+    """
+    H, W = frame_shape(src)
+    if roi is None:
+        cy, cx, r = H // 2, W // 2, 1024
+        roi = (max(cy - r, 0), min(cy + r, H), max(cx - r, 0), min(cx + r, W))
+    img = _read_box(src, *roi)
+    p1, p99 = np.percentile(img, perc)
+    img_n = normalize(img, p1, p99)
+    black_ridges = polarity == 'dark'
+    scale_max = []
+    for sigma in sigmas:
+        vals, _ = vu.meijering_vals(img_n, sigma, black_ridges=black_ridges, cache=False)
+        scale_max.append(float(vals.max()))
+    resp = vu.meijering(img_n, sigmas, black_ridges=black_ridges, scale_max=scale_max, cache=False)
+    return DetectionCalib(p1=float(p1), p99=float(p99), black_ridges=black_ridges,
+                          sigmas=[float(s) for s in sigmas], scale_max=scale_max,
+                          threshold=float(threshold_otsu(resp)), min_size=min_size,
+                          hole_area=hole_area, dilate_r=dilate_r, roi=[int(v) for v in roi])
+
+def _remove_small(bw, min_size):
+    # like skimage remove_small_objects (4-connectivity), but components touching the tile
+    # border are kept: their size is only known once the neighbouring tiles are seen
+    lab, n = ndi.label(bw)
+    keep = np.bincount(lab.ravel(), minlength=n + 1) >= min_size
+    keep[np.concatenate([lab[0], lab[-1], lab[:, 0], lab[:, -1]])] = True
+    keep[0] = False
+    return keep[lab]
+
+def vessel_mask(img, calib):
+    """ normalization, vesselness, threshold and morphology of one tile """
+    img_n = normalize(img, calib.p1, calib.p99)
+    resp = vu.meijering(img_n, calib.sigmas, black_ridges=calib.black_ridges,
+                        scale_max=calib.scale_max, cache=False)
+    bw = _remove_small(resp > calib.threshold, calib.min_size)
+    bw |= ~_remove_small(~bw, calib.hole_area)
+    if calib.dilate_r:
+        bw = ndi.binary_dilation(bw, disk(calib.dilate_r))
+    return bw
+
+def default_halo(calib):
+    # vesselness support (~4 sigma) plus room for the morphology, aligned to the coarsest
+    # pyramid level so every tile samples the same pyramid grid
+    align = 2**vu.level_for_sigma(max(calib.sigmas))
+    halo = max(4 * max(calib.sigmas), 128) + calib.dilate_r
+    return int(np.ceil(halo / align) * align)
+
+def tile_boxes(shape, tile):
+    H, W = shape
+    return [(y, min(y + tile, H), x, min(x + tile, W)) for y in range(0, H, tile) for x in range(0, W, tile)]
+
+def _detect_tile(src, calib, shape, box, halo, mask_path=None):
+    y0, y1, x0, x1 = box
+    ya, yb = max(y0 - halo, 0), min(y1 + halo, shape[0])
+    xa, xb = max(x0 - halo, 0), min(x1 + halo, shape[1])
+    bw = vessel_mask(_read_box(src, ya, yb, xa, xb), calib)[y0 - ya:y1 - ya, x0 - xa:x1 - xa]
+    if mask_path:
+        out = tifffile.memmap(mask_path, mode='r+')
+        out[y0:y1, x0:x1] = bw * np.uint8(255)
+        out.flush()
+        del out
+    # 8-connected components of the core: boxes, areas and the labels on the core border
+    lab, n = ndi.label(bw, np.ones((3, 3), bool))
+    areas = np.bincount(lab.ravel(), minlength=n + 1)[1:]
+    boxes = np.array([[s[0].start + y0, s[0].stop + y0, s[1].start + x0, s[1].stop + x0]
+                      for s in ndi.find_objects(lab)], dtype=np.int64).reshape(-1, 4)
+    edges = dict(top=lab[0].copy(), bottom=lab[-1].copy(), left=lab[:, 0].copy(), right=lab[:, -1].copy())
+    return box, boxes, areas, edges
+
+def _edge_pairs(a, b):
+    # label pairs of two facing border lines that touch (8-connectivity: offsets -1, 0, +1)
+    pairs = []
+    for d in (-1, 0, 1):
+        la = a[max(d, 0):len(a) + min(d, 0)]
+        lb = b[max(-d, 0):len(b) + min(-d, 0)]
+        ok = (la > 0) & (lb > 0)
+        pairs.append(np.stack([la[ok], lb[ok]], 1))
+    return np.concatenate(pairs)
+
+def merge_tiles(results, tile):
+    """
+    Join the per-tile components that touch across tile borders.
+    Returns boxes (n, 4) as y_min, y_max, x_min, x_max (exclusive) and areas (n,).
+    """
+    by_pos = {(r[0][0] // tile, r[0][2] // tile): r for r in results}
+    offset, offsets = 0, {}
+    for pos in sorted(by_pos):
+        offsets[pos] = offset
+        offset += len(by_pos[pos][2])
+    if offset == 0:
+        return np.zeros((0, 4), np.int64), np.zeros(0, np.int64)
+    links = [np.zeros((0, 2), np.int64)]
+    for (i, j), (_, _, _, e) in by_pos.items():
+        for (di, dj), sa, sb in (((1, 0), 'bottom', 'top'), ((0, 1), 'right', 'left')):
+            nb = by_pos.get((i + di, j + dj))
+            if nb is not None:
+                p = _edge_pairs(e[sa], nb[3][sb]).astype(np.int64)
+                links.append(np.stack([p[:, 0] - 1 + offsets[i, j], p[:, 1] - 1 + offsets[i + di, j + dj]], 1))
+        # diagonal corners
+        for dj, ca, cb in ((1, -1, 0), (-1, 0, -1)):
+            nb = by_pos.get((i + 1, j + dj))
+            if nb is not None and e['bottom'][ca] and nb[3]['top'][cb]:
+                links.append(np.array([[e['bottom'][ca] - 1 + offsets[i, j], nb[3]['top'][cb] - 1 + offsets[i + 1, j + dj]]]))
+    links = np.concatenate(links)
+    graph = coo_matrix((np.ones(len(links)), (links[:, 0], links[:, 1])), shape=(offset, offset))
+    n, comp = connected_components(graph, directed=False)
+    boxes = np.concatenate([by_pos[pos][1] for pos in sorted(by_pos)])
+    areas = np.concatenate([by_pos[pos][2] for pos in sorted(by_pos)])
+    out = np.empty((n, 4), np.int64)
+    out[:, [0, 2]] = np.iinfo(np.int64).max
+    out[:, [1, 3]] = np.iinfo(np.int64).min
+    np.minimum.at(out[:, 0], comp, boxes[:, 0])
+    np.maximum.at(out[:, 1], comp, boxes[:, 1])
+    np.minimum.at(out[:, 2], comp, boxes[:, 2])
+    np.maximum.at(out[:, 3], comp, boxes[:, 3])
+    return out, np.bincount(comp, weights=areas, minlength=n).astype(np.int64)
+
+@stage
+def detect_capillaries(src, calib=None, tile=2048, halo=None, workers=None, mask_path=None,
+                       index_path=None, min_area=None, margin=0):
+    """
+    Detect capillaries over a whole frame (TIFF path or array) tile by tile.
+    calib: DetectionCalib (default: calibrate(src) on the frame center)
+    tile: core tile edge; it is rounded up to the pyramid alignment of the largest sigma
+    mask_path: optional uint8 TIFF (0/255) of the stitched mask
+    index_path: JSON index of the capillary bounding boxes (replaces crop_coords.json)
+    min_area: smallest component kept in the index (default calib.min_size)
+    margin: padding added around every box, clipped to the frame
+    Paths are processed in a process pool, in-memory arrays in a thread pool.
+    Returns the index dict.
+    """
+    calib = calib or calibrate(src)
+    shape = frame_shape(src)
+    align = 2**vu.level_for_sigma(max(calib.sigmas))
+    tile = int(np.ceil(tile / align) * align)
+    halo = default_halo(calib) if halo is None else int(np.ceil(halo / align) * align)
+    if mask_path:
+        out = tifffile.memmap(mask_path, shape=shape, dtype=np.uint8)
+        del out
+    boxes = tile_boxes(shape, tile)
+    Pool = ProcessPoolExecutor if isinstance(src, str) else ThreadPoolExecutor
+    with Pool(max_workers=workers or os.cpu_count()) as pool:
+        results = list(pool.map(_detect_tile, *zip(*[(src, calib, shape, b, halo, mask_path) for b in boxes])))
+    cap_boxes, areas = merge_tiles(results, tile)
+    keep = areas >= (calib.min_size if min_area is None else min_area)
+    cap_boxes, areas = cap_boxes[keep], areas[keep]
+    order = np.lexsort((cap_boxes[:, 2], cap_boxes[:, 0]))
+    capillaries = []
+    for k, i in enumerate(order):
+        y_min, y_max, x_min, x_max = cap_boxes[i]
+        capillaries.append(dict(id=k, y_min=int(max(y_min - margin, 0)), y_max=int(min(y_max + margin, shape[0])),
+                                x_min=int(max(x_min - margin, 0)), x_max=int(min(x_max + margin, shape[1])),
+                                area=int(areas[i])))
+    index = dict(image=src if isinstance(src, str) else None, shape=list(shape), mask=mask_path,
+                 tile=tile, halo=halo, calib=asdict(calib), capillaries=capillaries)
+    if index_path:
+        with open(index_path, 'w') as f:
+            json.dump(index, f, indent=2)
+    return index
+
+def load_index(index_path):
+    with open(index_path) as f:
+        return json.load(f)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tiled whole-frame capillary detection.')
+    parser.add_argument('image', help='green-channel TIFF (e.g. C2-<name>.tif)')
+    parser.add_argument('--roi', type=int, nargs=4, metavar=('Y0', 'Y1', 'X0', 'X1'),
+                        help='calibration region (default: 2048 px box at the frame center)')
+    parser.add_argument('--tile', type=int, default=2048)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--margin', type=int, default=0, help='padding around every box')
+    parser.add_argument('--mask', default=None, help='write the stitched mask to this TIFF')
+    parser.add_argument('--index', default=None, help=f'output JSON (default: {INDEX_NAME} next to the image)')
+    parser.add_argument('--store', default=None, help='also append the boxes to this results store (results_utils.py)')
+    parser.add_argument('--session', default='default')
+    args = parser.parse_args()
+
+    index_path = args.index or os.path.join(os.path.dirname(os.path.abspath(args.image)), INDEX_NAME)
+    calib = calibrate(args.image, roi=args.roi)
+    index = detect_capillaries(args.image, calib, tile=args.tile, workers=args.workers, mask_path=args.mask,
+                               index_path=index_path, margin=args.margin)
+    print(f"{len(index['capillaries'])} capillaries -> {index_path}")
+    if args.store:
+        from results_utils import append, crop_records
+        print('crops ->', append(args.store, 'crops', crop_records(index, source=index_path), args.session))
@@ -6,15 +6,19 @@ import matplotlib.pyplot as plt
 import numpy as np
 from scipy.interpolate import UnivariateSpline, interp1d
 from scipy.ndimage import map_coordinates
+from scipy.spatial import cKDTree
 from skimage.transform import radon
+from skeleton_utils import find_endpoints, skeleton_segments
+
+from stage_utils import stage
 
 def unique_pts(pts):
-    unique_pts = []
-    for pt in pts:
-        pt = list(pt)
-        if pt not in unique_pts:
-            unique_pts.append(pt)
-    return np.array(unique_pts)
+    """ drop repeated points, keeping the first occurrence order """
+    pts = np.asarray(pts)
+    if len(pts) == 0:
+        return np.array([])
+    _, first_idx = np.unique(pts, axis=0, return_index=True)
+    return pts[np.sort(first_idx)]
 # resmaple path to eaqual distance
 def resample_even_pts(path, spacing=1., num_pts=None):
     if isinstance(path, np.ndarray):
@@ -61,25 +65,77 @@ def smooth_path(path, spacing=30.):
     path = resample_even_pts(path, spacing=1.)
     return path
 
-def sort_path(coords, start=None, smooth = 1., spacing=1.):
+def greedy_path_order(coords, start, rebuild_frac=0.5):
+    """
+    Index order of the greedy nearest-neighbour walk from start over coords (N,2),
+    the same walk as sort_path(method='greedy') but with a KD-tree over the points
+    not yet visited. The tree is rebuilt once rebuild_frac of its points are used.
+    """
+    coords = np.asarray(coords)
+    dtype = coords.dtype if np.issubdtype(coords.dtype, np.floating) else np.float64
+    n = len(coords)
+    visited = np.zeros(n, dtype=bool)
+    order = np.empty(n, dtype=np.int64)
+    remaining, tree, n_used = None, None, 0
+    cur = np.asarray(start, dtype=dtype)
+    for step in range(n):
+        if tree is None or n_used >= rebuild_frac * len(remaining):
+            remaining = np.flatnonzero(~visited)
+            tree = cKDTree(coords[remaining])
+            n_used = 0
+        k = min(8, len(remaining))
+        while True:
+            d, j = tree.query(cur, k=k)
+            d, j = np.atleast_1d(d), np.atleast_1d(j)
+            free = ~visited[remaining[j]]
+            # stop once every point tied with the nearest free one has been returned
+            if free.any():
+                d_max = d[free].min() * (1 + 1e-6) + 1e-9
+                if d[-1] > d_max or k == len(remaining):
+                    break
+            k = min(2 * k, len(remaining))
+        # break ties exactly like min(): smallest distance, then first in list order
+        cand = np.sort(remaining[j[free & (d <= d_max)]])
+        diff = coords[cand].astype(dtype) - cur
+        dists = (diff[:, 0]**2 + diff[:, 1]**2) ** 0.5
+        nearest = cand[np.argmin(dists)]
+        order[step] = nearest
+        visited[nearest] = True
+        n_used += 1
+        cur = coords[nearest].astype(dtype)
+    return order
+
+@stage
+def sort_path(coords, start=None, smooth = 1., spacing=1., method='kdtree'):
     """
     This function finds the nearest point to a point
     coords should be a list in this format coords = [ [x1, y1], [x2, y2] , ...] 
+    method: 'kdtree' (spatial index) or 'greedy' (pure python), both give the same ordering
     """
     coords = unique_pts(coords)
-    coords = [list(p) for p in coords]
-    if start is None:
-        start = coords[0]
-    if type(start) != list:
-        start = start.tolist()
-    
-    pass_by = coords
-    path = [start]
-    # pass_by.remove(start)
-    while pass_by:
-        nearest = min(pass_by, key=lambda x: distance(path[-1], x))
-        path.append(nearest)
-        pass_by.remove(nearest)
+    if method == 'kdtree':
+        if start is None:
+            start = coords[0]
+        if type(start) != list:
+            start = start.tolist()
+        order = greedy_path_order(coords, start)
+        path = np.concatenate([np.asarray(start)[None], coords[order]], axis=0)
+    elif method == 'greedy':
+        coords = [list(p) for p in coords]
+        if start is None:
+            start = coords[0]
+        if type(start) != list:
+            start = start.tolist()
+
+        pass_by = coords
+        path = [start]
+        # pass_by.remove(start)
+        while pass_by:
+            nearest = min(pass_by, key=lambda x: distance(path[-1], x))
+            path.append(nearest)
+            pass_by.remove(nearest)
+    else:
+        raise ValueError("method must be 'kdtree' or 'greedy'")
     if smooth>1.:
         path = resample_even_pts(path, spacing=smooth)     
     path = resample_even_pts(path, spacing=spacing)
@@ -100,11 +156,11 @@ def img_to_path(img):
     return path_unsorted.astype(np.float32)
 
 def skeleton_prunnning(skeleton, mask, len_thresh=0):
-    # get all segment edges
-    pruned_skel, seg_img, edge_objects = pcv.morphology.prune(skel_img=skeleton, size=0, mask=mask)
-    # sort edges by length
+    # get all segment edges (split at the dilated branch points), as ordered [X,Y] points
+    edge_objects = [seg[:, ::-1] for seg in skeleton_segments(skeleton)]
+    # sort edges by length (pixels)
     lengths = [len(edge) for edge in edge_objects]
-    main_edges = [np.array(edge_objects[i]).squeeze() for i in np.argsort(lengths)[::-1] if lengths[i]>=len_thresh]
+    main_edges = [edge_objects[i] for i in np.argsort(lengths)[::-1] if lengths[i]>=len_thresh]
     # plot the edges
     skel_out = np.zeros_like(mask, dtype=np.uint8)
     for i, edge in enumerate(main_edges):
@@ -112,8 +168,7 @@ def skeleton_prunnning(skeleton, mask, len_thresh=0):
     return main_edges, skel_out
 
 def detect_tip_pts(edge_map, vis=False):
-    pcv.params.debug = 'noplot'
-    tips = pcv.morphology.find_tips(skel_img=edge_map, mask=edge_map)
+    tips = find_endpoints(edge_map)
     tips = img_to_path(tips)
     if vis:
         fig_tip = plt.figure()
@@ -147,12 +202,9 @@ def extend_path_tail(path, TW=5):
 
 def get_tangent_direction(path, time_window=5):
     ex_path = extend_path(path, time_window).astype(np.float32)
-    tangent_angles = []
-    for i in range(0, len(ex_path)-time_window+1):
-        tangent = ex_path[i+time_window-1] - ex_path[i]
-        tangent /= np.linalg.norm(tangent)
-        tangent_angles.append(tangent)
-    tangent_angles = np.array(tangent_angles)
+    # chords over time_window points, all at once
+    tangent_angles = ex_path[time_window-1:] - ex_path[:len(ex_path)-time_window+1]
+    tangent_angles /= np.linalg.norm(tangent_angles, axis=1, keepdims=True)
     return tangent_angles
 
 def get_normal_direction(path, time_window=5):
@@ -161,12 +213,18 @@ def get_normal_direction(path, time_window=5):
     return normal_angles
 
 def direction_to_flow(directions, path, img_shape):
-    path = np.array(path)
+    directions = np.asarray(directions)
+    path = np.array(path)[:len(directions)]
     flow = np.zeros(img_shape+(2,), dtype=np.float32)
-    for i, d in enumerate(directions):
-        flow[int(path[i,1]), int(path[i,0])] = d #/ np.linalg.norm(d)
+    ys, xs = path[:,1].astype(np.int64), path[:,0].astype(np.int64)
+    # keep the last direction written to each pixel, as the sequential assignment did
+    lin = np.ravel_multi_index((ys % img_shape[0], xs % img_shape[1]), img_shape)
+    _, last = np.unique(lin[::-1], return_index=True)
+    last = len(lin) - 1 - last
+    flow[ys[last], xs[last]] = directions[last]
     return flow
 
+@stage
 def get_vessel_walls(sorted_edge, norms, mask, r):
     # plot the normal lines
     norm_start, norm_end = norms[0], norms[-1]
@@ -216,15 +274,13 @@ def get_vessel_walls(sorted_edge, norms, mask, r):
     return seg_mask, vessel_walls, np.array(CL)
 
 def get_flow_direction(path, time_windows):
-    assert type(time_windows) == list
-    assert type(time_windows[0]) == int
+    """ tangents over a per-point window: time_windows is an int or one int per path point """
+    time_windows = np.broadcast_to(np.asarray(time_windows), (len(path),))
+    assert np.issubdtype(time_windows.dtype, np.integer)
     ex_path = extend_path_tail(path, np.max(time_windows)).astype(np.float32)
-    tangent_angles = []
-    for i in range(0, len(path)):
-        tangent = ex_path[i+time_windows[i]-1] - ex_path[i]
-        tangent /= (np.linalg.norm(tangent)+1e-5)
-        tangent_angles.append(tangent)
-    tangent_angles = np.array(tangent_angles)
+    idx = np.arange(len(path))
+    tangent_angles = ex_path[idx+time_windows-1] - ex_path[idx]
+    tangent_angles /= (np.linalg.norm(tangent_angles, axis=1, keepdims=True)+1e-5)
     return tangent_angles
 
 def closest_pt(node, nodes):
@@ -232,7 +288,78 @@ def closest_pt(node, nodes):
     dist_2 = np.sum((nodes - node)**2, axis=1)
     return np.argmin(dist_2)
 
-def propagate_flow(flow, path, mask):
+def _reflect101(idx, n):
+    # cv2 BORDER_REFLECT_101 index mapping (default border of cv2.filter2D)
+    if n == 1:
+        return np.zeros_like(idx)
+    idx = np.abs(idx)
+    return np.where(idx > n-1, 2*(n-1) - idx, idx)
+
+def _box_sum_at(img, ys, xs, kernel):
+    """ cv2.filter2D(img, -1, np.ones(kernel)) evaluated only at pixels (ys, xs) """
+    kh, kw = kernel
+    yy = _reflect101(ys[:,None] + np.arange(kh) - kh//2, img.shape[0])
+    xx = _reflect101(xs[:,None] + np.arange(kw) - kw//2, img.shape[1])
+    return img[yy[:,:,None], xx[:,None,:]].sum(axis=(1,2))
+
+def _dilate_front(ys, xs, shape):
+    """ 3x3 neighbourhood (incl. the pixels themselves) of a pixel set, as unique flat indices """
+    H, W = shape
+    ny = (ys[:,None] + np.array([-1,-1,-1,0,0,0,1,1,1])).ravel()
+    nx = (xs[:,None] + np.array([-1,0,1,-1,0,1,-1,0,1])).ravel()
+    valid = (ny >= 0) & (ny < H) & (nx >= 0) & (nx < W)
+    return np.unique(ny[valid]*W + nx[valid])
+
+def _propagate_band(values, path_ori, mask, kernel, normalize):
+    """
+    Fill the mask ring by ring from the known path pixels, like the original
+    dilate/filter2D loop, but each ring (geodesic 8-connected layer) is found
+    from the previous front and the box filter is only evaluated on it.
+    """
+    H, W = mask.shape
+    inside = mask > 0
+    known = path_ori > 0
+    if not np.any(inside & ~known):
+        return values
+    known_w = known.astype(np.float32)
+    flat_known, flat_inside = known.ravel(), inside.ravel()
+    front = np.flatnonzero(flat_known)
+    # first ring also re-estimates path pixels lying outside the mask
+    outside = front[~flat_inside[front]]
+    while True:
+        cand = _dilate_front(front // W, front % W, (H, W))
+        ring = cand[flat_inside[cand] & ~flat_known[cand]]
+        if outside is not None:
+            ring = np.concatenate([ring, outside])
+        if len(ring) == 0:
+            break
+        ys, xs = ring // W, ring % W
+        new_vals = _box_sum_at(values, ys, xs, kernel)
+        counts = _box_sum_at(known_w, ys, xs, kernel) + 1e-5
+        if values.ndim == 3:
+            new_vals = new_vals / counts[:,None]
+        else:
+            new_vals = new_vals / counts
+        if normalize:
+            new_vals = new_vals / (np.linalg.norm(new_vals, axis=-1, keepdims=True)+1e-5)
+        values[ys, xs] = new_vals
+        # update the known set
+        if outside is not None:
+            known_w[outside // W, outside % W] = 0
+            flat_known[outside] = False
+            ring = ring[:len(ring)-len(outside)]
+            outside = None
+        known_w[ring // W, ring % W] = 1
+        flat_known[ring] = True
+        front = ring
+    return values
+
+@stage
+def propagate_flow(flow, path, mask, method='band'):
+    """
+    Extend the unit flow directions on the centerline path to every pixel of the mask.
+    method: 'band' (filter only the propagation front) or 'rings' (full-image filtering per ring)
+    """
     flow_prop = flow.copy()
     mask = mask.astype(np.float32)
     path_ori = path_to_img(path, img_shape=mask.shape)
@@ -241,6 +368,10 @@ def propagate_flow(flow, path, mask):
     # normalize the flow
     flow_prop *= path_ori[:,:,None].repeat(2, axis=2).astype(np.float32)
     flow_prop = flow_prop / (np.linalg.norm(flow_prop, axis=2)[:,:,None]+1e-5)
+    if method == 'band':
+        return _propagate_band(flow_prop, path_ori, mask, (7,7), normalize=True)
+    elif method != 'rings':
+        raise ValueError("method must be 'band' or 'rings'")
     # start to popagate the flow to fill the mask
     old_pts = path.copy()
     while np.sum(mask * (1-path_ori)) > 0:
@@ -263,13 +394,22 @@ def propagate_flow(flow, path, mask):
         old_pts = new_pts
     return flow_prop
 
-def propagate_velocity(velocity, path, mask, kernel=(5,5)):
+@stage
+def propagate_velocity(velocity, path, mask, kernel=(5,5), method='band'):
+    """
+    Extend the velocity on the centerline path to every pixel of the mask.
+    method: 'band' (filter only the propagation front) or 'rings' (full-image filtering per ring)
+    """
     velo_prop = velocity.copy()
     mask = mask.astype(np.float32)
     path_ori = path_to_img(path, img_shape=mask.shape)
     # smooth the flow along the path
     velo_prop = cv2.filter2D(velo_prop.copy(), -1, np.ones(kernel)) / (cv2.filter2D(path_ori.copy(), -1 ,np.ones(kernel))+1e-5)
     velo_prop *= path_ori.astype(np.float32)
+    if method == 'band':
+        return _propagate_band(velo_prop, path_ori, mask, kernel, normalize=False)
+    elif method != 'rings':
+        raise ValueError("method must be 'band' or 'rings'")
     # start to popagate the flow to fill the mask
     old_pts = path.copy()
     while np.sum(mask * (1-path_ori)) > 0:
@@ -288,4 +428,3 @@ def propagate_velocity(velocity, path, mask, kernel=(5,5)):
         path_ori = path_dilate
         old_pts = new_pts
     return velo_prop
-
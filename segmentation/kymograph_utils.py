@@ -2,9 +2,14 @@ import numpy as np
 import cv2
 import os
 import glob
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from flowmap_utils import *
 from scipy.ndimage import map_coordinates
 from skimage.transform import radon
+from scipy.sparse import coo_matrix
+from numpy.lib.stride_tricks import sliding_window_view
+
+from stage_utils import stage
 
 def get_parallel_lines(CL, norms, spacings):
     num_pts = len(CL)
@@ -18,18 +23,103 @@ def get_parallel_lines(CL, norms, spacings):
     lines_array = np.array(lines_array)
     return lines_array
 
+def _frame_paths(video_path):
+    return sorted(glob.glob(os.path.join(video_path,'*.png')))
+
+@stage
 def load_video(video_path):
-    frame_path = sorted(glob.glob(os.path.join(video_path,'*.png')))
+    frame_path = _frame_paths(video_path)
     # load the video
     print('Loading video:', video_path)
-    video = []
-    for frame in frame_path:
-        img = cv2.imread(frame, -1).astype(np.float32)
-        video.append(img)
-    video = np.array(video)
+    if not frame_path:
+        return np.array([])
+    # fill a preallocated stack instead of copying a list of frames
+    first = cv2.imread(frame_path[0], -1)
+    video = np.empty((len(frame_path),)+first.shape, dtype=np.float32)
+    video[0] = first
+    for i, frame in enumerate(frame_path[1:], 1):
+        video[i] = cv2.imread(frame, -1)
     print('Video loaded: ', video.shape)
     return video
 
+def _video_cache_is_fresh(cache_path, frame_path):
+    if not os.path.exists(cache_path):
+        return False
+    if os.path.getmtime(cache_path) < max(os.path.getmtime(f) for f in frame_path):
+        return False
+    return np.load(cache_path, mmap_mode='r').shape[0] == len(frame_path)
+
+@stage
+def open_video(video_path, cache_path=None, n_threads=8):
+    """
+    Lazy (T,H,W) frame stack of the PNGs in video_path, memory-mapped read-only in the
+    frames' native dtype. The first call decodes the frames in parallel threads straight
+    into a raw .npy cache (default <video_path>/frames_cache.npy); later calls only map it.
+    """
+    frame_path = _frame_paths(video_path)
+    if not frame_path:
+        raise FileNotFoundError(f'No .png frames in {video_path}')
+    if cache_path is None:
+        cache_path = os.path.join(video_path, 'frames_cache.npy')
+    if not _video_cache_is_fresh(cache_path, frame_path):
+        print('Caching video:', video_path, '->', cache_path)
+        first = cv2.imread(frame_path[0], -1)
+        tmp_path = cache_path + '.part'
+        stack = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=first.dtype,
+                                          shape=(len(frame_path),)+first.shape)
+        def decode(i):
+            stack[i] = cv2.imread(frame_path[i], -1)
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            list(pool.map(decode, range(len(frame_path))))
+        stack.flush()
+        del stack
+        os.replace(tmp_path, cache_path)
+    video = np.load(cache_path, mmap_mode='r')
+    print('Video mapped: ', video.shape, video.dtype)
+    return video
+
+def read_roi(video, y0, y1, x0, x1, t0=0, t1=None, dtype=np.float32):
+    """ frames t0:t1 of a (lazy) video restricted to rows y0:y1 and columns x0:x1 """
+    return np.asarray(video[t0:t1, y0:y1, x0:x1], dtype=dtype)
+
+def sample_lines(video, lines, t0=0, t1=None):
+    """
+    Bilinear samples of frames t0:t1 at the points lines[..., (x, y)], shape (T,)+lines.shape[:-1].
+    Only the bounding box of the lines is read from the video.
+    """
+    lines = np.asarray(lines, dtype=np.float32)
+    H, W = video.shape[1:3]
+    x0 = max(int(np.floor(lines[...,0].min()))-1, 0)
+    y0 = max(int(np.floor(lines[...,1].min()))-1, 0)
+    x1 = min(int(np.ceil(lines[...,0].max()))+2, W)
+    y1 = min(int(np.ceil(lines[...,1].max()))+2, H)
+    roi = read_roi(video, y0, y1, x0, x1, t0, t1)
+    n_t = roi.shape[0]
+    pts = lines.reshape(-1, 2)
+    coords = np.stack([np.repeat(np.arange(n_t), len(pts)),
+                       np.tile(pts[:,1]-y0, n_t), np.tile(pts[:,0]-x0, n_t)])
+    # order=1 at integer t coordinates, so frames never mix
+    samples = map_coordinates(roi, coords, order=1)
+    return samples.reshape((n_t,)+lines.shape[:-1])
+
+@stage
+def extract_kymographs(video, lines_array, t_chunk=None):
+    """
+    Kymographs of every line in lines_array (n_lines, n_pts, (x,y)) over all frames of
+    video (T,H,W), returned as (n_lines, T, n_pts) float32. An in-memory video is sampled
+    in one interpolation call; a memory-mapped one (open_video) is streamed t_chunk frames
+    at a time so only a chunk of the lines' bounding box is ever read.
+    """
+    lines_array = np.asarray(lines_array, dtype=np.float32)
+    T = video.shape[0]
+    if t_chunk is None:
+        t_chunk = 64 if isinstance(video, np.memmap) else T
+    t_chunk = max(int(t_chunk), 1)
+    kymos = np.empty((lines_array.shape[0], T, lines_array.shape[1]), dtype=np.float32)
+    for t0 in range(0, T, t_chunk):
+        kymos[:, t0:t0+t_chunk] = sample_lines(video, lines_array, t0, t0+t_chunk).transpose(1, 0, 2)
+    return kymos
+
 def compenstate_kymograph(vid_centerline):
     Gt = np.mean(vid_centerline.astype(np.float32), axis=0, keepdims=True)
     Gd = np.mean(vid_centerline.astype(np.float32), axis=1, keepdims=True)
@@ -42,9 +132,84 @@ def compenstate_kymograph(vid_centerline):
     r = r - np.mean(r)
     return r
 
-def kymograph_radon_transform(r, angle_range, time_window, time_step, dist_window, dist_step):
+def radon_operator(shape, theta):
+    """
+    Sparse matrix form of skimage.transform.radon(circle=False) for a fixed window
+    shape and angle grid. Rows are ordered (angle, projection position), columns
+    are the raveled window pixels, so sinogram = P @ tile.ravel().
+    """
+    h, w = shape
+    diagonal = np.sqrt(2) * max(shape)
+    pad = [int(np.ceil(diagonal - s)) for s in shape]
+    pad_before = [(s + p) // 2 - s // 2 for s, p in zip(shape, pad)]
+    n_pos = h + pad[0]
+    center = n_pos // 2
+    ys, xs = np.mgrid[:n_pos, :n_pos].astype(np.float64)
+    rows, cols, vals = [], [], []
+    for i, angle in enumerate(np.deg2rad(theta)):
+        cos_a, sin_a = np.cos(angle), np.sin(angle)
+        # inverse rotation used by radon's warp, shifted into window coordinates
+        x_in = cos_a*xs + sin_a*ys - center*(cos_a + sin_a - 1) - pad_before[1]
+        y_in = -sin_a*xs + cos_a*ys - center*(cos_a - sin_a - 1) - pad_before[0]
+        r0, c0 = np.floor(y_in), np.floor(x_in)
+        dr, dc = y_in - r0, x_in - c0
+        r0, c0 = r0.astype(np.int64), c0.astype(np.int64)
+        # bilinear weights of the 4 neighbours, zero outside the window
+        for rr, cc, wt in [(r0, c0, (1-dr)*(1-dc)), (r0, c0+1, (1-dr)*dc),
+                           (r0+1, c0, dr*(1-dc)), (r0+1, c0+1, dr*dc)]:
+            valid = (rr >= 0) & (rr < h) & (cc >= 0) & (cc < w) & (wt != 0)
+            rows.append(i*n_pos + xs[valid].astype(np.int64))
+            cols.append(rr[valid]*w + cc[valid])
+            vals.append(wt[valid])
+    P = coo_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+                   shape=(len(theta)*n_pos, h*w)).tocsr()
+    return P, n_pos
+
+def _radon_velocities(r, dists, P, n_pos, theta, time_window, time_step, dist_window, chunk_size=256):
+    # all tiles of the requested distance positions as (n_dist, n_time, time_window, dist_window)
+    tiles = sliding_window_view(r, (time_window, dist_window))[::time_step, dists]
+    tiles = tiles.transpose(1, 0, 2, 3).reshape(-1, time_window*dist_window)
+    degs = np.empty(len(tiles), dtype=np.float64)
+    for i in range(0, len(tiles), chunk_size):
+        seg = tiles[i:i+chunk_size].astype(np.float64)
+        sinograms = (P @ seg.T).reshape(len(theta), n_pos, -1)
+        degs[i:i+chunk_size] = theta[np.argmax(np.std(sinograms, axis=1), axis=0)]
+    return np.tan(np.deg2rad(degs)).reshape(len(dists), -1)
+
+_RADON_WORKER = {}
+
+def _init_radon_worker(r, P, n_pos, theta):
+    _RADON_WORKER.update(r=r, P=P, n_pos=n_pos, theta=theta)
+
+def _radon_worker(dists, time_window, time_step, dist_window):
+    w = _RADON_WORKER
+    return _radon_velocities(w['r'], dists, w['P'], w['n_pos'], w['theta'], time_window, time_step, dist_window)
+
+@stage('radon')
+def kymograph_radon_transform(r, angle_range, time_window, time_step, dist_window, dist_step, method='batched', n_workers=None):
+    """
+    Velocity (tan of the angle of max sinogram variance) for every (dist, time) window of the kymograph r.
+    method='batched' applies a precomputed sparse Radon operator to stacked tiles;
+    method='loop' calls skimage radon per tile. n_workers>1 splits the distance axis across processes.
+    """
     theta = np.linspace(angle_range[0], angle_range[1], int((angle_range[1]-angle_range[0])*10), endpoint=False)
     drange, trange = r.shape[1], r.shape[0]
+    if method == 'batched':
+        P, n_pos = radon_operator((time_window, dist_window), theta)
+        dists = np.arange(0, drange-dist_window+1, dist_step)
+        if n_workers is None or n_workers <= 1:
+            vs_spacing = _radon_velocities(r, dists, P, n_pos, theta, time_window, time_step, dist_window)
+        else:
+            dist_groups = [d for d in np.array_split(dists, n_workers) if len(d)]
+            with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_radon_worker,
+                                     initargs=(r, P, n_pos, theta)) as pool:
+                vs_spacing = np.concatenate(list(pool.map(_radon_worker, dist_groups,
+                                                          [time_window]*len(dist_groups),
+                                                          [time_step]*len(dist_groups),
+                                                          [dist_window]*len(dist_groups))))
+        return list(vs_spacing)
+    elif method != 'loop':
+        raise ValueError("method must be 'batched' or 'loop'")
     vs_spacing = []
     for dist in range(0, drange-dist_window+1, dist_step):
         vs =[]
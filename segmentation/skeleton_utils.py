@@ -0,0 +1,201 @@
+import numpy as np
+from scipy import ndimage as ndi
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import breadth_first_order, connected_components, shortest_path
+
+# Pixel graph of a binary skeleton: 8-neighbour convolution for degrees / endpoints,
+# plantcv's branch templates for junctions, CSR adjacency between skeleton pixels and
+# array-at-a-time BFS.
+# Nodes are the skeleton pixels in row-major order; coords are (row, col).
+
+OFFSETS = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
+MAX_DIST_ENTRIES = 2**25  # endpoint x node distances held at once for cyclic skeletons
+
+def neighbour_count(skel):
+    """ number of 8-neighbours of every skeleton pixel (0 off the skeleton) """
+    skel = np.asarray(skel) > 0
+    kernel = np.ones((3, 3), np.uint8)
+    kernel[1, 1] = 0
+    return ndi.convolve(skel.astype(np.uint8), kernel, mode='constant') * skel
+
+def find_endpoints(skel):
+    return neighbour_count(skel) == 1
+
+def _branch_lut():
+    # plantcv find_branch_pts' hit-or-miss templates (1 = on, -1 = off, 0 = any) in every
+    # rotation, as a lookup table over the 9-bit codes of a 3x3 neighbourhood
+    t = np.array([[-1, 1, -1], [1, 1, 1], [-1, -1, -1]]), np.array([[1, -1, 1], [-1, 1, -1], [1, -1, -1]])
+    y = np.array([[1, -1, 1], [0, 1, 0], [0, 1, 0]]), np.array([[-1, 1, -1], [1, 1, 0], [-1, 0, 1]])
+    bits = (np.arange(512)[:, None] >> np.arange(9)) & 1
+    lut = np.zeros(512, bool)
+    for kernel in t + y:
+        for k in range(4):
+            k = np.rot90(kernel, k).ravel()
+            lut |= np.all((bits == 1) | (k != 1), axis=1) & np.all((bits == 0) | (k != -1), axis=1)
+    return lut
+
+BRANCH_LUT = _branch_lut()
+CODE_WEIGHTS = (2 ** np.arange(9)).reshape(3, 3)
+
+def find_junctions(skel):
+    """
+    Branch points as plantcv's find_branch_pts (T and Y shaped neighbourhoods), so the
+    3-pixel corners of 8-connected lines are not junctions.
+    """
+    skel = np.asarray(skel) > 0
+    code = ndi.correlate(skel.astype(np.int16), CODE_WEIGHTS, mode='constant')
+    return BRANCH_LUT[code] & skel
+
+def skeleton_graph(skel):
+    """
+    coords (n, 2) of the skeleton pixels and their 8-neighbour adjacency as a CSR matrix
+    (adj.indptr / adj.indices); built with a sorted-index lookup per offset, no image-sized
+    index map.
+    """
+    skel = np.asarray(skel) > 0
+    H, W = skel.shape
+    rows, cols = np.nonzero(skel)
+    lin = rows.astype(np.int64) * W + cols
+    src, dst = [], []
+    for dr, dc in OFFSETS:
+        r, c = rows + dr, cols + dc
+        ok = np.flatnonzero((r >= 0) & (r < H) & (c >= 0) & (c < W))
+        target = r[ok].astype(np.int64) * W + c[ok]
+        j = np.minimum(np.searchsorted(lin, target), len(lin) - 1)
+        hit = lin[j] == target
+        src.append(ok[hit])
+        dst.append(j[hit])
+    src, dst = np.concatenate(src), np.concatenate(dst)
+    adj = csr_matrix((np.ones(len(src), np.int8), (src, dst)), shape=(len(lin), len(lin)))
+    return np.stack([rows, cols], 1), adj
+
+def degree(adj):
+    return np.diff(adj.indptr)
+
+def bfs(adj, sources):
+    """
+    BFS from one or several sources (through a virtual root linked to all of them) with
+    csgraph's breadth_first_order; hop distances follow from the parents by pointer
+    doubling. Returns distances (-1 = unreached) and BFS parents (-1 = root/unreached).
+    """
+    n = adj.shape[0]
+    sources = np.unique(np.atleast_1d(sources))
+    aug = csr_matrix((np.ones(adj.nnz + len(sources), np.int8),
+                      np.concatenate([adj.indices, sources]),
+                      np.append(adj.indptr, adj.nnz + len(sources))), shape=(n + 1, n + 1))
+    order, pred = breadth_first_order(aug, n, directed=True, return_predecessors=True)
+    parent = pred[:n].astype(np.int64)
+    parent[(parent < 0) | (parent == n)] = -1
+    reached = np.zeros(n, bool)
+    reached[order[1:]] = True
+    hop = np.where(parent >= 0, parent, np.arange(n))
+    dist = (parent >= 0).astype(np.int64)
+    while True:
+        nxt = hop[hop]
+        if np.array_equal(nxt, hop):
+            break
+        dist += dist[hop]  # roots point to themselves with distance 0
+        hop = nxt
+    dist[~reached] = -1
+    return dist, parent
+
+def trace_parents(parent, node):
+    """ nodes from the BFS root to node """
+    path = [node]
+    while parent[path[-1]] >= 0:
+        path.append(parent[path[-1]])
+    return np.array(path[::-1])
+
+def _farthest_per_component(dist, labels, n_comp):
+    # node of maximal distance in every component (lowest index on ties)
+    order = np.lexsort((np.arange(len(dist)), -dist, labels))
+    first = np.searchsorted(labels[order], np.arange(n_comp))
+    return order[first]
+
+def longest_path(skel=None, coords=None, adj=None):
+    """
+    Longest of the shortest paths between two endpoints of the skeleton (the notebook's
+    networkx search over all endpoint pairs), as ordered (row, col) coords.
+    Acyclic skeletons use two BFS sweeps (exact on trees); skeletons with cycles run
+    shortest_path from every endpoint in chunks.
+    """
+    if adj is None:
+        coords, adj = skeleton_graph(skel)
+    n = adj.shape[0]
+    if n == 0:
+        return np.zeros((0, 2), np.int64)
+    n_comp, labels = connected_components(adj, directed=False)
+    ends = np.flatnonzero(degree(adj) == 1)
+    if adj.nnz // 2 == n - n_comp or len(ends) < 2:
+        # double sweep, all components at once: farthest node from any node, then from there
+        dist, _ = bfs(adj, _farthest_per_component(np.zeros(n, np.int64), labels, n_comp))
+        a = _farthest_per_component(dist, labels, n_comp)
+        dist, parent = bfs(adj, a)
+        b = _farthest_per_component(dist, labels, n_comp)
+        return coords[trace_parents(parent, b[np.argmax(dist[b])])]
+    best, pair = -1, None
+    chunk = max(1, MAX_DIST_ENTRIES // n)
+    for i in range(0, len(ends), chunk):
+        d = shortest_path(adj, unweighted=True, directed=False, indices=ends[i:i + chunk])[:, ends]
+        d[~np.isfinite(d)] = -1
+        k = np.unravel_index(np.argmax(d), d.shape)
+        if d[k] > best:
+            best, pair = d[k], (ends[i + k[0]], ends[k[1]])
+    _, parent = bfs(adj, pair[0])
+    return coords[trace_parents(parent, pair[1])]
+
+def skeleton_segments(skel, dilate_junctions=True):
+    """
+    Split the skeleton at its junctions (dilated by one pixel as in plantcv's
+    segment_skeleton) and return every segment as ordered (row, col) coords.
+    """
+    skel = np.asarray(skel) > 0
+    cut = find_junctions(skel)
+    if dilate_junctions:
+        cut = ndi.binary_dilation(cut, np.ones((3, 3), bool))
+    coords, adj = skeleton_graph(skel & ~cut)
+    n = adj.shape[0]
+    if n == 0:
+        return []
+    n_comp, labels = connected_components(adj, directed=False)
+    deg = degree(adj)
+    # start every segment at one of its ends; closed loops are opened next to their first node
+    start = _farthest_per_component((deg <= 1).astype(np.int64), labels, n_comp)
+    loops = start[deg[start] > 1]
+    if len(loops):
+        cut_to = adj.indices[adj.indptr[loops]]
+        adj = adj.tolil()
+        adj[loops, cut_to] = 0
+        adj[cut_to, loops] = 0
+        adj = adj.tocsr()
+        adj.eliminate_zeros()
+    dist, _ = bfs(adj, start)
+    order = np.lexsort((dist, labels))
+    bounds = np.searchsorted(labels[order], np.arange(1, n_comp))
+    return [coords[seg] for seg in np.split(order, bounds)]
+
+def prune_branches(skel, min_length):
+    """
+    Remove terminal branches (endpoint to junction) shorter than min_length pixels, repeating
+    until none is left. Isolated segments without junctions are kept.
+    """
+    skel = np.asarray(skel) > 0
+    skel = skel.copy()
+    while True:
+        coords, adj = skeleton_graph(skel)
+        deg = degree(adj)
+        junction = deg >= 3
+        if not junction.any():
+            return skel
+        keep = np.flatnonzero(~junction)
+        n_comp, labels = connected_components(adj[keep][:, keep], directed=False)
+        sizes = np.bincount(labels, minlength=n_comp)
+        terminal = np.zeros(n_comp, bool)
+        terminal[labels[deg[keep] == 1]] = True
+        attached = np.zeros(n_comp, bool)
+        attached[labels[(adj[keep] @ junction.astype(np.int8)) > 0]] = True
+        spur = terminal & attached & (sizes < min_length)
+        if not spur.any():
+            return skel
+        rr, cc = coords[keep[spur[labels]]].T
+        skel[rr, cc] = False
@@ -0,0 +1,37 @@
+import importlib.util
+import os
+import sys
+import warnings
+
+# `stage` (instrument_utils, in the repo root) for the segmentation modules. Entry points put
+# the root on sys.path; notebooks run from segmentation/ do not, so the module is then loaded
+# from its file instead of adding the root to sys.path, where its convert_image.py would
+# shadow image_conversion/convert_image.py.
+
+ROOT_MODULE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'instrument_utils.py')
+
+def _load_instrument_utils():
+    try:
+        import instrument_utils
+        return instrument_utils
+    except ImportError:
+        pass
+    if not os.path.exists(ROOT_MODULE):
+        return None
+    spec = importlib.util.spec_from_file_location('instrument_utils', ROOT_MODULE)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['instrument_utils'] = module   # one module (and one run) for every later import
+    spec.loader.exec_module(module)
+    return module
+
+_instrument_utils = _load_instrument_utils()
+
+if _instrument_utils is not None:
+    stage = _instrument_utils.stage
+else:
+    if os.environ.get('CAPILLARY_PROFILE'):
+        warnings.warn(f'CAPILLARY_PROFILE is set but {ROOT_MODULE} is missing: stages are not recorded')
+
+    def stage(name=None):
+        """No-op stand-in for instrument_utils.stage (decorator use only)."""
+        return name if callable(name) else (lambda func: func)
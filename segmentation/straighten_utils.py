@@ -0,0 +1,132 @@
+import hashlib
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import numpy as np
+from scipy.interpolate import splprep, splev
+from scipy.sparse import csr_matrix
+
+# Capillary straightening as a precomputed gather: the spline fit, normals and bilinear
+# weights of a capillary geometry are built once (and cached), then every new frame, frame
+# stack or exposure of the same field is straightened by one sparse-matrix gather.
+# Straightened patches are (n_across, n_along) = (2*width+1, centerline length), as in the
+# notebooks; coordinates are (row, col).
+
+MAX_GRIDS = 256
+
+_GRIDS = OrderedDict()
+
+@dataclass
+class SamplingGrid:
+    centerline: np.ndarray  # (L, 2) resampled centerline
+    normals: np.ndarray     # (L, 2) unit sampling direction per centerline point
+    offsets: np.ndarray     # (n_across,) distances along the normal
+    box: tuple              # (y0, y1, x0, x1) pixels read from every frame
+    matrix: csr_matrix      # (n_across*L, box pixels) bilinear weights, 0 outside the image
+
+    @property
+    def shape(self):
+        return len(self.offsets), len(self.centerline)
+
+def clear_cache():
+    _GRIDS.clear()
+
+def resample_centerline(centerline, n_pts=None, smooth=0):
+    """ interpolating (smooth=0) parametric spline through the ordered centerline, n_pts samples """
+    centerline = np.asarray(centerline, dtype=np.float64)
+    tck, u = splprep([centerline[:, 0], centerline[:, 1]], s=smooth)
+    y_new, x_new = splev(np.linspace(0, 1, n_pts or len(centerline)), tck)
+    return np.column_stack([y_new, x_new])
+
+def centerline_normals(centerline):
+    """ unit normals (row, col) from central differences; the end points repeat their neighbour """
+    d = centerline[2:] - centerline[:-2]
+    length = np.hypot(d[:, 1], d[:, 0])
+    normals = np.stack([d[:, 1] / length, -d[:, 0] / length], axis=1)
+    return np.concatenate([normals[:1], normals, normals[-1:]])
+
+def bilinear_weights(rows, cols, shape):
+    """
+    Flat indices and weights of the 4 neighbours of every (row, col) sample, reproducing
+    map_coordinates(order=1, mode='constant', cval=0): samples outside the image get 0.
+    """
+    H, W = shape
+    inside = (rows >= 0) & (rows <= H - 1) & (cols >= 0) & (cols <= W - 1)
+    r0 = np.clip(np.floor(rows), 0, H - 1).astype(np.int64)
+    c0 = np.clip(np.floor(cols), 0, W - 1).astype(np.int64)
+    fr, fc = rows - r0, cols - c0
+    r1, c1 = np.minimum(r0 + 1, H - 1), np.minimum(c0 + 1, W - 1)
+    index = np.stack([r0 * W + c0, r0 * W + c1, r1 * W + c0, r1 * W + c1])
+    weight = np.stack([(1 - fr) * (1 - fc), (1 - fr) * fc, fr * (1 - fc), fr * fc]) * inside
+    return index, weight
+
+def _grid_key(centerline, width, shape, n_pts, direction, smooth, resample):
+    h = hashlib.sha1(np.ascontiguousarray(centerline, dtype=np.float64).tobytes())
+    h.update(repr((width, tuple(shape), n_pts, direction, smooth, resample)).encode())
+    return h.hexdigest()
+
+def sampling_grid(centerline, width, shape, n_pts=None, direction='normal', smooth=0, resample=True):
+    """
+    Sampling grid of one capillary (cached per geometry).
+    centerline: ordered (row, col) points
+    width: samples go from -width to +width pixels across the centerline
+    shape: (H, W) of the frames the grid will be applied to
+    direction: 'normal' (along the centerline normals), 'horizontal' or 'vertical'
+    resample: fit the spline first (notebook flow); False uses the points as given
+    """
+    key = _grid_key(centerline, width, shape, n_pts, direction, smooth, resample)
+    if key in _GRIDS:
+        _GRIDS.move_to_end(key)
+        return _GRIDS[key]
+    cl = resample_centerline(centerline, n_pts, smooth) if resample else np.asarray(centerline, np.float64)
+    if direction == 'normal':
+        normals = centerline_normals(cl)
+    elif direction in ('horizontal', 'vertical'):
+        normals = np.tile([0., 1.] if direction == 'horizontal' else [1., 0.], (len(cl), 1))
+    else:
+        raise ValueError(f"unknown direction '{direction}'")
+    offsets = np.arange(-width, width + 1, dtype=np.float64)
+    rows = cl[None, :, 0] + offsets[:, None] * normals[None, :, 0]
+    cols = cl[None, :, 1] + offsets[:, None] * normals[None, :, 1]
+    # read only the bounding box of the grid from every frame
+    H, W = shape
+    y0, x0 = int(np.clip(np.floor(rows.min()), 0, H - 1)), int(np.clip(np.floor(cols.min()), 0, W - 1))
+    y1, x1 = int(min(np.floor(rows.max()) + 2, H)), int(min(np.floor(cols.max()) + 2, W))
+    y1, x1 = max(y1, y0 + 1), max(x1, x0 + 1)
+    index, weight = bilinear_weights(rows - y0, cols - x0, (y1 - y0, x1 - x0))
+    # samples outside the image are outside the box too; mask them against the full frame
+    weight *= (rows >= 0) & (rows <= H - 1) & (cols >= 0) & (cols <= W - 1)
+    n = rows.size
+    matrix = csr_matrix((weight.reshape(4, n).T.ravel(), index.reshape(4, n).T.ravel(), np.arange(0, 4*n + 1, 4)),
+                        shape=(n, (y1 - y0) * (x1 - x0)))
+    grid = SamplingGrid(cl, normals, offsets, (y0, y1, x0, x1), matrix)
+    _GRIDS[key] = grid
+    while len(_GRIDS) > MAX_GRIDS:
+        _GRIDS.popitem(last=False)
+    return grid
+
+def straighten(frames, grids):
+    """
+    Apply sampling grid(s) to a frame (H, W) or a stack (T, H, W) (arrays or memmaps).
+    Returns one patch per grid: (n_across, L) for a frame, (T, n_across, L) for a stack;
+    a single grid returns its patch directly.
+    """
+    single = isinstance(grids, SamplingGrid)
+    out = []
+    for g in ([grids] if single else grids):
+        y0, y1, x0, x1 = g.box
+        box = np.asarray(frames[..., y0:y1, x0:x1])
+        lead = box.shape[:-2]
+        flat = box.reshape((-1, box.shape[-2] * box.shape[-1]))
+        patch = (g.matrix @ flat.T).T.reshape(lead + g.shape)
+        out.append(patch.astype(np.result_type(box.dtype, np.float32)))
+    return out[0] if single else out
+
+def straighten_capillaries(frames, centerlines, width=30, **grid_kwargs):
+    """ straighten several capillaries of a frame or frame stack; grids are built once per geometry """
+    shape = frames.shape[-2:]
+    return straighten(frames, [sampling_grid(cl, width, shape, **grid_kwargs) for cl in centerlines])
+
+def profile_stats(straight):
+    """ mean and std of the across-capillary profile over the centerline (last axis) """
+    return straight.mean(axis=-1), straight.std(axis=-1)
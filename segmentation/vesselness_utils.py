@@ -0,0 +1,194 @@
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+from scipy.ndimage import gaussian_filter, gaussian_filter1d
+from scipy.sparse import csr_matrix
+
+from stage_utils import stage
+
+# Multi-scale Hessian vesselness (meijering / frangi as in skimage.filters) computed once
+# per (image, sigma): large scales run on a decimated Gaussian pyramid level, and the
+# per-scale Hessian eigenvalues are cached so re-running with other sigma ranges or
+# thresholds only recombines cached scales.
+
+LEVEL_SIGMA = 4.        # a scale runs on the coarsest level where sigma/2**level >= LEVEL_SIGMA
+PYRAMID_SIGMA = 1.      # anti-alias blur (in pixels of the finer level) before each 2x decimation
+CACHE_MAX_BYTES = 2**31
+
+_CACHE = OrderedDict()  # key -> array(s), least recently used first
+_CACHE_BYTES = [0]
+
+def image_hash(image):
+    image = np.ascontiguousarray(image)
+    h = hashlib.blake2b(image.view(np.uint8).ravel() if image.size else b'', digest_size=16)
+    h.update(str((image.shape, image.dtype.str)).encode())
+    return h.hexdigest()
+
+def clear_cache():
+    _CACHE.clear()
+    _CACHE_BYTES[0] = 0
+
+def _cache_get(key):
+    if key in _CACHE:
+        _CACHE.move_to_end(key)
+        return _CACHE[key]
+    return None
+
+def _cache_put(key, value):
+    nbytes = sum(v.nbytes for v in value) if isinstance(value, tuple) else value.nbytes
+    _CACHE[key] = value
+    _CACHE_BYTES[0] += nbytes
+    while _CACHE_BYTES[0] > CACHE_MAX_BYTES and len(_CACHE) > 1:
+        _, old = _CACHE.popitem(last=False)
+        _CACHE_BYTES[0] -= sum(v.nbytes for v in old) if isinstance(old, tuple) else old.nbytes
+
+def level_for_sigma(sigma, max_level=None):
+    level = int(np.floor(np.log2(max(sigma / LEVEL_SIGMA, 1.))))
+    return level if max_level is None else min(level, max_level)
+
+def pyramid_level(image, level, mode='reflect', key=None, cache=True):
+    """
+    Gaussian pyramid level of image (level 0 = image) and the blur it already carries,
+    in full-resolution pixels. Pixel j of a level sits at full-resolution pixel j*2**level.
+    """
+    if level == 0:
+        return image, 0.
+    if cache:
+        key = key or image_hash(image)
+        cached = _cache_get((key, 'pyr', level, mode))
+        if cached is not None:
+            return cached[0], float(cached[1])
+    finer, blur = pyramid_level(image, level - 1, mode, key, cache)
+    coarse = gaussian_filter(finer, PYRAMID_SIGMA, mode=mode)[::2, ::2].astype(np.float32)
+    blur = np.sqrt(blur**2 + (PYRAMID_SIGMA * 2**(level - 1))**2)
+    if cache:
+        _cache_put((key, 'pyr', level, mode), (coarse, np.array(blur)))
+    return coarse, blur
+
+def hessian(image, sigma, mode='reflect'):
+    """
+    Hessian (Hrr, Hrc, Hcc) as skimage.feature.hessian_matrix(use_gaussian_derivatives=True):
+    two first-order Gaussian derivative passes at sigma/sqrt(2), which also reproduces its
+    border response.
+    """
+    image = np.asarray(image, dtype=np.float32)
+    s = sigma / np.sqrt(2)
+    truncate = 8 if sigma > 1 else 100
+    g = lambda img, axis, order: gaussian_filter1d(img, s, axis=axis, order=order, mode=mode, truncate=truncate)
+    grad_r = g(g(image, 1, 0), 0, 1)
+    grad_c = g(g(image, 0, 0), 1, 1)
+    r0 = g(grad_r, 0, 0)
+    Hrr = g(g(grad_r, 1, 0), 0, 1)
+    Hrc = g(r0, 1, 1)
+    Hcc = g(g(grad_c, 0, 0), 1, 1)
+    return Hrr, Hrc, Hcc
+
+def eigvals_2x2(Hrr, Hrc, Hcc):
+    """ eigenvalues of the symmetric 2x2 Hessian, in decreasing order (like skimage) """
+    tr = (Hrr + Hcc) / 2
+    d = np.sqrt(((Hrr - Hcc) / 2)**2 + Hrc**2)
+    return np.stack([tr + d, tr - d])
+
+def hessian_eigvals(image, sigma, mode='reflect', max_level=None, key=None, cache_dir=None, cache=True):
+    """
+    Hessian eigenvalues (2, h, w) of image at scale sigma (full-resolution pixels) and the
+    pyramid level they were computed on (h, w = level shape). Values are per full-resolution
+    pixel^2. Results are cached in memory (and in cache_dir as .npy if given) unless cache=False.
+    """
+    level = level_for_sigma(sigma, max_level)
+    if cache:
+        key = key or image_hash(image)
+        ckey = (key, 'eig', float(sigma), level, mode)
+        cached = _cache_get(ckey)
+        if cached is not None:
+            return cached, level
+    path = os.path.join(cache_dir, f'{key}_eig_{float(sigma):.4f}_{level}_{mode}.npy') if cache and cache_dir else None
+    if path and os.path.exists(path):
+        eig = np.load(path)
+    else:
+        img, blur = pyramid_level(np.asarray(image, dtype=np.float32), level, mode, key, cache)
+        f = 2**level
+        s = np.sqrt(max(sigma**2 - blur**2, (0.5*sigma)**2)) / f
+        eig = (eigvals_2x2(*hessian(img, s, mode)) / f**2).astype(np.float32)
+        if path:
+            os.makedirs(cache_dir, exist_ok=True)
+            np.save(path, eig)
+    if cache:
+        _cache_put(ckey, eig)
+    return eig, level
+
+def _interp_matrix(n_out, n_in, factor):
+    # linear interpolation of level samples at full-resolution positions x/factor
+    x = np.minimum(np.arange(n_out) / factor, n_in - 1)
+    x0 = np.minimum(np.floor(x).astype(np.int64), max(n_in - 2, 0))
+    w1 = x - x0 if n_in > 1 else np.zeros(n_out)
+    rows = np.repeat(np.arange(n_out), 2)
+    cols = np.stack([x0, np.minimum(x0 + 1, n_in - 1)], 1).ravel()
+    vals = np.stack([1 - w1, w1], 1).ravel()
+    return csr_matrix((vals, (rows, cols)), shape=(n_out, n_in))
+
+def upsample(small, shape, level):
+    """ bring a pyramid level map back to full resolution (linear interpolation) """
+    if level == 0:
+        return small
+    f = 2**level
+    Ay = _interp_matrix(shape[0], small.shape[0], f)
+    Ax = _interp_matrix(shape[1], small.shape[1], f)
+    return np.asarray((Ay @ (Ax @ small.T).T), dtype=np.float32)
+
+def meijering_vals(image, sigma, alpha=None, black_ridges=True, mode='reflect', max_level=None,
+                   key=None, cache_dir=None, cache=True):
+    """ un-normalized meijering response of one scale (at pyramid level resolution) and its level """
+    eig, level = hessian_eigvals(image, sigma, mode, max_level, key, cache_dir, cache)
+    alpha = 1 / 3 if alpha is None else alpha
+    if not black_ridges:
+        eig = -eig[::-1]  # eigenvalues of the negated image, still in decreasing order
+    e1, e2 = eig
+    l1, l2 = e1 + alpha * e2, e2 + alpha * e1
+    vals = np.where(np.abs(l1) >= np.abs(l2), l1, l2)
+    return np.maximum(vals, 0), level
+
+@stage
+def meijering(image, sigmas=range(1, 10, 2), alpha=None, black_ridges=True, mode='reflect',
+              max_level=None, cache_dir=None, scale_max=None, cache=True):
+    """
+    skimage.filters.meijering on cached, pyramid-accelerated Hessian eigenvalues.
+    scale_max: per-sigma normalizers used instead of each scale's maximum over image
+    (so tiles of one frame share the normalization of a calibration region).
+    """
+    image = np.asarray(image, dtype=np.float32)
+    key = image_hash(image) if cache else None
+    filtered_max = np.zeros_like(image)
+    for i, sigma in enumerate(sigmas):
+        vals, level = meijering_vals(image, sigma, alpha, black_ridges, mode, max_level, key, cache_dir, cache)
+        max_val = vals.max() if scale_max is None else scale_max[i]
+        if max_val > 0:
+            vals /= max_val
+        filtered_max = np.maximum(filtered_max, upsample(vals, image.shape, level))
+    return filtered_max
+
+@stage
+def frangi(image, sigmas=range(1, 10, 2), alpha=0.5, beta=0.5, gamma=None, black_ridges=True,
+           mode='reflect', max_level=None, cache_dir=None):
+    """ skimage.filters.frangi (2D) on cached, pyramid-accelerated Hessian eigenvalues """
+    image = np.asarray(image, dtype=np.float32)
+    key = image_hash(image)
+    filtered_max = np.zeros_like(image)
+    for sigma in sigmas:
+        eig, level = hessian_eigvals(image, sigma, mode, max_level, key, cache_dir)
+        if not black_ridges:
+            eig = -eig
+        order = np.abs(eig).argsort(0)
+        eig = np.take_along_axis(eig, order, 0)
+        lambda1, lambda2 = eig[0], np.maximum(eig[1], 1e-10)
+        r_b = np.abs(lambda1) / lambda2
+        s = np.sqrt((eig**2).sum(0))
+        if gamma is None:
+            gamma = s.max() / 2
+            if gamma == 0:
+                gamma = 1
+        vals = np.exp(-r_b**2 / (2 * beta**2)) * (1.0 - np.exp(-s**2 / (2 * gamma**2)))
+        filtered_max = np.maximum(filtered_max, upsample(vals.astype(np.float32), image.shape, level))
+    return filtered_max